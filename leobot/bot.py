@@ -1,31 +1,88 @@
+import os
 import json
 import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from leobot.settings import *
 from core.settings_local import LEO_TELEGRAM_BOT_TOKEN
 
 
+def _make_retry(retries, backoff):
+    # only connection errors are retried, request is not sent then. Methods are POST which are not idempotent,
+    # so a message could be sent twice after a read error or an error status, rate limits (429) are handled
+    # by callers with retry_after
+    return Retry(total=retries, connect=retries, read=0, status=0, backoff_factor=backoff, raise_on_status=False)
+
+
 class LeoBot:
-    def __init__(self, token, token_prefix='', api_url='', timeout=30):
+    def __init__(self, token, token_prefix='', api_url='', timeout=30, pool_size=None, retries=None, backoff=None,
+                 session=None):
         self.token = token
         self.token_prefix = token_prefix if token_prefix else TELEGRAM_TOKEN_PREFIX
         self.api_url = api_url if api_url else TELEGRAM_API_URL
         self.timeout = timeout
+        self.session = session if session is not None else self._make_session(
+            pool_size if pool_size is not None else TELEGRAM_POOL_SIZE,
+            retries if retries is not None else TELEGRAM_RETRIES,
+            backoff if backoff is not None else TELEGRAM_BACKOFF)
+        self._urls = {}
+
+    @staticmethod
+    def _make_session(pool_size, retries, backoff):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=_make_retry(retries, backoff))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
 
     def _build_cmd_url(self, cmd):
-        token = '{0}{1}'.format(self.token_prefix, self.token)
-        url = '/'.join(s.strip('/') for s in (self.api_url, token, cmd) if s)
+        url = self._urls.get(cmd)
+        if url is None:
+            token = '{0}{1}'.format(self.token_prefix, self.token)
+            url = self._urls[cmd] = '/'.join(s.strip('/') for s in (self.api_url, token, cmd) if s)
         return url
 
     def execute(self, cmd, **payload):
         url = self._build_cmd_url(cmd)
-        return requests.post(url, data=payload, timeout=self.timeout)
+        return self.session.post(url, data=payload, timeout=self.timeout)
 
     def send_message(self, chat_id, text, mode='HTML'):
-        cmd = 'sendMessage'
-        payload = {'chat_id': chat_id, 'text': text, 'parse_mode': mode}
-        url = self._build_cmd_url(cmd)
-        return requests.post(url, data=payload, timeout=self.timeout)
+        return self.execute('sendMessage', chat_id=chat_id, text=text, parse_mode=mode)
+
+    def send_many(self, chat_id, texts, mode='HTML'):
+        """
+        Send messages one after another over the kept alive connection.
+        Sending stops at the first rate limited response (429), its retry_after tells when to send the rest
+        :return: list of responses, one per sent message
+        """
+        responses = []
+        for text in texts:
+            response = self.send_message(chat_id, text, mode)
+            responses.append(response)
+            if response.status_code == 429:
+                break
+        return responses
+
+    def close(self):
+        self.session.close()
+
+
+_bots = {}
+_bots_lock = threading.Lock()
+
+
+def get_bot(token=LEO_TELEGRAM_BOT_TOKEN):
+    """
+    Return bot shared by the current process, so connections are reused by all tasks of a worker
+    """
+    key = os.getpid(), token
+    with _bots_lock:
+        bot = _bots.get(key)
+        if bot is None:
+            bot = _bots[key] = LeoBot(token)
+        return bot
 
 
 if '__main__' == __name__:
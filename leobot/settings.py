@@ -1,2 +1,5 @@
 TELEGRAM_API_URL = 'https://api.telegram.org'
-TELEGRAM_TOKEN_PREFIX = 'bot'
\ No newline at end of file
+TELEGRAM_TOKEN_PREFIX = 'bot'
+TELEGRAM_POOL_SIZE = 4
+TELEGRAM_RETRIES = 3
+TELEGRAM_BACKOFF = 0.5
@@ -0,0 +1,69 @@
+import mock
+import unittest
+from requests.packages.urllib3.exceptions import ConnectTimeoutError, ReadTimeoutError
+
+from leobot import bot as leobot
+from leobot.bot import LeoBot, get_bot, _make_retry
+
+
+def make_response(status_code=200):
+    return mock.Mock(status_code=status_code)
+
+
+class TestLeoBot(unittest.TestCase):
+
+    def setUp(self):
+        self.session = mock.Mock()
+        self.session.post.return_value = make_response()
+        self.bot = LeoBot('token', session=self.session)
+
+    def test_retry(self):
+        retry = _make_retry(3, 0.5)
+        self.assertEqual(3, retry.connect)
+        self.assertEqual(0, retry.read)
+        self.assertEqual(0, retry.status)
+        self.assertFalse(retry.is_retry('POST', 503))
+        self.assertEqual(2, retry.increment('POST', '/', error=ConnectTimeoutError()).connect)
+        # message could be delivered already
+        with self.assertRaises(ReadTimeoutError):
+            retry.increment('POST', '/', error=ReadTimeoutError(None, '/', 'timeout'))
+
+    def test_session(self):
+        bot = LeoBot('token', pool_size=2, retries=1, backoff=0)
+        self.addCleanup(bot.close)
+        adapter = bot.session.get_adapter('https://api.telegram.org')
+        self.assertIs(adapter, bot.session.get_adapter('http://api.telegram.org'))
+        self.assertEqual(2, adapter._pool_maxsize)
+        self.assertEqual(1, adapter.max_retries.connect)
+
+    def test_execute(self):
+        self.bot.send_message(1, 'first')
+        self.bot.send_message(1, 'second')
+        self.assertEqual({'sendMessage': 'https://api.telegram.org/bottoken/sendMessage'}, self.bot._urls)
+        self.session.post.assert_called_with('https://api.telegram.org/bottoken/sendMessage',
+                                             data={'chat_id': 1, 'text': 'second', 'parse_mode': 'HTML'}, timeout=30)
+
+    def test_send_many(self):
+        self.session.post.side_effect = [make_response(), make_response(429), make_response()]
+        responses = self.bot.send_many(1, ['first', 'second', 'third'])
+        self.assertEqual([200, 429], [response.status_code for response in responses])
+        self.assertEqual(2, self.session.post.call_count)
+
+    def test_close(self):
+        self.bot.close()
+        self.session.close.assert_called_once_with()
+
+
+class TestGetBot(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(leobot._bots, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_bot_is_shared_by_process(self):
+        bot = get_bot('token')
+        self.assertIs(bot, get_bot('token'))
+        self.assertIsNot(bot, get_bot('other'))
+        with mock.patch('leobot.bot.os.getpid', return_value=-1):
+            self.assertIsNot(bot, get_bot('token'))
@@ -4,6 +4,10 @@ from core.models import Master
 from core.models import Category
 from core.models import Location
 from core.models import Masterclass
+from core.models import FetchState
+from core.models import Source
+from core.models import ImageState
+from core.models import TokenBucket
 
 
 @admin.register(Location)
@@ -30,3 +34,26 @@ class MasterclassAdminModel(admin.ModelAdmin):
     fields = ('uid', 'category', 'content', 'location', 'master', )
 
 
+@admin.register(Source)
+class SourceAdminModel(admin.ModelAdmin):
+    fields = ('id', 'name', 'url', 'city', 'tz', 'page_param', 'max_pages', 'is_active', )
+    readonly_fields = ('id', )
+
+
+@admin.register(FetchState)
+class FetchStateAdminModel(admin.ModelAdmin):
+    fields = ('id', 'url', 'etag', 'last_modified', 'digest', 'checked', 'changed',
+              'fetched_count', 'not_modified_count', 'unchanged_count', 'changed_count', )
+    readonly_fields = fields
+
+
+@admin.register(ImageState)
+class ImageStateAdminModel(admin.ModelAdmin):
+    fields = ('id', 'url', 'etag', 'last_modified', 'size', 'sha256', 'checked', 'changed', )
+    readonly_fields = fields
+
+
+@admin.register(TokenBucket)
+class TokenBucketAdminModel(admin.ModelAdmin):
+    fields = ('id', 'name', 'tokens', 'updated', 'blocked_until', )
+    readonly_fields = ('id', )
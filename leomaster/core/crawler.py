@@ -0,0 +1,113 @@
+import time
+import random
+import logging
+import threading
+import requests
+
+from collections import namedtuple
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+
+from core import settings as core_settings
+
+LOG = logging.getLogger(__name__)
+
+WORKERS = 8
+PER_HOST = 2
+JITTER = 2.0
+TIMEOUT = 30
+
+Page = namedtuple('Page', ('source', 'number', 'url', 'response', 'error'))
+
+
+def make_session(pool_size):
+    """
+    Return session keeping up to pool_size connections per host
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class Crawler:
+    """
+    Concurrent fetcher of listing pages of sources.
+    Pages are fetched by a pool of threads over one pooled session, at most per_host requests run against a host
+    at once and every request is delayed by a random jitter to be polite. Pages are yielded as they arrive,
+    next page of a source is requested as soon as the previous one succeeded, up to Source.max_pages
+    """
+
+    def __init__(self, workers=None, per_host=None, jitter=None, timeout=None, headers=None, session=None):
+        self.workers = workers or getattr(core_settings, 'LEO_CRAWLER_WORKERS', WORKERS)
+        self.per_host = per_host or getattr(core_settings, 'LEO_CRAWLER_PER_HOST', PER_HOST)
+        self.jitter = jitter if jitter is not None else getattr(core_settings, 'LEO_CRAWLER_JITTER', JITTER)
+        self.timeout = timeout or getattr(core_settings, 'LEO_TASK_TIMEOUT', TIMEOUT)
+        self.headers = headers or {}
+        self.session = session or make_session(self.workers)
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            semaphore = self._hosts.get(host)
+            if semaphore is None:
+                semaphore = self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return semaphore
+
+    def fetch(self, url, headers=None):
+        """
+        Fetch url within limit of its host after a politeness delay
+        :param url:
+        :param headers: headers of request, Crawler.headers are used by default
+        :return: requests.Response
+        :exception: requests.RequestException
+        """
+        with self._semaphore(url):
+            if self.jitter:
+                time.sleep(random.uniform(0, self.jitter))
+            LOG.debug('Fetching "%s"', url)
+            return self.session.get(url, headers=headers or self.headers, timeout=self.timeout)
+
+    def crawl(self, sources, prepare=None):
+        """
+        Fetch pages of sources concurrently
+        :param sources: iterable of core.models.Source
+        :param prepare: function of url to additional headers, it is called in the calling thread
+        :return: generator of Page in order of arrival, error is set if request failed
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {}
+
+            def submit(source, number):
+                url = source.page_url(number)
+                headers = dict(self.headers)
+                if prepare is not None:
+                    headers.update(prepare(url))
+                pending[executor.submit(self.fetch, url, headers)] = source, number, url
+
+            for source in sources:
+                submit(source, 1)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    source, number, url = pending.pop(future)
+                    try:
+                        response, error = future.result(), None
+                    except requests.RequestException as err:
+                        response, error = None, err
+                    if response is not None and response.status_code in (200, 304) and number < source.max_pages:
+                        submit(source, number + 1)
+                    yield Page(source, number, url, response, error)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,141 @@
+import os
+import re
+import logging
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from core import settings as core_settings
+
+LOG = logging.getLogger(__name__)
+
+WIDTHS = (320, 640, 1280)
+FORMATS = ('webp', 'jpeg')
+QUALITY = 80
+WORKERS = 4
+
+EXTENSIONS = {'jpeg': 'jpeg', 'webp': 'webp'}
+SOURCE_EXTENSIONS = ('.jpeg',)
+
+_VARIANT = re.compile(r'_\d+w\.(%s)$' % ('|'.join(EXTENSIONS.values()),))
+
+
+def variant_name(name, width, fmt):
+    """
+    Return file name of variant of image, e.g. "uid_preview.jpeg" -> "uid_preview_640w.webp"
+    """
+    stem, _ = os.path.splitext(name)
+    return '%s_%sw.%s' % (stem, width, EXTENSIONS[fmt])
+
+
+def is_variant(name):
+    """
+    Check whether file name is a name of variant, see variant_name
+    """
+    return _VARIANT.search(name) is not None
+
+
+def sources(directory):
+    """
+    Return paths of downloaded images in directory, variants, hidden and temporary files are omitted
+    """
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if not name.startswith('.') and name.endswith(SOURCE_EXTENSIONS) and not is_variant(name))
+
+
+class DerivativeGenerator:
+    """
+    Generator of resized and recompressed variants of downloaded images at fixed widths and formats.
+    Variants are written next to the source image (see variant_name) and get modification time of the source,
+    so they are generated again only if the source is replaced. Images are never upscaled,
+    a variant wider than its source has size of the source
+    """
+
+    def __init__(self, widths=None, formats=None, quality=None, workers=None):
+        self.widths = sorted(widths or getattr(core_settings, 'LEO_DERIVATIVE_WIDTHS', WIDTHS), reverse=True)
+        self.formats = formats or getattr(core_settings, 'LEO_DERIVATIVE_FORMATS', FORMATS)
+        self.quality = quality or getattr(core_settings, 'LEO_DERIVATIVE_QUALITY', QUALITY)
+        self.workers = workers or getattr(core_settings, 'LEO_DERIVATIVE_WORKERS', WORKERS)
+
+    def variants(self, path):
+        """
+        Return variants of image
+        :param path: path of source image
+        :return: list of (width, format, path of variant)
+        """
+        directory, name = os.path.split(path)
+        return [(width, fmt, os.path.join(directory, variant_name(name, width, fmt)))
+                for width in self.widths for fmt in self.formats]
+
+    def stale(self, path):
+        """
+        Return variants which are missing or older than the source image
+        """
+        mtime = os.stat(path).st_mtime_ns
+        result = []
+        for width, fmt, variant in self.variants(path):
+            try:
+                if os.stat(variant).st_mtime_ns == mtime:
+                    continue
+            except FileNotFoundError:
+                pass
+            result.append((width, fmt, variant))
+        return result
+
+    def generate(self, path):
+        """
+        Generate stale variants of image
+        :param path: path of source image
+        :return: amount of generated variants
+        :exception: OSError if image can not be read or written, ValueError or Image.DecompressionBombError
+                    if image is broken or too large
+        """
+        stale = self.stale(path)
+        if not stale:
+            return 0
+        stat = os.stat(path)
+        with Image.open(path) as image:
+            image.load()
+            for width, fmt, variant in stale:
+                self._save(self._resize(image, width), fmt, variant)
+                os.utime(variant, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        return len(stale)
+
+    @staticmethod
+    def _resize(image, width):
+        if image.width <= width:
+            return image
+        height = max(1, round(image.height * width / image.width))
+        return image.resize((width, height), Image.LANCZOS)
+
+    def _save(self, image, fmt, path):
+        if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                image.save(tmp, format=fmt.upper(), quality=self.quality, optimize=fmt == 'jpeg',
+                           progressive=fmt == 'jpeg')
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _generate(self, path):
+        try:
+            return self.generate(path)
+        except (OSError, ValueError, Image.DecompressionBombError) as err:
+            return err
+
+    def generate_many(self, paths):
+        """
+        Generate stale variants of many images concurrently
+        :param paths: paths of source images
+        :return: dict of path to amount of generated variants or to error
+        """
+        paths = list(paths)
+        if len(paths) < 2:
+            return {path: self._generate(path) for path in paths}
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(paths))) as executor:
+            return dict(zip(paths, executor.map(self._generate, paths)))
@@ -0,0 +1,161 @@
+import os
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import tempfile
+import requests
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from core import settings as core_settings
+from core.crawler import make_session
+
+LOG = logging.getLogger(__name__)
+
+WORKERS = 8
+TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+STORE_DIR = '.store'
+GARBAGE_AGE = 60 * 60
+
+NOT_MODIFIED = 'not_modified'
+UNCHANGED = 'unchanged'
+SAVED = 'saved'
+MISSING = 'missing'
+FAILED = 'failed'
+
+Validators = namedtuple('Validators', ('etag', 'last_modified', 'size', 'sha256'))
+Download = namedtuple('Download', ('url', 'path', 'status', 'validators', 'error'))
+
+
+def store_of(path):
+    """
+    Return directory of content addressed files for target path
+    """
+    return os.path.join(os.path.dirname(path), STORE_DIR)
+
+
+def collect_garbage(directory, age=GARBAGE_AGE):
+    """
+    Delete stored files which are not linked to any target anymore
+    :param directory: directory of targets
+    :param age: files modified less than age seconds ago are kept, they may be about to be linked
+    :return: amount of deleted files
+    """
+    deleted, before = 0, time.time() - age
+    for root, _, names in os.walk(os.path.join(directory, STORE_DIR)):
+        for name in names:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            if stat.st_nlink == 1 and stat.st_mtime < before:
+                os.unlink(path)
+                deleted += 1
+    return deleted
+
+
+class ImageFetcher:
+    """
+    Concurrent downloader of images over one pooled session.
+    Bodies are streamed to a content addressed store next to targets (see store_of), a target is a hard link
+    to the stored file of its content, so identical images are kept once and a target is replaced atomically
+    only if its content changed. Requests are conditional on validators of the previous download
+    """
+
+    def __init__(self, workers=None, timeout=None, headers=None, session=None, chunk_size=CHUNK_SIZE):
+        self.workers = workers or getattr(core_settings, 'LEO_IMAGE_WORKERS', WORKERS)
+        self.timeout = timeout or getattr(core_settings, 'LEO_TASK_TIMEOUT', TIMEOUT)
+        self.headers = headers or {}
+        self.session = session or make_session(self.workers)
+        self.chunk_size = chunk_size
+
+    def download(self, url, path, validators=None):
+        """
+        Download url to path
+        :param validators: Validators of the previous download of url
+        :return: status, Validators of the current content
+        :exception: requests.RequestException, OSError
+        """
+        headers = dict(self.headers)
+        if validators is not None and os.path.exists(path):
+            if validators.etag:
+                headers['If-None-Match'] = validators.etag
+            if validators.last_modified:
+                headers['If-Modified-Since'] = validators.last_modified
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 304:
+                return NOT_MODIFIED, validators
+            if response.status_code != 200:
+                LOG.warning('Problem occurred while downloading image "%s", response code is %s',
+                            url, response.status_code)
+                return MISSING, validators
+            stored, size, sha256 = self._store(response, store_of(path))
+        validators = Validators(response.headers.get('ETag', ''), response.headers.get('Last-Modified', ''),
+                                size, sha256)
+        if os.path.exists(path) and os.path.samefile(path, stored):
+            return UNCHANGED, validators
+        self._link(stored, path)
+        return SAVED, validators
+
+    def _store(self, response, directory):
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+        digest, size = hashlib.sha256(), 0
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+            sha256 = digest.hexdigest()
+            stored = os.path.join(directory, sha256[:2], sha256)
+            if os.path.exists(stored):
+                os.unlink(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(stored), exist_ok=True)
+                os.replace(tmp_path, stored)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return stored, size, sha256
+
+    @staticmethod
+    def _link(stored, path):
+        tmp_path = '%s.%s.part' % (path, uuid.uuid4().hex)
+        try:
+            os.link(stored, tmp_path)
+        except OSError:
+            shutil.copyfile(stored, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _download(self, job):
+        url, path, validators = (tuple(job) + (None,))[:3]
+        try:
+            status, validators = self.download(url, path, validators)
+            return Download(url, path, status, validators, None)
+        except (requests.RequestException, OSError) as err:
+            return Download(url, path, FAILED, validators, err)
+
+    def download_many(self, jobs):
+        """
+        Download many images concurrently
+        :param jobs: iterable of (url, path) or (url, path, validators)
+        :return: list of Download in order of jobs, error is set if download failed
+        """
+        jobs = list(jobs)
+        if len(jobs) < 2:
+            return [self._download(job) for job in jobs]
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(jobs))) as executor:
+            return list(executor.map(self._download, jobs))
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
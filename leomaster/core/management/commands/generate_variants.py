@@ -0,0 +1,32 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.derivatives import DerivativeGenerator, sources
+
+
+class Command(BaseCommand):
+    help = 'Generate missing and stale variants of downloaded images, e.g. after widths or formats are changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='amount of images processed concurrently, see LEO_DERIVATIVE_WORKERS')
+
+    def handle(self, *args, **options):
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError('Value of "workers" must be positive')
+
+        directory = os.path.join(settings.MEDIA_ROOT, getattr(settings, 'DOWNLOAD_IMG_DIR', 'downloads/img'))
+        if not os.path.isdir(directory):
+            raise CommandError('Directory of images "%s" does not exist' % (directory,))
+
+        generated, failed = 0, 0
+        paths = sources(directory)
+        for path, result in DerivativeGenerator(workers=options['workers']).generate_many(paths).items():
+            if isinstance(result, Exception):
+                failed += 1
+                self.stderr.write('Could not generate variants of "%s": %s' % (path, result))
+            else:
+                generated += result
+        self.stdout.write('images: %s, generated variants: %s, failed images: %s' % (len(paths), generated, failed))
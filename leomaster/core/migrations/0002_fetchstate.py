@@ -0,0 +1,29 @@
+# Generated by Django 2.0.6 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FetchState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(max_length=2048, unique=True, verbose_name='url')),
+                ('etag', models.TextField(blank=True, default='', verbose_name='etag')),
+                ('last_modified', models.TextField(blank=True, default='', verbose_name='last modified')),
+                ('digest', models.CharField(blank=True, default='', max_length=64, verbose_name='digest')),
+                ('checked', models.DateTimeField(default=None, null=True, verbose_name='checked')),
+                ('changed', models.DateTimeField(default=None, null=True, verbose_name='changed')),
+                ('fetched_count', models.PositiveIntegerField(default=0, verbose_name='fetched responses')),
+                ('not_modified_count', models.PositiveIntegerField(default=0, verbose_name='not modified responses')),
+                ('unchanged_count', models.PositiveIntegerField(default=0, verbose_name='unchanged responses')),
+                ('changed_count', models.PositiveIntegerField(default=0, verbose_name='changed responses')),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.0.6 on 2026-10-18 13:45
+
+from django.db import migrations, models
+
+
+def add_default_source(apps, schema_editor):
+    Source = apps.get_model('core', 'Source')
+    Source.objects.get_or_create(name='petersburg', defaults={'url': 'https://leonardo.ru/masterclasses/petersburg/'})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_fetchstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Source',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField(unique=True, verbose_name='name')),
+                ('url', models.URLField(max_length=2048, verbose_name='url')),
+                ('city', models.TextField(blank=True, default='', verbose_name='city')),
+                ('tz', models.TextField(default='Europe/Moscow', verbose_name='timezone')),
+                ('page_param', models.TextField(blank=True, default='page', verbose_name='page parameter')),
+                ('max_pages', models.PositiveIntegerField(default=1, verbose_name='max pages')),
+                ('is_active', models.BooleanField(default=True, verbose_name='active')),
+            ],
+        ),
+        migrations.RunPython(add_default_source, migrations.RunPython.noop),
+    ]
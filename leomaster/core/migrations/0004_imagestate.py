@@ -0,0 +1,26 @@
+# Generated by Django 2.0.6 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_source'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(max_length=2048, unique=True, verbose_name='url')),
+                ('etag', models.TextField(blank=True, default='', verbose_name='etag')),
+                ('last_modified', models.TextField(blank=True, default='', verbose_name='last modified')),
+                ('size', models.BigIntegerField(default=None, null=True, verbose_name='size')),
+                ('sha256', models.CharField(blank=True, default='', max_length=64, verbose_name='sha256')),
+                ('checked', models.DateTimeField(default=None, null=True, verbose_name='checked')),
+                ('changed', models.DateTimeField(default=None, null=True, verbose_name='changed')),
+            ],
+        ),
+    ]
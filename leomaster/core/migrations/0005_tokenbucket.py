@@ -0,0 +1,23 @@
+# Generated by Django 2.0.6 on 2026-10-18 14:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_imagestate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField(unique=True, verbose_name='name')),
+                ('tokens', models.FloatField(default=0, verbose_name='tokens')),
+                ('updated', models.DateTimeField(default=None, null=True, verbose_name='updated')),
+                ('blocked_until', models.DateTimeField(default=None, null=True, verbose_name='blocked until')),
+            ],
+        ),
+    ]
@@ -1,5 +1,14 @@
-from django.db import models
+import hashlib
+
+from datetime import timedelta
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
+
+from core.images import Validators
 from leoparser.models import PersistentHistoryDocument
 
 
@@ -31,3 +40,202 @@ class Masterclass(PersistentHistoryDocument):
     mapping = {
         'datetime': date
     }
+
+
+class Source(models.Model):
+    """
+    Listing page of masterclasses of a city followed by core.tasks.update, see core.crawler.Crawler
+    """
+    name = models.TextField(verbose_name='name', unique=True)
+    url = models.URLField(verbose_name='url', max_length=2048)
+    city = models.TextField(verbose_name='city', blank=True, default='')
+    tz = models.TextField(verbose_name='timezone', default='Europe/Moscow')
+    page_param = models.TextField(verbose_name='page parameter', blank=True, default='page')
+    max_pages = models.PositiveIntegerField(verbose_name='max pages', default=1)
+    is_active = models.BooleanField(verbose_name='active', default=True)
+
+    def __repr__(self):
+        return '<%s: name="%s">' % (self.__class__.__name__, self.name,)
+
+    def page_url(self, number):
+        """
+        Return url of listing page by number, the first page is the url itself
+        :param number: number of page starting from 1
+        :return: url
+        """
+        if number <= 1 or not self.page_param:
+            return self.url
+        scheme, netloc, path, query, fragment = urlsplit(self.url)
+        query = [(key, value) for key, value in parse_qsl(query, keep_blank_values=True) if key != self.page_param]
+        query.append((self.page_param, str(number)))
+        return urlunsplit((scheme, netloc, path, urlencode(query), fragment))
+
+
+class FetchState(models.Model):
+    """
+    State of conditional fetching of a url: validators and digest of the last processed response
+    and counters of how fetches ended, see core.tasks.update
+    """
+    url = models.URLField(verbose_name='url', max_length=2048, unique=True)
+    etag = models.TextField(verbose_name='etag', blank=True, default='')
+    last_modified = models.TextField(verbose_name='last modified', blank=True, default='')
+    digest = models.CharField(verbose_name='digest', max_length=64, blank=True, default='')
+    checked = models.DateTimeField(verbose_name='checked', null=True, default=None)
+    changed = models.DateTimeField(verbose_name='changed', null=True, default=None)
+    fetched_count = models.PositiveIntegerField(verbose_name='fetched responses', default=0)
+    not_modified_count = models.PositiveIntegerField(verbose_name='not modified responses', default=0)
+    unchanged_count = models.PositiveIntegerField(verbose_name='unchanged responses', default=0)
+    changed_count = models.PositiveIntegerField(verbose_name='changed responses', default=0)
+
+    def __repr__(self):
+        return '<%s: url="%s">' % (self.__class__.__name__, self.url,)
+
+    def conditional_headers(self):
+        """
+        Return headers making request conditional on validators of the last processed response
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    @staticmethod
+    def digest_of(content):
+        return hashlib.sha256(content).hexdigest()
+
+    def is_modified(self, response):
+        """
+        Decide whether response has to be processed, it is not on 304 or if body is the same as the last processed one.
+        Outcome is counted
+        :param response: requests.Response of request with conditional_headers
+        :return: bool
+        """
+        if response.status_code == 304:
+            self._count('not_modified_count')
+            return False
+        if self.digest and self.digest == self.digest_of(response.content):
+            self._count('unchanged_count')
+            return False
+        self._count('changed_count')
+        return True
+
+    def remember(self, response):
+        """
+        Store validators and digest of successfully processed response
+        :param response: requests.Response
+        """
+        self.etag = response.headers.get('ETag', '')
+        self.last_modified = response.headers.get('Last-Modified', '')
+        self.digest = self.digest_of(response.content)
+        self.changed = timezone.now()
+        self.save(update_fields=['etag', 'last_modified', 'digest', 'changed'])
+
+    def _count(self, counter):
+        self.checked = timezone.now()
+        counters = {'fetched_count': F('fetched_count') + 1, counter: F(counter) + 1}
+        FetchState.objects.filter(pk=self.pk).update(checked=self.checked, **counters)
+        self.refresh_from_db(fields=list(counters))
+
+
+class ImageState(models.Model):
+    """
+    Validators and content of the last downloaded version of an image url, see core.images.ImageFetcher
+    """
+    url = models.URLField(verbose_name='url', max_length=2048, unique=True)
+    etag = models.TextField(verbose_name='etag', blank=True, default='')
+    last_modified = models.TextField(verbose_name='last modified', blank=True, default='')
+    size = models.BigIntegerField(verbose_name='size', null=True, default=None)
+    sha256 = models.CharField(verbose_name='sha256', max_length=64, blank=True, default='')
+    checked = models.DateTimeField(verbose_name='checked', null=True, default=None)
+    changed = models.DateTimeField(verbose_name='changed', null=True, default=None)
+
+    def __repr__(self):
+        return '<%s: url="%s">' % (self.__class__.__name__, self.url,)
+
+    @property
+    def validators(self):
+        return Validators(self.etag, self.last_modified, self.size, self.sha256)
+
+    @classmethod
+    def validators_of(cls, urls):
+        """
+        Return validators of urls by one query
+        :return: dict of url to Validators, unknown urls are omitted
+        """
+        return {state.url: state.validators for state in cls.objects.filter(url__in=set(urls))}
+
+    @classmethod
+    def record(cls, downloads):
+        """
+        Store outcome of downloads
+        :param downloads: iterable of core.images.Download
+        """
+        now = timezone.now()
+        downloads = {download.url: download for download in downloads if download.validators is not None}
+        states = {state.url: state for state in cls.objects.filter(url__in=list(downloads))}
+        created = []
+        for url, download in downloads.items():
+            state = states.get(url)
+            if state is None:
+                state = cls(url=url)
+                created.append(state)
+            if state.validators != download.validators:
+                state.etag, state.last_modified, state.size, state.sha256 = download.validators
+                state.changed = now
+            state.checked = now
+            if state.pk is not None:
+                state.save()
+        cls.objects.bulk_create(created)
+
+
+class TokenBucket(models.Model):
+    """
+    Token bucket shared by all worker processes, it limits rate of an action, e.g. of sending notifications.
+    Bucket is refilled by rate tokens per second up to capacity, it may be blocked for a while
+    when the remote side asks to slow down
+    """
+    name = models.TextField(verbose_name='name', unique=True)
+    tokens = models.FloatField(verbose_name='tokens', default=0)
+    updated = models.DateTimeField(verbose_name='updated', null=True, default=None)
+    blocked_until = models.DateTimeField(verbose_name='blocked until', null=True, default=None)
+
+    def __repr__(self):
+        return '<%s: name="%s">' % (self.__class__.__name__, self.name,)
+
+    @classmethod
+    def acquire(cls, name, rate, capacity, amount=1):
+        """
+        Take tokens from bucket, row of bucket is locked while tokens are counted
+        :param name: name of bucket
+        :param rate: tokens per second
+        :param capacity: max amount of tokens
+        :param amount: amount of tokens to take
+        :return: 0 if tokens are taken, otherwise seconds to wait before trying again
+        """
+        with transaction.atomic():
+            now = timezone.now()
+            bucket, _ = cls.objects.select_for_update().get_or_create(name=name,
+                                                                      defaults={'tokens': capacity, 'updated': now})
+            if bucket.blocked_until is not None and bucket.blocked_until > now:
+                return (bucket.blocked_until - now).total_seconds()
+            elapsed = (now - bucket.updated).total_seconds() if bucket.updated is not None else 0
+            bucket.tokens = min(capacity, bucket.tokens + max(elapsed, 0) * rate)
+            bucket.updated = now
+            wait = 0
+            if bucket.tokens >= amount:
+                bucket.tokens -= amount
+            else:
+                wait = (amount - bucket.tokens) / rate
+            bucket.save(update_fields=['tokens', 'updated'])
+            return wait
+
+    @classmethod
+    def block(cls, name, seconds):
+        """
+        Block bucket for seconds and empty it
+        """
+        now = timezone.now()
+        cls.objects.update_or_create(name=name, defaults={'tokens': 0, 'updated': now,
+                                                          'blocked_until': now + timedelta(seconds=seconds)})
@@ -0,0 +1,85 @@
+import time
+import logging
+
+from core import settings as core_settings
+from core.models import TokenBucket
+
+LOG = logging.getLogger(__name__)
+
+RATE = 20 / 60
+BURST = 3
+MAX_WAIT = 10
+DIGEST_SIZE = 4096
+DIGEST_SEPARATOR = '\n\n'
+RETRY_AFTER = 30
+
+
+def build_digests(messages, size=DIGEST_SIZE, separator=DIGEST_SEPARATOR):
+    """
+    Group messages into digests of at most size characters, a longer message makes a digest alone
+    :param messages: list of (key, text) in order
+    :return: list of (keys, text)
+    """
+    digests, keys, texts, length = [], [], [], 0
+    for key, text in messages:
+        if texts and length + len(separator) + len(text) > size:
+            digests.append((keys, separator.join(texts)))
+            keys, texts, length = [], [], 0
+        length += len(text) + (len(separator) if texts else 0)
+        keys.append(key)
+        texts.append(text)
+    if texts:
+        digests.append((keys, separator.join(texts)))
+    return digests
+
+
+class NotificationDispatcher:
+    """
+    Sender of notifications grouped into digests.
+    Every digest takes a token of a TokenBucket shared by worker processes, short waits for a token are slept,
+    a longer wait or retry_after of a rate limited response stops sending, remaining messages have to be sent later
+    """
+
+    def __init__(self, bot, chat_id, bucket=None, rate=None, burst=None, max_wait=None, digest_size=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.bucket = bucket or 'telegram:%s' % (chat_id,)
+        self.rate = rate or getattr(core_settings, 'LEO_NOTIFICATION_RATE', RATE)
+        self.burst = burst or getattr(core_settings, 'LEO_NOTIFICATION_BURST', BURST)
+        self.max_wait = max_wait if max_wait is not None else getattr(core_settings, 'LEO_NOTIFICATION_MAX_WAIT',
+                                                                      MAX_WAIT)
+        self.digest_size = digest_size or getattr(core_settings, 'LEO_NOTIFICATION_DIGEST_SIZE', DIGEST_SIZE)
+        self.sent = []
+
+    def _acquire(self):
+        while True:
+            wait = TokenBucket.acquire(self.bucket, self.rate, self.burst)
+            if not wait or wait > self.max_wait:
+                return wait
+            time.sleep(wait)
+
+    def send(self, messages):
+        """
+        Send messages as digests, keys of sent messages are collected in sent
+        :param messages: list of (key, text) in order
+        :return: None if all messages are sent, otherwise seconds to wait before sending the rest
+        :exception: requests.RequestException
+        """
+        for keys, text in build_digests(messages, self.digest_size):
+            wait = self._acquire()
+            if wait:
+                LOG.info('Rate of notifications is exceeded, %s messages are postponed for %.1f seconds',
+                         len(messages) - len(self.sent), wait)
+                return wait
+            response = self.bot.send_message(self.chat_id, text)
+            if response.status_code == 429:
+                try:
+                    retry_after = response.json()['parameters']['retry_after']
+                except (ValueError, KeyError, TypeError):
+                    retry_after = RETRY_AFTER
+                LOG.warning('Notifications are rate limited by server for %s seconds', retry_after)
+                TokenBucket.block(self.bucket, retry_after)
+                return retry_after
+            response.raise_for_status()
+            self.sent.extend(keys)
+        return None
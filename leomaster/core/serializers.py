@@ -1,10 +1,40 @@
+import os
+import posixpath
+
+from django.conf import settings
 from rest_framework import serializers
 from core.models import Masterclass
+from core.derivatives import DerivativeGenerator, variant_name
 
 
 class MasterclassSerializer(serializers.ModelSerializer):
     location = serializers.SlugRelatedField(read_only=True, slug_field='name')
     master = serializers.SlugRelatedField(read_only=True, slug_field='name')
+    images = serializers.SerializerMethodField()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._derivatives = DerivativeGenerator()
+
+    def get_images(self, mc):
+        """
+        Urls of original images and of their variants which are generated already,
+        missing variants are made by fetch_images or by the command generate_variants
+        """
+        img_dir = getattr(settings, 'DOWNLOAD_IMG_DIR', 'downloads/img')
+        base = posixpath.join(settings.MEDIA_URL, img_dir, '')
+        directory = os.path.join(settings.MEDIA_ROOT, img_dir)
+        images = {}
+        for kind, name in (('main', '{0}.jpeg'), ('preview', '{0}_preview.jpeg')):
+            name = name.format(mc.uid)
+            variants = []
+            for width in sorted(self._derivatives.widths):
+                for fmt in self._derivatives.formats:
+                    variant = variant_name(name, width, fmt)
+                    if os.path.exists(os.path.join(directory, variant)):
+                        variants.append({'width': width, 'format': fmt, 'url': base + variant})
+            images[kind] = {'original': base + name, 'variants': variants}
+        return images
 
     class Meta:
         model = Masterclass
@@ -24,4 +54,5 @@ class MasterclassSerializer(serializers.ModelSerializer):
                   'max_complexity',
                   'complexity',
                   'creation_ts',
-                  'modification_ts')
+                  'modification_ts',
+                  'images')
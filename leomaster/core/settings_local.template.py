@@ -19,3 +19,17 @@ LEO_TASK_TIMEOUT = 30
 LEO_NOTIFICATION_MAX_RETRIES = 100
 LEO_DOWNLOAD_MAX_RETRIES = 1
 LEO_UPDATE_MAX_RETRIES = 1
+LEO_CRAWLER_WORKERS = 8
+LEO_CRAWLER_PER_HOST = 2
+LEO_CRAWLER_JITTER = 2.0
+LEO_IMAGE_WORKERS = 8
+LEO_IMAGE_BATCH_SIZE = 50
+LEO_DERIVATIVE_WIDTHS = (320, 640, 1280)
+LEO_DERIVATIVE_FORMATS = ('webp', 'jpeg')
+LEO_DERIVATIVE_QUALITY = 80
+LEO_DERIVATIVE_WORKERS = 4
+LEO_NOTIFICATION_IMAGE_WIDTH = 640
+LEO_NOTIFICATION_RATE = 20 / 60
+LEO_NOTIFICATION_BURST = 3
+LEO_NOTIFICATION_MAX_WAIT = 10
+LEO_NOTIFICATION_DIGEST_SIZE = 4096
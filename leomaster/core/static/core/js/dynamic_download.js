@@ -1,5 +1,7 @@
 let url = '/api/masterclasses/';
 let inProcess = false;
+let cardSizes = '(min-width: 1450px) 20vw, (min-width: 1200px) 25vw, (min-width: 768px) 34vw, (min-width: 500px) 50vw, 100vw';
+let modalSizes = '(min-width: 576px) 500px, 100vw';
 
 function printDateTime(stringDate) {
     let date = new Date(stringDate);
@@ -51,6 +53,23 @@ function toTime(seconds) {
     return `${days > 0 ? days + " дней " : ""}${hours > 0 ? hours + " ч. " : ""}${minutes > 0 ? minutes + " мин. " : ""}${seconds > 0 ? seconds + " сек. " : ""}`
 }
 
+function srcset(image, format) {
+    return image.variants
+        .filter(variant => variant.format === format)
+        .map(variant => `${variant.url} ${variant.width}w`)
+        .join(', ');
+}
+
+function printPicture(image, sizes, attributes) {
+    // browser requests the smallest variant suitable for the layout, webp if it is supported
+    let webp = srcset(image, 'webp');
+    let jpeg = srcset(image, 'jpeg');
+    return `<picture>
+                ${webp ? `<source type="image/webp" srcset="${webp}" sizes="${sizes}">` : ''}
+                <img src="${image.original}" ${jpeg ? `srcset="${jpeg}" sizes="${sizes}"` : ''} ${attributes}>
+            </picture>`
+}
+
 function download() {
     if (url && !inProcess) {
         $.ajax({
@@ -72,7 +91,7 @@ function download() {
                         <div class="grid-item">
                             <div class="card text-center rounded-0 mc-block ${mc.avail_seats ? "" : "not-available"} ${isWeekend(mc.date) ? "holiday" : ""}" style="width: 100%;">
                                 <div class="card-body d-flex flex-column">
-                                    <img data-toggle="modal" data-target="#mcDescription_${mc.uid}" src="/media/downloads/img/${mc.uid}.jpeg" alt="${mc.title}" class="img-thumbnail rounded-0">
+                                    ${printPicture(mc.images.main, cardSizes, `data-toggle="modal" data-target="#mcDescription_${mc.uid}" alt="${mc.title}" class="img-thumbnail rounded-0"`)}
                                     <h6 class="card-title">${mc.title}</h6>
                                     <div class="mc-short-description mt-auto text-left">
                                         <hr>
@@ -97,7 +116,7 @@ function download() {
                                                 <p class="float-left">${printFullDate(mc.date)}</p>
                                                 <p class="float-right">${printComplexity(mc.complexity, mc.max_complexity)}</p>
                                             </div>
-                                            <p><img src="/media/downloads/img/${mc.uid}_preview.jpeg" alt="${mc.title}" class="img-thumbnail rounded-0"></p>
+                                            <p>${printPicture(mc.images.preview, modalSizes, `alt="${mc.title}" class="img-thumbnail rounded-0"`)}</p>
                                             <div class="mc-detail">
                                                 <p><i class="icon fa fa-map-marker fa-fw" aria-hidden="true"></i> ${mc.location}</p>
                                                 <p><i class="icon fa fa-user fa-fw"></i> ${mc.master}</p>
@@ -1,7 +1,5 @@
 import pytz
-import time
 import json
-import random
 import requests
 import celery.signals
 
@@ -13,14 +11,23 @@ from django.utils.formats import date_format
 from celery.utils.log import get_task_logger
 from logging.handlers import TimedRotatingFileHandler
 
-from leobot.bot import LeoBot
+from leobot.bot import get_bot
+from leoparser import compaction
 from core.models import *
+from core.crawler import Crawler
+from core import images
+from core.images import ImageFetcher
+from core.derivatives import DerivativeGenerator, variant_name
+from core.notifications import NotificationDispatcher
 from core.settings import *
+from core import settings as core_settings
 from leomaster.celery import app
 from _leoparser.leoparser import LeoParserFabric
 
 CONTENT_URL = 'https://leonardo.ru/masterclasses/petersburg/'
 CURRENT_TZ = 'Europe/Moscow'
+IMAGE_BATCH_SIZE = 50
+NOTIFICATION_IMAGE_WIDTH = 640
 
 logger = get_task_logger(__name__)
 
@@ -38,29 +45,7 @@ def on_after_setup_task_logger(**kwargs):
         def_logger.addHandler(time_rot_fh)
 
 
-@app.task(bind=True, max_retries=LEO_UPDATE_MAX_RETRIES, ignore_result=True)
-def update(self):
-    random.seed()
-    time.sleep(random.randint(0, 120))
-    logger.info('>>>>> Starting update task')
-    user_agent = fake_useragent.UserAgent(fallback=LEO_DEFAULT_USER_AGENT,
-                                          path=LEO_FAKE_USER_AGENT_CACHE)
-    current_agent = user_agent.random
-    logger.info('Current user agent: {0}'.format(current_agent))
-
-    http_headers = {'User-Agent': current_agent}
-    web_session = requests.Session()
-    web_request = requests.Request('GET', CONTENT_URL, headers=http_headers)
-    prepared_request = web_request.prepare()
-    logger.info('Executing HTTP request (url: "{0}")'.format(CONTENT_URL))
-    try:
-        response = web_session.send(prepared_request, timeout=LEO_TASK_TIMEOUT)
-    except requests.RequestException as err:
-        logger.exception('Error occurred while trying to update masterclasses: {0}'.format(err))
-        logger.warning('Task "download_images" will be retry (attempt {0} of {1})'.format(
-            self.request.retries, LEO_DOWNLOAD_MAX_RETRIES))
-        raise self.retry(exc=err, countdown=(2 ** self.request.retries) * LEO_RETRY_DELAY)
-
+def create_parser():
     logger.info('Open parser config file: "{0}"'.format(LEO_PARSER_CONFIG_PATH))
     with open(LEO_PARSER_CONFIG_PATH, 'r', encoding='utf8') as f_dsc:
         config = f_dsc.read()
@@ -69,21 +54,26 @@ def update(self):
     config_dict = json.loads(config)
     lp_fabric = LeoParserFabric(config_dict)
     logger.info('Creating parser')
-    lp = lp_fabric.create_parser()
-    logger.info('Extracting page content (encoding: {0})'.format(response.encoding))
-    raw_content = response.content.decode(encoding=response.encoding).encode(encoding='utf-8').decode(encoding='utf-8')
-    logger.info('Parsing'.format())
-    parsed_content = lp.parse_to_dict(raw_content)
+    return lp_fabric.create_parser()
+
+
+def save_masterclasses(source, parsed_content):
+    """
+    Save parsed masterclasses of source
+    :return: list of ids of new masterclasses
+    """
+    created = []
     for key, body in parsed_content.items():
-        logger.info('Masterclass has been found (uid: {0})'.format(key))
-        master, created = Master.objects.get_or_create(name=body.pop('master', ''))
-        if created:
+        logger.info('Masterclass has been found (uid: {0}, source: {1})'.format(key, source.name))
+        master, master_created = Master.objects.get_or_create(name=body.pop('master', ''))
+        if master_created:
             logger.info('New master was added: "{0}"'.format(master.name))
         else:
             logger.info('Master already exists: "{0}"'.format(master.name))
 
-        location, created = Location.objects.get_or_create(name=body.pop('location', ''))
-        if created:
+        location, location_created = Location.objects.get_or_create(name=body.pop('location', ''),
+                                                                    defaults={'city': source.city, 'tz': source.tz})
+        if location_created:
             logger.info('New location was added: "{0}"'.format(location.name))
         else:
             logger.info('Location already exists: "{0}"'.format(location.name))
@@ -91,12 +81,7 @@ def update(self):
         if not Masterclass.objects.filter(uid=key).exists():
             mc = Masterclass.objects.create(**body, master=master, location=location)
             logger.info('New masterclass was added: "{0}"'.format(mc.uid))
-
-            chain = celery.chain(
-                download_images.si(mc.id).set(queue='downloads'),
-                notify.si(mc.id).set(queue='notifications'),
-            )
-            chain.delay()
+            created.append(mc.id)
         else:
             body.pop('uid')
             if body.get('duration') == 0:
@@ -104,113 +89,240 @@ def update(self):
             body = {key: value for key, value in body.items() if value not in {'', None}}
             Masterclass.objects.filter(uid=key).update(**body, master=master, location=location)
             logger.info('Masterclass already exists: "{0}"'.format(key))
+    return created
+
+
+@app.task(bind=True, max_retries=LEO_UPDATE_MAX_RETRIES, ignore_result=True)
+def update(self):
+    logger.info('>>>>> Starting update task')
+    user_agent = fake_useragent.UserAgent(fallback=LEO_DEFAULT_USER_AGENT,
+                                          path=LEO_FAKE_USER_AGENT_CACHE)
+    current_agent = user_agent.random
+    logger.info('Current user agent: {0}'.format(current_agent))
+
+    sources = list(Source.objects.filter(is_active=True))
+    logger.info('Sources to update: {0}'.format(', '.join(source.name for source in sources)))
+    fetch_states = {}
+
+    def conditional_headers(url):
+        fetch_states[url], _ = FetchState.objects.get_or_create(url=url)
+        return fetch_states[url].conditional_headers()
+
+    lp = None
+    pages, errors, created, targets = 0, [], [], {}
+    with Crawler(headers={'User-Agent': current_agent}) as crawler:
+        for page in crawler.crawl(sources, prepare=conditional_headers):
+            pages += 1
+            if page.error is not None:
+                logger.error('Error occurred while trying to fetch page {0} of "{1}" (url: "{2}"): {3}'.format(
+                    page.number, page.source.name, page.url, page.error))
+                errors.append(page.error)
+                continue
+            if page.response.status_code not in (200, 304):
+                logger.error('Unexpected status of page {0} of "{1}" (url: "{2}", status: {3})'.format(
+                    page.number, page.source.name, page.url, page.response.status_code))
+                errors.append(requests.HTTPError('Unexpected status {0}'.format(page.response.status_code),
+                                                 response=page.response))
+                continue
+
+            fetch_state = fetch_states[page.url]
+            if not fetch_state.is_modified(page.response):
+                logger.info('Page was not changed, parsing skipped (url: "{0}", status: {1}, not modified: {2}, '
+                            'unchanged: {3}, changed: {4})'.format(page.url, page.response.status_code,
+                                                                   fetch_state.not_modified_count,
+                                                                   fetch_state.unchanged_count,
+                                                                   fetch_state.changed_count))
+                continue
+
+            if lp is None:
+                lp = create_parser()
+            logger.info('Parsing page {0} of "{1}" (url: "{2}", encoding: {3})'.format(
+                page.number, page.source.name, page.url, page.response.encoding))
+            mc_ids = save_masterclasses(page.source, lp.parse_to_dict(page.response.text))
+            created.extend(mc_ids)
+            targets.update((str(mc_id), page.source.url) for mc_id in mc_ids)
+            fetch_state.remember(page.response)
+
+    if created:
+        # images are downloaded before notifications, new masterclasses are announced together
+        chain = celery.chain(
+            download_images_batch.si(created).set(queue='downloads'),
+            notify_many.si(created, targets=targets).set(queue='notifications'),
+        )
+        chain.delay()
 
+    if errors and len(errors) == pages:
+        logger.warning('Task "update" will be retry (attempt {0} of {1})'.format(
+            self.request.retries, LEO_UPDATE_MAX_RETRIES))
+        raise self.retry(exc=errors[0], countdown=(2 ** self.request.retries) * LEO_RETRY_DELAY)
     logger.info('<<<<< Update task finished')
 
 
-def download_image(url, http_headers, web_session):
-    request = requests.Request('GET', url, headers=http_headers)
-    prepared_request = request.prepare()
-    response = web_session.send(prepared_request, timeout=LEO_TASK_TIMEOUT)
-    if response.status_code == 200:
-        return response.content
-    logger.warning('Problem occurred while downloading image "{0}", response code is {1}'.format(
-        url, response.status_code))
-    return None
+def image_jobs(mc, target_dir):
+    return [('https:' + mc.img_url, os.path.join(target_dir, '{0}.jpeg'.format(mc.uid))),
+            ('https:' + mc.preview_img_url, os.path.join(target_dir, '{0}_preview.jpeg'.format(mc.uid)))]
 
 
-def save_binary(content, path):
-    with open(path, 'wb') as f:
-        f.write(content)
-        f.close()
+def fetch_images(mc_ids):
+    """
+    Download main and preview images of masterclasses concurrently
+    :param mc_ids: ids of masterclasses
+    :return: list of ids of masterclasses failed by request errors
+    """
+    user_agent = fake_useragent.UserAgent(fallback=LEO_DEFAULT_USER_AGENT,
+                                          path=LEO_FAKE_USER_AGENT_CACHE)
+    current_agent = user_agent.random
+    logger.info('Current user agent: {0}'.format(current_agent))
+
+    target_dir = os.path.join(settings.MEDIA_ROOT, settings.DOWNLOAD_IMG_DIR)
+    logger.debug('Target directory is "{0}"'.format(target_dir))
+    jobs, owners = [], []
+    for mc in Masterclass.objects.filter(pk__in=mc_ids):
+        for job in image_jobs(mc, target_dir):
+            jobs.append(job)
+            owners.append(mc.id)
+    validators = ImageState.validators_of(url for url, _ in jobs)
+    jobs = [(url, path, validators.get(url)) for url, path in jobs]
+
+    failed = set()
+    with ImageFetcher(headers={'User-Agent': current_agent}) as fetcher:
+        downloads = fetcher.download_many(jobs)
+    for mc_id, download in zip(owners, downloads):
+        if download.error is not None:
+            logger.error('Mc {0}: Error occurred while trying to download image "{1}": {2}'.format(
+                mc_id, download.url, download.error))
+            if isinstance(download.error, requests.RequestException):
+                failed.add(mc_id)
+        elif download.status == images.SAVED:
+            logger.info('Mc {0}: Image saved to {1}'.format(mc_id, download.path))
+        else:
+            logger.info('Mc {0}: Image was not written, it is {1} (url: "{2}")'.format(
+                mc_id, download.status.replace('_', ' '), download.url))
+    ImageState.record(downloads)
+
+    paths = [download.path for download in downloads if download.status in (images.SAVED, images.UNCHANGED,
+                                                                             images.NOT_MODIFIED)]
+    for path, generated in DerivativeGenerator().generate_many(paths).items():
+        if isinstance(generated, Exception):
+            logger.error('Error occurred while trying to generate variants of image "{0}": {1}'.format(path, generated))
+        elif generated:
+            logger.info('Variants of image generated: {0} (image: "{1}")'.format(generated, path))
+    return sorted(failed)
 
 
 @app.task(bind=True, max_retries=0, ignore_result=True)
 def update_images(self):
     _2_month_ago = datetime.today() - timedelta(days=30)
-    masterclasses = Masterclass.objects.all().filter(creation_ts__gte=_2_month_ago)
-    for mc in masterclasses:
-        download_images.apply_async(args=(mc.id,), queue='updates')
+    mc_ids = list(Masterclass.objects.filter(creation_ts__gte=_2_month_ago).values_list('id', flat=True))
+    deleted = images.collect_garbage(os.path.join(settings.MEDIA_ROOT, settings.DOWNLOAD_IMG_DIR))
+    logger.info('Unused stored images deleted: {0}'.format(deleted))
+    batch_size = getattr(core_settings, 'LEO_IMAGE_BATCH_SIZE', IMAGE_BATCH_SIZE)
+    for start in range(0, len(mc_ids), batch_size):
+        download_images_batch.apply_async(args=(mc_ids[start:start + batch_size],), queue='downloads')
 
 
 @app.task(bind=True, max_retries=LEO_DOWNLOAD_MAX_RETRIES, ignore_result=True, expires=LEO_TASK_EXPIRES)
-def download_images(self, mc_id):
-    logger.info('>>>>> Mc {0}: Downloading images'.format(mc_id))
-    user_agent = fake_useragent.UserAgent(fallback=LEO_DEFAULT_USER_AGENT,
-                                          path=LEO_FAKE_USER_AGENT_CACHE)
-    current_agent = user_agent.random
-    logger.info('Mc {0}: Current user agent: {1}'.format(mc_id, current_agent))
+def download_images_batch(self, mc_ids):
+    logger.info('>>>>> Downloading images of {0} masterclasses'.format(len(mc_ids)))
+    try:
+        failed = fetch_images(mc_ids)
+        if failed and self.request.retries >= self.max_retries:
+            # task finishes normally, so notifications chained to it are sent for all masterclasses
+            logger.error('Images of masterclasses were not downloaded, attempts are exhausted: {0}'.format(
+                ', '.join(map(str, failed))))
+        elif failed:
+            logger.warning('Task "download_images_batch" will be retry for {0} masterclasses (attempt {1} of {2})'
+                           .format(len(failed), self.request.retries, self.max_retries))
+            raise self.retry(args=(failed,), countdown=(2 ** self.request.retries) * LEO_RETRY_DELAY)
+    finally:
+        logger.info('<<<<< Downloading images of {0} masterclasses finished'.format(len(mc_ids)))
 
-    http_headers = {'User-Agent': current_agent}
-    web_session = requests.Session()
-
-    mc = Masterclass.objects.get(pk=mc_id)
-    target_dir = os.path.join(settings.MEDIA_ROOT, settings.DOWNLOAD_IMG_DIR)
-    logger.debug('Mc {0}: Target directory is "{1}"'.format(mc_id, target_dir))
 
+@app.task(bind=True, max_retries=LEO_DOWNLOAD_MAX_RETRIES, ignore_result=True, expires=LEO_TASK_EXPIRES)
+def download_images(self, mc_id):
+    logger.info('>>>>> Mc {0}: Downloading images'.format(mc_id))
     try:
-        url = 'https:' + mc.img_url
-        logger.info('Mc {0}: Downloading main image "{1}"'.format(mc_id, url))
-        img_content = download_image(url, http_headers, web_session)
-        if img_content is None:
-            return
-        img_path = os.path.join(target_dir, '{0}.jpeg'.format(mc.uid))
-        save_binary(img_content, img_path)
-        logger.info('Mc {0}: Image saved to {1}'.format(mc_id, img_path))
-
-        url = 'https:' + mc.preview_img_url
-        logger.info('Mc {0}: Downloading preview image "{1}"'.format(mc_id, url))
-        img_content = download_image(url, http_headers, web_session)
-        if img_content is None:
-            return
-        img_path = os.path.join(target_dir, '{0}_preview.jpeg'.format(mc.uid))
-        save_binary(img_content, img_path)
-        logger.info('Mc {0}: Image saved to {1}'.format(mc_id, img_path))
-    except requests.RequestException as err:
-        logger.exception('Mc {0}: Error occurred while trying to download image: {1}'.format(mc_id, err))
-        logger.warning('Mc {0}: Task "download_images" will be retry (attempt {1} of {2})'.format(
-            mc_id, self.request.retries, LEO_DOWNLOAD_MAX_RETRIES))
-        raise self.retry(exc=err, countdown=(2 ** self.request.retries) * LEO_RETRY_DELAY)
+        if fetch_images([mc_id]):
+            logger.warning('Mc {0}: Task "download_images" will be retry (attempt {1} of {2})'.format(
+                mc_id, self.request.retries, LEO_DOWNLOAD_MAX_RETRIES))
+            raise self.retry(countdown=(2 ** self.request.retries) * LEO_RETRY_DELAY)
     finally:
         logger.info('<<<<< Mc {0}:  Downloading images finished'.format(mc_id))
 
 
-@app.task(bind=True, max_retries=LEO_NOTIFICATION_MAX_RETRIES, ignore_result=True)
-def notify(self, mc_id):
-    lang = 'ru'
-    logger.info('>>>>> Mc {0}: Notify about masterclass'.format(mc_id))
-    translation.activate(lang)
-    leobot = LeoBot(LEO_TELEGRAM_BOT_TOKEN)
-    mc = Masterclass.objects.get(pk=mc_id)
-    template = loader.get_template('core/telegram_notification.html')
+def notification_preview(mc):
+    """
+    Return name of preview image of masterclass, a variant if it is generated already
+    """
+    name = '{0}_preview.jpeg'.format(mc.uid)
+    variant = variant_name(name, getattr(core_settings, 'LEO_NOTIFICATION_IMAGE_WIDTH', NOTIFICATION_IMAGE_WIDTH),
+                           'jpeg')
+    if os.path.exists(os.path.join(settings.MEDIA_ROOT, settings.DOWNLOAD_IMG_DIR, variant)):
+        return variant
+    return name
+
+
+def render_notification(mc, template, target=CONTENT_URL):
     context = {'title': mc.title,
                'when': date_format(mc.date.astimezone(pytz.timezone(mc.location.tz)), 'd-m-Y H:i, l'),
                'where': mc.location.name,
                'who': mc.master.name,
                'howmany': mc.avail_seats,
-               'preview': '//{0}/media/downloads/img/{1}_preview.jpeg'.format(settings.ALLOWED_HOSTS[0],  mc.uid),
+               'preview': '//{0}/media/downloads/img/{1}'.format(settings.ALLOWED_HOSTS[0], notification_preview(mc)),
                'online_price': mc.online_price,
                'price': mc.price,
                'description': mc.description,
-               'target': CONTENT_URL}
-    logger.debug('Mc {0}: Template context: {1}'.format(mc_id, context))
-    rendered = template.render(context=context)
+               'target': target}
+    logger.debug('Mc {0}: Template context: {1}'.format(mc.id, context))
+    return template.render(context=context)
+
+
+@app.task(bind=True, max_retries=LEO_NOTIFICATION_MAX_RETRIES, ignore_result=True)
+def notify_many(self, mc_ids, targets=None):
+    """
+    :param mc_ids: ids of masterclasses
+    :param targets: dict of id (as string) to url of source page of masterclass, CONTENT_URL by default
+    """
+    lang = 'ru'
+    logger.info('>>>>> Notify about {0} masterclasses'.format(len(mc_ids)))
+    translation.activate(lang)
+    leobot = get_bot(LEO_TELEGRAM_BOT_TOKEN)
+    template = loader.get_template('core/telegram_notification.html')
+    masterclasses = Masterclass.objects.select_related('location', 'master').in_bulk(mc_ids)
+    targets = targets or {}
+    messages = [(mc_id, render_notification(masterclasses[mc_id], template, targets.get(str(mc_id), CONTENT_URL)))
+                for mc_id in mc_ids if mc_id in masterclasses]
+
+    dispatcher = NotificationDispatcher(leobot, LEO_TELEGRAM_CHAT_ID)
     try:
-        logger.debug('Mc {0}: Try send message'.format(mc_id))
-        leobot.send_message(LEO_TELEGRAM_CHAT_ID, rendered)
-    except Exception as err:
-        logger.exception('Mc {0}: Error occurred while trying to send message: {1}'.format(mc_id, err))
-        logger.warning('Mc {0}: Task "notify" will be retry (attempt {1} of {2})'.format(
-            mc_id, self.request.retries, LEO_NOTIFICATION_MAX_RETRIES))
-        raise self.retry(exc=err, countdown=(2 ** self.request.retries) * LEO_RETRY_DELAY)
+        logger.debug('Try send {0} messages'.format(len(messages)))
+        retry_after = dispatcher.send(messages)
+        if retry_after:
+            remaining = [mc_id for mc_id, _ in messages if mc_id not in dispatcher.sent]
+            logger.warning('Messages about {0} masterclasses are postponed for {1} seconds'.format(
+                len(remaining), retry_after))
+            raise self.retry(args=(remaining,), countdown=retry_after)
+    except requests.RequestException as err:
+        remaining = [mc_id for mc_id, _ in messages if mc_id not in dispatcher.sent]
+        logger.exception('Error occurred while trying to send messages about {0} masterclasses: {1}'.format(
+            len(remaining), err))
+        logger.warning('Task "notify_many" will be retry (attempt {0} of {1})'.format(
+            self.request.retries, LEO_NOTIFICATION_MAX_RETRIES))
+        raise self.retry(args=(remaining,), exc=err, countdown=(2 ** self.request.retries) * LEO_RETRY_DELAY)
     finally:
-        logger.info('<<<<< Mc {0}:  Notifying finished'.format(mc_id))
+        logger.info('<<<<< Notifying about {0} masterclasses finished'.format(len(mc_ids)))
+
+
+@app.task(bind=True, max_retries=0, ignore_result=True)
+def notify(self, mc_id):
+    logger.info('Mc {0}: Notification is passed to "notify_many"'.format(mc_id))
+    notify_many.apply_async(args=([mc_id],), queue='notifications')
 
 
 @app.task(bind=True, max_retries=0, ignore_result=True, expires=LEO_TASK_EXPIRES)
 def watchdog(self):
     logger.info('>>>>> Watchdog starting')
-    leobot = LeoBot(LEO_TELEGRAM_BOT_TOKEN)
+    leobot = get_bot(LEO_TELEGRAM_BOT_TOKEN)
     try:
         today = date_format(datetime.now(tz=pytz.timezone(CURRENT_TZ)), 'd-m-Y H:i, l'),
         logger.info('Watchdog say: ' + str(today))
@@ -219,3 +331,15 @@ def watchdog(self):
         logger.exception('Error occurred while trying to watchdog: {0}'.format(err))
     finally:
         logger.info('<<<<< Watchdog finished')
+
+
+@app.task(bind=True, max_retries=0, ignore_result=True, expires=LEO_TASK_EXPIRES)
+def compact_history(self):
+    logger.info('>>>>> Compacting history of documents')
+    try:
+        report = compaction.compact_history()
+        compaction.expire_history(report=report)
+        logger.info('History compacted (documents: {0}, merged: {1}, deleted: {2}, bytes reclaimed: {3})'.format(
+            report.documents, report.merged, report.deleted, report.bytes_reclaimed))
+    finally:
+        logger.info('<<<<< Compacting history finished')
@@ -1,3 +1,572 @@
-from django.test import TestCase
+import io
+import os
+import sys
+import mock
+import time
+import datetime
+import tempfile
+import threading
+import requests
 
-# Create your tests here.
+from urllib.parse import urlsplit, parse_qs
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.core.management import call_command
+from django.utils import timezone
+from PIL import Image
+from celery.exceptions import Retry
+
+from core import images
+from core.models import FetchState, Source, ImageState, TokenBucket
+from core.notifications import NotificationDispatcher, build_digests
+from core.crawler import Crawler, Page
+from core.images import ImageFetcher
+from core.derivatives import DerivativeGenerator, variant_name, sources
+from core.serializers import MasterclassSerializer
+
+
+def make_response(status_code=200, content=b'content', headers=None):
+    response = mock.Mock(status_code=status_code, content=content)
+    response.headers = headers or {}
+    return response
+
+
+class TestFetchState(TestCase):
+
+    def setUp(self):
+        self.state = FetchState.objects.create(url='https://example.com/')
+
+    def test_conditional_headers(self):
+        self.assertEqual({}, self.state.conditional_headers())
+        self.state.remember(make_response(headers={'ETag': '"1"', 'Last-Modified': 'Sun, 18 Oct 2026 10:00:00 GMT'}))
+        state = FetchState.objects.get(url='https://example.com/')
+        self.assertEqual({'If-None-Match': '"1"', 'If-Modified-Since': 'Sun, 18 Oct 2026 10:00:00 GMT'},
+                         state.conditional_headers())
+
+    def test_is_modified(self):
+        self.assertTrue(self.state.is_modified(make_response()))
+        self.state.remember(make_response())
+        self.assertFalse(self.state.is_modified(make_response(status_code=304, content=b'')))
+        self.assertFalse(self.state.is_modified(make_response()))
+        self.assertTrue(self.state.is_modified(make_response(content=b'changed')))
+
+        state = FetchState.objects.get(url='https://example.com/')
+        self.assertEqual(4, state.fetched_count)
+        self.assertEqual(1, state.not_modified_count)
+        self.assertEqual(1, state.unchanged_count)
+        self.assertEqual(2, state.changed_count)
+        self.assertIsNotNone(state.checked)
+
+    def test_digest_is_kept_until_remembered(self):
+        self.state.remember(make_response())
+        self.assertTrue(self.state.is_modified(make_response(content=b'changed')))
+        self.assertTrue(self.state.is_modified(make_response(content=b'changed')))
+
+
+class TestSource(SimpleTestCase):
+
+    def test_page_url(self):
+        source = Source(name='spb', url='https://example.com/list/?city=spb&page=7')
+        self.assertEqual('https://example.com/list/?city=spb&page=7', source.page_url(1))
+        self.assertEqual('https://example.com/list/?city=spb&page=2', source.page_url(2))
+
+    def test_page_url_without_pagination(self):
+        source = Source(name='spb', url='https://example.com/list/', page_param='')
+        self.assertEqual('https://example.com/list/', source.page_url(3))
+
+
+class TestCrawler(SimpleTestCase):
+
+    def make_crawler(self, get, **kwargs):
+        session = mock.Mock()
+        session.get.side_effect = get
+        return Crawler(jitter=0, session=session, **kwargs)
+
+    def test_pagination(self):
+        last_pages = {'a.example.com': 2, 'b.example.com': 5}
+
+        def get(url, headers, timeout):
+            url = urlsplit(url)
+            page = int(parse_qs(url.query).get('page', ['1'])[0])
+            return make_response(status_code=200 if page <= last_pages[url.netloc] else 404)
+
+        sources = [Source(name='a', url='https://a.example.com/', max_pages=10),
+                   Source(name='b', url='https://b.example.com/', max_pages=3)]
+        pages = list(self.make_crawler(get).crawl(sources))
+        fetched = sorted((page.source.name, page.number, page.response.status_code) for page in pages)
+        self.assertEqual([('a', 1, 200), ('a', 2, 200), ('a', 3, 404), ('b', 1, 200), ('b', 2, 200), ('b', 3, 200)],
+                         fetched)
+
+    def test_errors_and_headers(self):
+        def get(url, headers, timeout):
+            if 'broken' in url:
+                raise requests.ConnectionError('broken')
+            return make_response(headers=headers)
+
+        sources = [Source(name='a', url='https://a.example.com/'), Source(name='b', url='https://broken.example.com/')]
+        crawler = self.make_crawler(get, headers={'User-Agent': 'agent'})
+        pages = {page.source.name: page for page in crawler.crawl(sources, prepare=lambda url: {'If-None-Match': url})}
+        self.assertIsInstance(pages['b'].error, requests.ConnectionError)
+        self.assertIsNone(pages['b'].response)
+        self.assertEqual({'User-Agent': 'agent', 'If-None-Match': 'https://a.example.com/'},
+                         pages['a'].response.headers)
+
+    def test_per_host_limit(self):
+        lock = threading.Lock()
+        running, peak = {}, {}
+
+        def get(url, headers, timeout):
+            host = url.split('/')[2]
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                peak[host] = max(peak.get(host, 0), running[host])
+            time.sleep(0.01)
+            with lock:
+                running[host] -= 1
+            return make_response(status_code=404)
+
+        sources = [Source(name=str(i), url='https://%s.example.com/%s' % (i % 2, i)) for i in range(12)]
+        pages = list(self.make_crawler(get, workers=8, per_host=2).crawl(sources))
+        self.assertEqual(12, len(pages))
+        self.assertEqual({'0.example.com': 2, '1.example.com': 2}, peak)
+
+
+class TestImageFetcher(SimpleTestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.requests = []
+
+    def make_fetcher(self, bodies, etags=None):
+        etags = etags or {}
+
+        def get(url, headers, timeout, stream):
+            self.requests.append((url, headers))
+            etag = etags.get(url, '')
+            if etag and headers.get('If-None-Match') == etag:
+                status_code = 304
+            else:
+                status_code = 200 if url in bodies else 404
+            response = mock.MagicMock(status_code=status_code, headers={'ETag': etag} if etag else {})
+            response.__enter__.return_value = response
+            body = bodies.get(url)
+            if isinstance(body, Exception):
+                response.iter_content.side_effect = body
+            else:
+                response.iter_content.return_value = iter([body[:3], body[3:]] if body else [])
+            return response
+
+        session = mock.Mock()
+        session.get.side_effect = get
+        return ImageFetcher(session=session, workers=4)
+
+    def read(self, name):
+        with open(os.path.join(self.dir, name), 'rb') as image:
+            return image.read()
+
+    def test_download_many(self):
+        fetcher = self.make_fetcher({'https://example.com/%s.jpeg' % i: b'image %s' % (str(i).encode(),)
+                                     for i in range(5)})
+        jobs = [('https://example.com/%s.jpeg' % i, os.path.join(self.dir, '%s.jpeg' % i)) for i in range(6)]
+        downloads = fetcher.download_many(jobs)
+        self.assertEqual([images.SAVED] * 5 + [images.MISSING], [download.status for download in downloads])
+        for i in range(5):
+            self.assertEqual(b'image %s' % (str(i).encode(),), self.read('%s.jpeg' % i))
+            self.assertEqual(len(b'image 0'), downloads[i].validators.size)
+        self.assertFalse(os.path.exists(jobs[5][1]))
+        self.assertEqual(sorted(['%s.jpeg' % i for i in range(5)] + [images.STORE_DIR]), sorted(os.listdir(self.dir)))
+
+    def test_failed_download_keeps_previous_image(self):
+        path = os.path.join(self.dir, 'image.jpeg')
+        with open(path, 'wb') as image:
+            image.write(b'previous')
+        fetcher = self.make_fetcher({'https://example.com/image.jpeg': requests.ConnectionError('broken')})
+        download, = fetcher.download_many([('https://example.com/image.jpeg', path)])
+        self.assertEqual(images.FAILED, download.status)
+        self.assertIsInstance(download.error, requests.ConnectionError)
+        self.assertEqual(b'previous', self.read('image.jpeg'))
+        self.assertEqual([], [name for name in os.listdir(self.dir) if name.endswith('.part')])
+
+    def test_identical_images_are_stored_once(self):
+        fetcher = self.make_fetcher({'https://example.com/a.jpeg': b'same', 'https://example.com/b.jpeg': b'same'})
+        downloads = fetcher.download_many([('https://example.com/a.jpeg', os.path.join(self.dir, 'a.jpeg')),
+                                           ('https://example.com/b.jpeg', os.path.join(self.dir, 'b.jpeg'))])
+        self.assertEqual(downloads[0].validators.sha256, downloads[1].validators.sha256)
+        self.assertTrue(os.path.samefile(os.path.join(self.dir, 'a.jpeg'), os.path.join(self.dir, 'b.jpeg')))
+
+    def test_revalidation(self):
+        url, path = 'https://example.com/a.jpeg', os.path.join(self.dir, 'a.jpeg')
+        fetcher = self.make_fetcher({url: b'image'}, etags={url: '"1"'})
+        status, validators = fetcher.download(url, path)
+        self.assertEqual(images.SAVED, status)
+        self.assertEqual('"1"', validators.etag)
+        inode = os.stat(path).st_ino
+
+        self.assertEqual((images.NOT_MODIFIED, validators), fetcher.download(url, path, validators))
+        self.assertEqual('"1"', self.requests[-1][1]['If-None-Match'])
+
+        fetcher = self.make_fetcher({url: b'image'})
+        self.assertEqual(images.UNCHANGED, fetcher.download(url, path, validators)[0])
+        self.assertEqual(inode, os.stat(path).st_ino)
+
+        fetcher = self.make_fetcher({url: b'changed'})
+        self.assertEqual(images.SAVED, fetcher.download(url, path, validators)[0])
+        self.assertEqual(b'changed', self.read('a.jpeg'))
+
+    def test_missing_target_is_not_revalidated(self):
+        url, path = 'https://example.com/a.jpeg', os.path.join(self.dir, 'a.jpeg')
+        fetcher = self.make_fetcher({url: b'image'}, etags={url: '"1"'})
+        validators = fetcher.download(url, path)[1]
+        os.unlink(path)
+        self.assertEqual(images.SAVED, fetcher.download(url, path, validators)[0])
+        self.assertNotIn('If-None-Match', self.requests[-1][1])
+
+    def test_collect_garbage(self):
+        url, path = 'https://example.com/a.jpeg', os.path.join(self.dir, 'a.jpeg')
+        self.make_fetcher({url: b'image'}).download(url, path)
+        self.assertEqual(0, images.collect_garbage(self.dir, age=-1))
+        self.make_fetcher({url: b'changed'}).download(url, path)
+        self.assertEqual(0, images.collect_garbage(self.dir))
+        self.assertEqual(1, images.collect_garbage(self.dir, age=-1))
+        self.assertEqual(b'changed', self.read('a.jpeg'))
+
+
+class TestImageState(TestCase):
+
+    def test_record(self):
+        validators = images.Validators('"1"', '', 5, 'a' * 64)
+        ImageState.record([images.Download('https://example.com/a.jpeg', 'a.jpeg', images.SAVED, validators, None),
+                           images.Download('https://example.com/b.jpeg', 'b.jpeg', images.MISSING, None, None)])
+        self.assertEqual({'https://example.com/a.jpeg': validators},
+                         ImageState.validators_of(['https://example.com/a.jpeg', 'https://example.com/b.jpeg']))
+        changed = ImageState.objects.get().changed
+
+        ImageState.record([images.Download('https://example.com/a.jpeg', 'a.jpeg', images.NOT_MODIFIED, validators,
+                                           None)])
+        state = ImageState.objects.get()
+        self.assertEqual(changed, state.changed)
+        self.assertGreater(state.checked, changed)
+
+
+class TestDerivativeGenerator(SimpleTestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.generator = DerivativeGenerator(widths=(100, 400), formats=('webp', 'jpeg'), workers=2)
+
+    def make_image(self, name, size=(200, 100), mode='RGB'):
+        path = os.path.join(self.dir, name)
+        Image.new(mode, size, 'red').save(path, format='PNG' if mode == 'RGBA' else 'JPEG')
+        return path
+
+    def test_variant_name(self):
+        self.assertEqual('uid_preview_640w.webp', variant_name('uid_preview.jpeg', 640, 'webp'))
+
+    def test_generate(self):
+        path = self.make_image('uid.jpeg')
+        self.assertEqual(4, self.generator.generate(path))
+        for width, fmt, variant in self.generator.variants(path):
+            with Image.open(variant) as image:
+                self.assertEqual(fmt.upper(), image.format)
+                self.assertEqual((100, 50) if width == 100 else (200, 100), image.size)
+
+    def test_sources(self):
+        path = self.make_image('uid.jpeg')
+        self.generator.generate(path)
+        open(os.path.join(self.dir, '.uid.part'), 'wb').close()
+        self.assertEqual([path], sources(self.dir))
+
+    def test_generate_variants_command(self):
+        path = self.make_image('uid.jpeg')
+        self.make_image('uid_preview.jpeg')
+        self.generator.generate(path)
+        stdout = io.StringIO()
+        with override_settings(MEDIA_ROOT=self.dir, DOWNLOAD_IMG_DIR=''), \
+                mock.patch('core.derivatives.core_settings', mock.Mock(LEO_DERIVATIVE_WIDTHS=(100, 400),
+                                                                       LEO_DERIVATIVE_FORMATS=('webp', 'jpeg'),
+                                                                       LEO_DERIVATIVE_QUALITY=80)):
+            call_command('generate_variants', workers=2, stdout=stdout)
+        self.assertEqual('images: 2, generated variants: 4, failed images: 0', stdout.getvalue().strip())
+        self.assertEqual(0, self.generator.generate(os.path.join(self.dir, 'uid_preview.jpeg')))
+
+    def test_generate_many_reports_errors_per_image(self):
+        paths = [self.make_image('uid.jpeg'), self.make_image('bomb.jpeg'), self.make_image('broken.jpeg')]
+        original = self.generator.generate
+
+        def generate(path):
+            if path == paths[1]:
+                raise Image.DecompressionBombError('too large')
+            if path == paths[2]:
+                raise ValueError('broken')
+            return original(path)
+
+        with mock.patch.object(self.generator, 'generate', side_effect=generate):
+            results = self.generator.generate_many(paths)
+        self.assertEqual(4, results[paths[0]])
+        self.assertIsInstance(results[paths[1]], Image.DecompressionBombError)
+        self.assertIsInstance(results[paths[2]], ValueError)
+
+    def test_generation_is_cached(self):
+        path = self.make_image('uid.jpeg')
+        self.generator.generate(path)
+        self.assertEqual(0, self.generator.generate(path))
+
+        os.unlink(os.path.join(self.dir, 'uid_100w.webp'))
+        self.assertEqual(1, self.generator.generate(path))
+
+        replaced = self.make_image('other.jpeg', size=(300, 300))
+        os.utime(replaced, ns=(0, os.stat(path).st_mtime_ns + 1))
+        os.replace(replaced, path)
+        self.assertEqual(4, self.generator.generate(path))
+        with Image.open(os.path.join(self.dir, 'uid_100w.jpeg')) as image:
+            self.assertEqual((100, 100), image.size)
+
+    def test_transparent_image_to_jpeg(self):
+        path = self.make_image('uid.png', mode='RGBA')
+        self.assertEqual(4, self.generator.generate(path))
+
+    def test_generate_many(self):
+        paths = [self.make_image('%s.jpeg' % i) for i in range(3)]
+        broken = os.path.join(self.dir, 'broken.jpeg')
+        with open(broken, 'wb') as image:
+            image.write(b'broken')
+        result = self.generator.generate_many(paths + [broken])
+        self.assertEqual([4, 4, 4], [result[path] for path in paths])
+        self.assertIsInstance(result[broken], OSError)
+        self.assertEqual([], [name for name in os.listdir(self.dir) if name.endswith('.part')])
+
+
+class TestMasterclassSerializer(SimpleTestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = os.path.join(tmp.name, 'downloads', 'img')
+        os.makedirs(self.dir)
+        patcher = override_settings(MEDIA_URL='/media/', MEDIA_ROOT=tmp.name, DOWNLOAD_IMG_DIR='downloads/img')
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def test_images(self):
+        for name in ('uid_preview_320w.webp', 'uid_preview_640w.webp'):
+            open(os.path.join(self.dir, name), 'wb').close()
+        serializer = MasterclassSerializer()
+        serializer._derivatives = DerivativeGenerator(widths=(640, 320), formats=('webp',))
+        images = serializer.get_images(mock.Mock(uid='uid'))
+        self.assertEqual('/media/downloads/img/uid.jpeg', images['main']['original'])
+        self.assertEqual([{'width': 320, 'format': 'webp', 'url': '/media/downloads/img/uid_preview_320w.webp'},
+                          {'width': 640, 'format': 'webp', 'url': '/media/downloads/img/uid_preview_640w.webp'}],
+                         images['preview']['variants'])
+
+    def test_missing_variants_are_not_listed(self):
+        open(os.path.join(self.dir, 'uid_preview_320w.jpeg'), 'wb').close()
+        serializer = MasterclassSerializer()
+        serializer._derivatives = DerivativeGenerator(widths=(640, 320), formats=('webp', 'jpeg'))
+        images = serializer.get_images(mock.Mock(uid='uid'))
+        self.assertEqual([], images['main']['variants'])
+        self.assertEqual([{'width': 320, 'format': 'jpeg', 'url': '/media/downloads/img/uid_preview_320w.jpeg'}],
+                         images['preview']['variants'])
+
+
+class TestTokenBucket(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        patcher = mock.patch('core.models.timezone.now', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_acquire(self):
+        self.assertEqual(0, TokenBucket.acquire('bucket', rate=0.5, capacity=2))
+        self.assertEqual(0, TokenBucket.acquire('bucket', rate=0.5, capacity=2))
+        self.assertEqual(2, TokenBucket.acquire('bucket', rate=0.5, capacity=2))
+        self.now += datetime.timedelta(seconds=1)
+        self.assertEqual(1, TokenBucket.acquire('bucket', rate=0.5, capacity=2))
+        self.now += datetime.timedelta(seconds=1)
+        self.assertEqual(0, TokenBucket.acquire('bucket', rate=0.5, capacity=2))
+
+    def test_capacity(self):
+        TokenBucket.acquire('bucket', rate=1, capacity=2)
+        self.now += datetime.timedelta(hours=1)
+        self.assertEqual(0, TokenBucket.acquire('bucket', rate=1, capacity=2))
+        self.assertEqual(0, TokenBucket.acquire('bucket', rate=1, capacity=2))
+        self.assertEqual(1, TokenBucket.acquire('bucket', rate=1, capacity=2))
+
+    def test_block(self):
+        TokenBucket.block('bucket', 30)
+        self.assertEqual(30, TokenBucket.acquire('bucket', rate=1, capacity=2))
+        self.now += datetime.timedelta(seconds=31)
+        self.assertEqual(0, TokenBucket.acquire('bucket', rate=1, capacity=2))
+
+
+class TestNotificationDispatcher(TestCase):
+
+    def make_bot(self, *statuses):
+        bot = mock.Mock()
+        responses = []
+        for status in statuses:
+            response = make_response(status_code=status)
+            response.json.return_value = {'ok': False, 'parameters': {'retry_after': 17}}
+            if status >= 400 and status != 429:
+                response.raise_for_status.side_effect = requests.HTTPError(status)
+            responses.append(response)
+        bot.send_message.side_effect = responses
+        return bot
+
+    def test_build_digests(self):
+        messages = [(1, 'a' * 4), (2, 'b' * 4), (3, 'c' * 20), (4, 'd' * 2)]
+        self.assertEqual([([1, 2], 'aaaa\n\nbbbb'), ([3], 'c' * 20), ([4], 'dd')], build_digests(messages, size=12))
+        self.assertEqual([], build_digests([]))
+
+    def test_send_digests(self):
+        bot = self.make_bot(200, 200)
+        dispatcher = NotificationDispatcher(bot, 'chat', rate=1, burst=5, digest_size=10)
+        self.assertIsNone(dispatcher.send([(1, 'aaaa'), (2, 'bbbb'), (3, 'cccc')]))
+        self.assertEqual([1, 2, 3], dispatcher.sent)
+        self.assertEqual([mock.call('chat', 'aaaa\n\nbbbb'), mock.call('chat', 'cccc')],
+                         bot.send_message.call_args_list)
+
+    def test_retry_after(self):
+        dispatcher = NotificationDispatcher(self.make_bot(200, 429), 'chat', rate=1, burst=5, digest_size=1)
+        self.assertEqual(17, dispatcher.send([(1, 'a'), (2, 'b'), (3, 'c')]))
+        self.assertEqual([1], dispatcher.sent)
+        self.assertGreater(TokenBucket.acquire('telegram:chat', rate=1, capacity=5), 16)
+
+    def test_rate_limit_is_shared(self):
+        TokenBucket.acquire('telegram:chat', rate=0.01, capacity=1)
+        dispatcher = NotificationDispatcher(self.make_bot(), 'chat', rate=0.01, burst=1, max_wait=1)
+        self.assertGreater(dispatcher.send([(1, 'a')]), 1)
+        self.assertEqual([], dispatcher.sent)
+
+    def test_error(self):
+        dispatcher = NotificationDispatcher(self.make_bot(200, 500), 'chat', rate=1, burst=5, digest_size=1)
+        with self.assertRaises(requests.HTTPError):
+            dispatcher.send([(1, 'a'), (2, 'b')])
+        self.assertEqual([1], dispatcher.sent)
+
+
+def import_tasks():
+    # parser of the site is an external package, it is not needed while pages are parsed by a mock
+    with mock.patch.dict(sys.modules, {'_leoparser': mock.Mock(), '_leoparser.leoparser': mock.Mock()}):
+        from core import tasks
+    return tasks
+
+
+class FakeCrawler:
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def __call__(self, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def crawl(self, sources, prepare=None):
+        for page in self.pages:
+            if prepare is not None:
+                prepare(page.url)
+            yield page
+
+
+class TestTasks(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tasks = import_tasks()
+        cls.download_images_batch = cls.tasks.download_images_batch
+
+    def setUp(self):
+        self.source = Source.objects.create(name='spb', url='https://example.com/spb/', city='spb', max_pages=3)
+        self.parser = mock.Mock()
+        self.parser.parse_to_dict.return_value = {'uid': {'uid': 'uid', 'title': 'title'}}
+        for name, value in (('create_parser', mock.Mock(return_value=self.parser)),
+                            ('fake_useragent', mock.Mock()),
+                            ('celery', mock.Mock()),
+                            ('download_images_batch', mock.Mock()),
+                            ('notify_many', mock.Mock())):
+            patcher = mock.patch.object(self.tasks, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def page(self, number, response=None, error=None):
+        return Page(self.source, number, self.source.page_url(number), response, error)
+
+    def test_save_masterclasses(self):
+        with mock.patch.object(self.tasks, 'Master') as master, \
+                mock.patch.object(self.tasks, 'Location') as location, \
+                mock.patch.object(self.tasks, 'Masterclass') as masterclass:
+            master.objects.get_or_create.return_value = mock.Mock(), True
+            location.objects.get_or_create.return_value = mock.Mock(), True
+            masterclass.objects.filter.return_value.exists.side_effect = [False, True]
+            masterclass.objects.create.return_value = mock.Mock(id=7)
+            created = self.tasks.save_masterclasses(self.source, {
+                'new': {'uid': 'new', 'master': 'master', 'location': 'location'},
+                'old': {'uid': 'old', 'master': 'master', 'location': 'location', 'duration': 0, 'title': ''},
+            })
+        self.assertEqual([7], created)
+        location.objects.get_or_create.assert_called_with(name='location', defaults={'city': 'spb',
+                                                                                      'tz': 'Europe/Moscow'})
+        masterclass.objects.filter.return_value.update.assert_called_once_with(master=mock.ANY,
+                                                                               location=mock.ANY)
+
+    def test_update(self):
+        pages = [self.page(1, make_response(200, b'page')), self.page(2, make_response(500)),
+                 self.page(3, error=requests.ConnectionError('refused'))]
+        with mock.patch.object(self.tasks, 'Crawler', FakeCrawler(pages)), \
+                mock.patch.object(self.tasks, 'save_masterclasses', return_value=[5]) as save:
+            self.tasks.update()
+        save.assert_called_once_with(self.source, self.parser.parse_to_dict.return_value)
+        self.tasks.notify_many.si.assert_called_once_with([5], targets={'5': self.source.url})
+        self.tasks.celery.chain.return_value.delay.assert_called_once_with()
+        self.assertEqual(FetchState.digest_of(b'page'), FetchState.objects.get(url=self.source.url).digest)
+        self.assertEqual(0, FetchState.objects.get(url=self.source.page_url(2)).changed_count)
+
+    def test_update_skips_unchanged_pages(self):
+        FetchState.objects.create(url=self.source.url, digest=FetchState.digest_of(b'page'))
+        with mock.patch.object(self.tasks, 'Crawler', FakeCrawler([self.page(1, make_response(200, b'page'))])), \
+                mock.patch.object(self.tasks, 'save_masterclasses') as save:
+            self.tasks.update()
+        save.assert_not_called()
+        self.tasks.celery.chain.assert_not_called()
+
+    def test_update_is_retried_if_all_pages_fail(self):
+        pages = [self.page(1, make_response(503)), self.page(2, error=requests.ConnectionError('refused'))]
+        with mock.patch.object(self.tasks, 'Crawler', FakeCrawler(pages)), \
+                mock.patch.object(self.tasks, 'save_masterclasses') as save:
+            # task called directly raises the error it would be retried by
+            with self.assertRaises(requests.HTTPError):
+                self.tasks.update()
+        save.assert_not_called()
+
+    def test_download_images_batch_is_retried_for_failed_masterclasses(self):
+        with mock.patch.object(self.tasks, 'fetch_images', return_value=[2]), \
+                mock.patch.object(self.download_images_batch, 'max_retries', 1):
+            with self.assertRaises(Retry):
+                self.download_images_batch([1, 2])
+
+    def test_download_images_batch_finishes_when_retries_are_exhausted(self):
+        with mock.patch.object(self.tasks, 'fetch_images', return_value=[2]) as fetch_images, \
+                mock.patch.object(self.download_images_batch, 'max_retries', 0):
+            # chained notifications are not cancelled
+            self.download_images_batch([1, 2])
+        fetch_images.assert_called_once_with([1, 2])
+
+    def test_notification_preview(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        os.makedirs(os.path.join(tmp.name, 'img'))
+        mc = mock.Mock(uid='uid')
+        with override_settings(MEDIA_ROOT=tmp.name, DOWNLOAD_IMG_DIR='img'), \
+                mock.patch.object(self.tasks, 'core_settings', mock.Mock(LEO_NOTIFICATION_IMAGE_WIDTH=640)):
+            self.assertEqual('uid_preview.jpeg', self.tasks.notification_preview(mc))
+            open(os.path.join(tmp.name, 'img', 'uid_preview_640w.jpeg'), 'wb').close()
+            self.assertEqual('uid_preview_640w.jpeg', self.tasks.notification_preview(mc))
@@ -19,7 +19,10 @@ task_queues = (Queue(name='celery', exchange=Exchange('celery'), routing_key='ce
 task_routes = {'core.tasks.update': {'queue': 'updates'},
                'core.tasks.update_images': {'queue': 'updates'},
                'core.tasks.download_images': {'queue': 'downloads'},
-               'core.tasks.notify': {'queue': 'notifications'}, }
+               'core.tasks.download_images_batch': {'queue': 'downloads'},
+               'core.tasks.notify': {'queue': 'notifications'},
+               'core.tasks.notify_many': {'queue': 'notifications'},
+               'core.tasks.compact_history': {'queue': 'updates'}, }
 
 beat_schedule = {
     'update-every-30-seconds': {
@@ -47,6 +50,15 @@ beat_schedule = {
         'options': {
             'queue': 'updates'
         }
+    },
+    'compact-history-everyday-at-night': {
+        'task': 'core.tasks.compact_history',
+        'schedule': crontab(minute=30, hour=3),
+        'args': tuple(),
+        'options': {
+            'expires': LEO_TASK_EXPIRES,
+            'queue': 'updates'
+        }
     }
 }
 
@@ -110,3 +110,15 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10
 }
+
+# History of documents, see leoparser.models.DocSnapshot and leoparser.compaction
+LEOPARSER_SNAPSHOT_EVERY = 100
+LEOPARSER_SNAPSHOT_INTERVAL = 24 * 60 * 60
+LEOPARSER_COMPACT_HOURLY_AFTER = 24 * 60 * 60
+LEOPARSER_COMPACT_DAILY_AFTER = 30 * 24 * 60 * 60
+LEOPARSER_HISTORY_RETENTION = None
+LEOPARSER_PACK_DELTAS = False
+
+# Cache of related instances mapped from documents, see leoparser.relations
+LEOPARSER_RELATED_CACHE_SIZE = 1024
+LEOPARSER_RELATED_CACHE_TTL = 300
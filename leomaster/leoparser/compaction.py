@@ -0,0 +1,187 @@
+import logging
+
+from bisect import bisect_left
+from datetime import timedelta
+from itertools import groupby
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Func, IntegerField, Q, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Trunc
+from django.utils import timezone
+from dictdiffer import revert
+
+from leoparser.diff import diff
+from leoparser.models import DocDelta, DocSnapshot, GenericDocument, contents_as_of, _bulk_update
+
+LOG = logging.getLogger(__name__)
+
+HOURLY_AFTER = timedelta(days=1)
+DAILY_AFTER = timedelta(days=30)
+BATCH_SIZE = 100
+
+
+class ColumnSize(Func):
+    function = 'pg_column_size'
+    output_field = IntegerField()
+
+
+class CompactionReport:
+    """
+    Result of compaction and expiration of history
+    """
+    __slots__ = ('documents', 'merged', 'deleted', 'bytes_reclaimed')
+
+    def __init__(self):
+        self.documents = 0
+        self.merged = 0
+        self.deleted = 0
+        self.bytes_reclaimed = 0
+
+    def __repr__(self):
+        return '<%s: documents="%s" merged="%s" deleted="%s" bytes_reclaimed="%s">' % (
+            self.__class__.__name__, self.documents, self.merged, self.deleted, self.bytes_reclaimed,)
+
+
+def _setting(name, default):
+    value = getattr(settings, name, default)
+    if value is not None and not isinstance(value, timedelta):
+        value = timedelta(seconds=value)
+    return value
+
+
+def _size(queryset):
+    sizes = queryset.aggregate(delta=Sum(ColumnSize('delta')), packed=Sum(ColumnSize('packed')))
+    return (sizes['delta'] or 0) + (sizes['packed'] or 0)
+
+
+def _bucket_of(daily_before):
+    def bucket(created):
+        if created <= daily_before:
+            return 'day', created.date()
+        return 'hour', created.replace(minute=0, second=0, microsecond=0)
+    return bucket
+
+
+def _candidates(hourly_before, daily_before):
+    """
+    Select ids of documents having at least one bucket of more than one delta
+    """
+    utc = timezone.utc
+    hourly = DocDelta.objects.filter(created__lte=hourly_before, created__gt=daily_before)\
+        .annotate(bucket=Trunc('created', 'hour', tzinfo=utc))
+    daily = DocDelta.objects.filter(created__lte=daily_before).annotate(bucket=Trunc('created', 'day', tzinfo=utc))
+    ids = set()
+    for deltas in (hourly, daily):
+        ids.update(deltas.order_by().values('base', 'bucket').annotate(amount=Count('id')).filter(amount__gt=1)
+                   .values_list('base', flat=True).distinct())
+    return sorted(ids)
+
+
+def merge_deltas(content, deltas, snapshots, bucket):
+    """
+    Merge deltas of a document which fall into the same bucket.
+    Versions at the bucket boundaries are restored backward from content, merged delta is the full diff between them,
+    so patching or reverting it gives exactly the same versions. Deltas are never merged across a snapshot.
+    :param content: version of the document after the newest delta
+    :param deltas: list of (id, created, delta) ordered from newest to oldest
+    :param snapshots: sorted list of creation times of snapshots of the document
+    :param bucket: function of creation time to bucket key
+    :return: dict of kept delta id to merged delta, list of ids to delete
+    """
+    merged, deleted = {}, []
+    for _, rows in groupby(deltas, key=lambda row: (bucket(row[1]), bisect_left(snapshots, row[1]))):
+        rows = list(rows)
+        end = content
+        for _, _, delta in rows:
+            content = revert(delta, content)
+        if len(rows) < 2:
+            continue
+        delta = diff(content, end)
+        if delta:
+            merged[rows[0][0]] = delta
+            deleted.extend(row[0] for row in rows[1:])
+        else:
+            deleted.extend(row[0] for row in rows)
+    return merged, deleted
+
+
+def compact_history(hourly_after=None, daily_after=None, batch_size=BATCH_SIZE, report=None):
+    """
+    Merge old deltas into coarser ones: deltas older than hourly_after are merged per hour,
+    deltas older than daily_after are merged per day (UTC).
+    Buckets are aligned to hours and days, so history of a period (see GenericDocument.get_history_period)
+    is still correct at the kept granularity. Snapshots are kept and never merged across
+    :param hourly_after: timedelta, LEOPARSER_COMPACT_HOURLY_AFTER by default
+    :param daily_after: timedelta, LEOPARSER_COMPACT_DAILY_AFTER by default
+    :param batch_size: amount of documents compacted in a single transaction
+    :param report: CompactionReport to update
+    :return: CompactionReport
+    """
+    report = report or CompactionReport()
+    now = timezone.now()
+    hourly_before = now - (hourly_after or _setting('LEOPARSER_COMPACT_HOURLY_AFTER', HOURLY_AFTER))
+    daily_before = now - (daily_after or _setting('LEOPARSER_COMPACT_DAILY_AFTER', DAILY_AFTER))
+    daily_before = min(daily_before, hourly_before)
+    bucket = _bucket_of(daily_before)
+
+    ids = _candidates(hourly_before, daily_before)
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        with transaction.atomic():
+            docs = list(GenericDocument.objects.filter(id__in=batch).select_for_update())
+            contents = contents_as_of(docs, hourly_before)
+            snapshots = {}
+            for base_id, created in DocSnapshot.objects.filter(base__in=batch, created__lte=hourly_before)\
+                    .order_by('base', 'created').values_list('base_id', 'created'):
+                snapshots.setdefault(base_id, []).append(created)
+
+            deltas = DocDelta.objects.filter(base__in=batch, created__lte=hourly_before).order_by('base', '-created')
+            merged, deleted = {}, []
+            for base_id, rows in groupby(deltas.values_list('id', 'base_id', 'created', 'delta', 'packed').iterator(),
+                                         key=lambda row: row[1]):
+                rows = [(delta_id, created, packed if packed is not None else delta)
+                        for delta_id, _, created, delta, packed in rows]
+                doc_merged, doc_deleted = merge_deltas(contents[base_id], rows, snapshots.get(base_id, []), bucket)
+                merged.update(doc_merged)
+                deleted.extend(doc_deleted)
+
+            if not merged and not deleted:
+                continue
+            size = _size(DocDelta.objects.filter(id__in=list(merged) + deleted))
+            DocDelta.objects.filter(id__in=deleted).delete()
+            rows = [DocDelta(id=delta_id, **DocDelta.payload(delta)) for delta_id, delta in merged.items()]
+            _bulk_update(DocDelta, rows, [DocDelta._meta.get_field('delta'), DocDelta._meta.get_field('packed')],
+                         DocDelta.objects.db)
+            report.bytes_reclaimed += size - _size(DocDelta.objects.filter(id__in=list(merged)))
+            report.documents += len(docs)
+            report.merged += len(merged)
+            report.deleted += len(deleted)
+    LOG.info('History compacted: %r', report)
+    return report
+
+
+def expire_history(retention=None, report=None):
+    """
+    Delete history older than retention.
+    For every document the latest snapshot before the retention boundary is kept with all deltas after it,
+    so any version within retention can still be restored, older deltas and snapshots are deleted
+    :param retention: timedelta, LEOPARSER_HISTORY_RETENTION by default, nothing is deleted if it is None
+    :param report: CompactionReport to update
+    :return: CompactionReport
+    """
+    report = report or CompactionReport()
+    retention = retention or _setting('LEOPARSER_HISTORY_RETENTION', None)
+    if retention is None:
+        return report
+    before = timezone.now() - retention
+    kept = DocSnapshot.objects.filter(base=OuterRef('base'), created__lte=before).order_by('-created')
+    kept = Subquery(kept.values('created')[:1])
+    with transaction.atomic():
+        deltas = DocDelta.objects.filter(created__lte=before).annotate(kept=kept)\
+            .filter(Q(kept__isnull=True) | Q(created__lte=F('kept')))
+        report.bytes_reclaimed += _size(deltas)
+        report.deleted += deltas.delete()[0]
+        DocSnapshot.objects.annotate(kept=kept).filter(created__lt=F('kept')).delete()
+    LOG.info('History expired: %r', report)
+    return report
@@ -0,0 +1,282 @@
+import re
+import pytz
+import datetime
+
+from functools import lru_cache
+from collections import namedtuple
+from django.conf import settings
+
+DEFAULT_TIMEZONE = 'Europe/Moscow'
+
+MONTHS = {
+    'январь': 1, 'января': 1, 'янв': 1,
+    'февраль': 2, 'февраля': 2, 'фев': 2, 'февр': 2,
+    'март': 3, 'марта': 3, 'мар': 3,
+    'апрель': 4, 'апреля': 4, 'апр': 4,
+    'май': 5, 'мая': 5,
+    'июнь': 6, 'июня': 6, 'июн': 6,
+    'июль': 7, 'июля': 7, 'июл': 7,
+    'август': 8, 'августа': 8, 'авг': 8,
+    'сентябрь': 9, 'сентября': 9, 'сен': 9, 'сент': 9,
+    'октябрь': 10, 'октября': 10, 'окт': 10,
+    'ноябрь': 11, 'ноября': 11, 'ноя': 11, 'нояб': 11,
+    'декабрь': 12, 'декабря': 12, 'дек': 12,
+}
+
+FREE = ('бесплатно', 'free')
+
+_SPACES = re.compile(r'\s+')
+_TIME = re.compile(r'(?<!\d)(\d{1,2}):(\d{2})(?::(\d{2}))?(?!\d)')
+
+Format = namedtuple('Format', ('name', 'regex', 'build'))
+
+
+def _identity(value):
+    return value
+
+
+def normalize(value):
+    """
+    Lower case value and replace any kind of spaces (e.g. non-breaking) by a single space
+    """
+    return _SPACES.sub(' ', value).strip().lower()
+
+
+@lru_cache(maxsize=1)
+def default_timezone():
+    return pytz.timezone(settings.TIME_ZONE if settings.configured and settings.TIME_ZONE else DEFAULT_TIMEZONE)
+
+
+def apply_once_or_many(f, many=None):
+    """
+    Apply f to a single value or to every item of a list.
+    List of a single item is treated as the item itself.
+    :param f: converter of a single value
+    :param many: converter of a whole list, by default f is applied to every item
+    """
+    def wrapper(value):
+        if isinstance(value, (list, tuple)):
+            if len(value) > 1:
+                return many(value) if many is not None else [f(v) for v in value]
+            elif len(value) == 1:
+                value = value[0]
+        return f(value)
+    return wrapper
+
+
+def _year(value):
+    year = int(value)
+    return year + 2000 if year < 100 else year
+
+
+def _numeric_date(match):
+    return datetime.date(_year(match.group(3)), int(match.group(2)), int(match.group(1)))
+
+
+def _iso_date(match):
+    return datetime.date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+
+
+def _verbal_date(match):
+    month = MONTHS.get(match.group(2).rstrip('.'))
+    if month is None:
+        raise ValueError('Unknown month "%s"' % (match.group(2),))
+    year = _year(match.group(3)) if match.group(3) else datetime.date.today().year
+    return datetime.date(year, month, int(match.group(1)))
+
+
+DATE_FORMATS = (
+    Format('dd.mm.yyyy', re.compile(r'(?<!\d)(\d{1,2})\.(\d{1,2})\.(\d{4}|\d{2})(?!\d)'), _numeric_date),
+    Format('yyyy-mm-dd', re.compile(r'(?<!\d)(\d{4})-(\d{2})-(\d{2})(?!\d)'), _iso_date),
+    Format('dd month yyyy', re.compile(r'(?<!\d)(\d{1,2}) ([а-яё]+\.?)(?: (\d{4}))?'), _verbal_date),
+)
+
+
+def _clock(match):
+    return datetime.time(int(match.group(1)), int(match.group(2)), int(match.group(3) or 0))
+
+
+def _duration(match):
+    hours = match.group('hours')
+    minutes = match.group('minutes') or match.group('only_minutes')
+    return datetime.timedelta(hours=float(hours.replace(',', '.')) if hours else 0,
+                              minutes=int(minutes) if minutes else 0)
+
+
+_HOURS = r'(?P<hours>\d+(?:[.,]\d+)?) ?ч(?:ас(?:а|ов)?)?\.?(?![а-я])'
+_MINUTES = r' ?(?P<%s>\d+) ?мин(?:ут[аы]?)?\.?(?![а-я])'
+
+TIME_FORMATS = (
+    Format('duration', re.compile(r'%s(?:%s)?|%s' % (_HOURS, _MINUTES % ('minutes',), _MINUTES % ('only_minutes',))),
+           _duration),
+    Format('hh:mm', _TIME, _clock),
+)
+
+
+def _free(match):
+    return 0
+
+
+def _amount(match):
+    integer, fraction = match.group(1).replace(' ', ''), match.group(2)
+    if fraction and int(fraction):
+        return float(integer + '.' + fraction)
+    return int(integer)
+
+
+CURRENCY_FORMATS = (
+    Format('free', re.compile(r'^(?:%s)$' % ('|'.join(FREE),)), _free),
+    Format('amount', re.compile(r'(?<![\d,.])(\d{1,3}(?: \d{3})+|\d+)(?:[.,](\d{1,2}))?(?!\d)'), _amount),
+)
+
+
+class FormatConverter:
+    """
+    Converter of text into typed value.
+    Format of the first value is detected by trying every known format and is kept,
+    so next values are converted by a single regex.
+    Another detection is done only if kept format does not fit the value.
+    Value is returned as is if no format fits it.
+    One instance is created per rule, so every rule has its own detected format.
+    """
+    formats = ()
+
+    def __init__(self):
+        self.format = None
+        self.convert = apply_once_or_many(self.convert_one, self.convert_many)
+
+    def __call__(self, value):
+        return self.convert(value)
+
+    def _search(self, fmt, text):
+        match = fmt.regex.search(text)
+        return match if match and match.group(0) else None
+
+    def detect(self, text):
+        for fmt in self.formats:
+            match = self._search(fmt, text)
+            if match is not None:
+                try:
+                    return fmt, self.build(fmt, match, text)
+                except ValueError:
+                    continue
+        return None, None
+
+    def build(self, fmt, match, text):
+        return fmt.build(match)
+
+    def convert_one(self, value):
+        if not isinstance(value, str):
+            return value
+        text = normalize(value)
+        fmt = self.format
+        if fmt is not None:
+            match = self._search(fmt, text)
+            if match is not None:
+                try:
+                    return self.build(fmt, match, text)
+                except ValueError:
+                    pass
+        fmt, converted = self.detect(text)
+        if fmt is None:
+            return value
+        self.format = fmt
+        return converted
+
+    def convert_many(self, values):
+        if self.format is None:
+            for value in values:
+                if isinstance(value, str):
+                    self.convert_one(value)
+                    break
+        fmt = self.format
+        if fmt is None:
+            return list(values)
+        search, build, convert_one = fmt.regex.search, self.build, self.convert_one
+        converted = []
+        for value in values:
+            match = None
+            if isinstance(value, str):
+                text = normalize(value)
+                match = search(text)
+            if match is not None and match.group(0):
+                try:
+                    converted.append(build(fmt, match, text))
+                    continue
+                except ValueError:
+                    pass
+            converted.append(convert_one(value))
+        return converted
+
+
+class DateConverter(FormatConverter):
+    """
+    15.05.2026, 15.05.26, 2026-05-15, 15 мая 2026, 15 мая (current year)
+    """
+    formats = DATE_FORMATS
+
+
+class DatetimeConverter(FormatConverter):
+    """
+    Date in any format of DateConverter followed by time hh:mm, e.g. "15 мая 2026, пятница, 18:30"
+    Time is midnight if it is missing. Result is aware of default timezone
+    """
+    formats = DATE_FORMATS
+
+    def build(self, fmt, match, text):
+        date = fmt.build(match)
+        clock = _TIME.search(text, match.end())
+        time = _clock(clock) if clock else datetime.time()
+        return default_timezone().localize(datetime.datetime.combine(date, time))
+
+
+class CurrencyConverter(FormatConverter):
+    """
+    1 500 ₽, 1500 руб., 1 500,50 р., бесплатно
+    Whole amounts are integers, other amounts are floats
+    """
+    formats = CURRENCY_FORMATS
+
+
+class TimeConverter(FormatConverter):
+    """
+    Duration (2 часа, 1 ч. 30 мин., 90 минут, 1,5 часа) is timedelta,
+    time of a day (18:30) is time
+    """
+    formats = TIME_FORMATS
+
+
+def _to_string(value):
+    return str(value).strip()
+
+
+to_container = apply_once_or_many(_identity)
+to_float = apply_once_or_many(float, lambda values: list(map(float, values)))
+to_integer = apply_once_or_many(int, lambda values: list(map(int, values)))
+to_string = apply_once_or_many(_to_string, lambda values: list(map(_to_string, values)))
+to_currency = CurrencyConverter()
+to_date = DateConverter()
+to_datetime = DatetimeConverter()
+to_time = TimeConverter()
+
+CONVERTERS = {
+    'container': lambda: to_container,
+    'currency': CurrencyConverter,
+    'date': DateConverter,
+    'datetime': DatetimeConverter,
+    'float': lambda: to_float,
+    'integer': lambda: to_integer,
+    'string': lambda: to_string,
+    'time': TimeConverter,
+}
+
+
+def get_converter(typeof):
+    """
+    Return converter for a rule of type.
+    Converters which detect format are created per call, so every rule caches its own format
+    :param typeof: name of TypeOf
+    :return: callable
+    """
+    factory = CONVERTERS.get(typeof)
+    return factory() if factory is not None else _identity
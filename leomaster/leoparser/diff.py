@@ -0,0 +1,64 @@
+from copy import deepcopy
+
+import dictdiffer
+from dictdiffer import DICT_TYPES, LIST_TYPES, SET_TYPES
+from dictdiffer.utils import EPSILON, are_different
+
+ADD = 'add'
+REMOVE = 'remove'
+CHANGE = 'change'
+
+
+def _dotted(node):
+    if all(isinstance(key, str) and '.' not in key for key in node):
+        return '.'.join(node)
+    return list(node)
+
+
+def diff(first, second, tolerance=EPSILON):
+    """
+    Compare two documents, result is the same as list(dictdiffer.diff(first, second)).
+    Subtrees which are the same object or are equal are skipped before descending,
+    equality of containers is checked by Python itself, so time depends on size of the change
+    rather than on size of documents. Values of actions are deep copies as in dictdiffer
+    :param first: original dict or list
+    :param second: new dict or list
+    :param tolerance: threshold to consider when comparing two float numbers
+    :return: list of actions
+    """
+    result = []
+    _diff(first, second, [], result, tolerance)
+    return result
+
+
+def _diff(first, second, node, result, tolerance):
+    if first is second:
+        return
+    if isinstance(first, DICT_TYPES) and isinstance(second, DICT_TYPES):
+        if first == second:
+            return
+        for key in first:
+            if key in second:
+                _diff(first[key], second[key], node + [key], result, tolerance)
+        addition = [(key, deepcopy(second[key])) for key in second if key not in first]
+        if addition:
+            result.append((ADD, _dotted(node), addition))
+        deletion = [(key, deepcopy(first[key])) for key in first if key not in second]
+        if deletion:
+            result.append((REMOVE, _dotted(node), deletion))
+    elif isinstance(first, LIST_TYPES) and isinstance(second, LIST_TYPES):
+        if first == second:
+            return
+        common = min(len(first), len(second))
+        for index in range(common):
+            _diff(first[index], second[index], node + [index], result, tolerance)
+        if len(second) > common:
+            result.append((ADD, _dotted(node), [(index, deepcopy(second[index]))
+                                                for index in range(common, len(second))]))
+        if len(first) > common:
+            result.append((REMOVE, _dotted(node), [(index, deepcopy(first[index]))
+                                                   for index in reversed(range(common, len(first)))]))
+    elif isinstance(first, SET_TYPES) and isinstance(second, SET_TYPES):
+        result.extend(dictdiffer.diff(first, second, node=node, tolerance=tolerance))
+    elif are_different(first, second, tolerance):
+        result.append((CHANGE, _dotted(node), (deepcopy(first), deepcopy(second))))
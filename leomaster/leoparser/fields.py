@@ -0,0 +1,53 @@
+import json
+import zlib
+
+from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class PackedJSONField(models.BinaryField):
+    """
+    JSON value stored as zlib compressed compact JSON in a binary column (bytea).
+    Value is packed on the way to database and unpacked on the way back,
+    so the field is used as a JSON field but it can not be filtered by content
+    """
+    description = 'Compressed JSON'
+
+    def __init__(self, *args, level=6, encoder=DjangoJSONEncoder, **kwargs):
+        self.level = level
+        self.encoder = encoder
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.level != 6:
+            kwargs['level'] = self.level
+        if self.encoder is not DjangoJSONEncoder:
+            kwargs['encoder'] = self.encoder
+        return name, path, args, kwargs
+
+    def pack(self, value):
+        dump = json.dumps(value, cls=self.encoder, separators=(',', ':'), ensure_ascii=False)
+        return zlib.compress(dump.encode('utf-8'), self.level)
+
+    @staticmethod
+    def unpack(value):
+        return json.loads(zlib.decompress(bytes(value)).decode('utf-8'))
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is None:
+            return None
+        return super().get_db_prep_value(self.pack(value), connection, prepared)
+
+    def from_db_value(self, value, expression, connection, *args):
+        if value is None:
+            return None
+        return self.unpack(value)
+
+    def to_python(self, value):
+        if isinstance(value, (bytes, memoryview)):
+            return self.unpack(value)
+        return value
+
+    def value_to_string(self, obj):
+        return json.dumps(self.value_from_object(obj), cls=self.encoder)
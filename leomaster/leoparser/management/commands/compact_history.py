@@ -0,0 +1,32 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+
+from leoparser.compaction import BATCH_SIZE, CompactionReport, compact_history, expire_history
+
+
+class Command(BaseCommand):
+    help = 'Merge old deltas of documents into hourly and daily ones and delete history older than retention'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hourly-after', type=int, default=None,
+                            help='merge deltas older than N hours per hour, see LEOPARSER_COMPACT_HOURLY_AFTER')
+        parser.add_argument('--daily-after', type=int, default=None,
+                            help='merge deltas older than N days per day, see LEOPARSER_COMPACT_DAILY_AFTER')
+        parser.add_argument('--retention', type=int, default=None,
+                            help='delete history older than N days, see LEOPARSER_HISTORY_RETENTION')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='amount of documents compacted in a single transaction')
+
+    def handle(self, *args, **options):
+        for name in ('hourly_after', 'daily_after', 'retention', 'batch_size'):
+            if options[name] is not None and options[name] < 1:
+                raise CommandError('Value of "%s" must be positive' % (name.replace('_', '-'),))
+
+        report = CompactionReport()
+        compact_history(hourly_after=timedelta(hours=options['hourly_after']) if options['hourly_after'] else None,
+                        daily_after=timedelta(days=options['daily_after']) if options['daily_after'] else None,
+                        batch_size=options['batch_size'], report=report)
+        expire_history(retention=timedelta(days=options['retention']) if options['retention'] else None,
+                       report=report)
+        self.stdout.write('documents: %s, merged deltas: %s, deleted deltas: %s, bytes reclaimed: %s' % (
+            report.documents, report.merged, report.deleted, report.bytes_reclaimed))
@@ -0,0 +1,34 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand, CommandError
+
+from leoparser.models import DocDelta, _bulk_update
+
+
+class Command(BaseCommand):
+    help = 'Move deltas of documents from JSON column into compressed binary column (or back with --unpack)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='amount of deltas converted at once')
+        parser.add_argument('--unpack', action='store_true', default=False, help='convert packed deltas back to JSON')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('Batch size must be positive')
+        source, target = ('packed', 'delta') if options['unpack'] else ('delta', 'packed')
+        fields = [DocDelta._meta.get_field('delta'), DocDelta._meta.get_field('packed')]
+
+        converted, last_id = 0, 0
+        while True:
+            rows = DocDelta.objects.filter(**{'id__gt': last_id, '%s__isnull' % (source,): False})\
+                .order_by('id').values_list('id', source)[:batch_size]
+            rows = list(rows)
+            if not rows:
+                break
+            with transaction.atomic():
+                _bulk_update(DocDelta, [DocDelta(id=delta_id, **{source: None, target: delta})
+                                        for delta_id, delta in rows], fields, DocDelta.objects.db)
+            converted += len(rows)
+            last_id = rows[-1][0]
+            self.stdout.write('%s deltas converted' % (converted,))
+        self.stdout.write('Done: %s deltas converted into "%s" column' % (converted, target))
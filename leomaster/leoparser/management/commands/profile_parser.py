@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from leoparser.models import Parser
+
+
+class Command(BaseCommand):
+    help = 'Parse html file by parser and report time, calls, matches and errors of every rule'
+
+    def add_arguments(self, parser):
+        parser.add_argument('parser_name', help='name of parser')
+        parser.add_argument('html_file', help='path to html file')
+        parser.add_argument('--repeat', type=int, default=1, help='amount of parsing iterations')
+        parser.add_argument('--limit', type=int, default=0, help='show only N slowest rules')
+
+    def handle(self, *args, **options):
+        try:
+            leo_parser = Parser.objects.get(name=options['parser_name'])
+        except Parser.DoesNotExist:
+            raise CommandError('Parser "%s" does not exist' % (options['parser_name'],))
+        if options['repeat'] < 1:
+            raise CommandError('Amount of iterations must be positive')
+
+        try:
+            with open(options['html_file'], 'rb') as f:
+                content = f.read()
+        except OSError as err:
+            raise CommandError('Could not read html file "%s": %s' % (options['html_file'], err))
+
+        report = leo_parser.profile(content, repeat=options['repeat'])
+        sources = {rule.id: rule.xpath + (' ~ /%s/' % (rule.regex,) if rule.regex else '')
+                   for rule in leo_parser.rules.values()}
+        self.stdout.write(report.format(n=options['limit'], sources=sources))
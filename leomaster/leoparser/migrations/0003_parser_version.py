@@ -0,0 +1,18 @@
+# Generated by Django 2.0.6 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leoparser', '0002_auto_20200418_1535'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parser',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='version'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.0.6 on 2026-10-18 12:05
+
+import json
+import hashlib
+
+from django.db import migrations, models
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+def content_fingerprint(content):
+    # copy of leoparser.models.content_fingerprint as of this migration
+    try:
+        dump = json.dumps(content, cls=DjangoJSONEncoder, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    except TypeError:
+        dump = json.dumps(json.loads(json.dumps(content, cls=DjangoJSONEncoder)),
+                          sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha1(dump.encode('utf-8')).hexdigest()
+
+
+def fill_fingerprints(apps, schema_editor):
+    GenericDocument = apps.get_model('leoparser', 'GenericDocument')
+    for doc in GenericDocument.objects.only('id', 'content').iterator():
+        GenericDocument.objects.filter(id=doc.id).update(fingerprint=content_fingerprint(doc.content))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leoparser', '0003_parser_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genericdocument',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', editable=False, max_length=40),
+        ),
+        migrations.RunPython(fill_fingerprints, migrations.RunPython.noop),
+    ]
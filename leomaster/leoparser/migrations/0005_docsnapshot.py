@@ -0,0 +1,42 @@
+# Generated by Django 2.0.6 on 2026-10-18 12:40
+
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leoparser', '0004_genericdocument_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genericdocument',
+            name='changes_since_snapshot',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='genericdocument',
+            name='snapshot_created',
+            field=models.DateTimeField(default=None, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='DocSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('content', django.contrib.postgres.fields.jsonb.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('base', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshot_set', to='leoparser.GenericDocument')),
+            ],
+            options={
+                'ordering': ('-created',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='docsnapshot',
+            index=models.Index(fields=['base', 'created'], name='leoparser_d_base_id_ca6fbb_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.0.6 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leoparser', '0005_docsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='docdelta',
+            index=models.Index(fields=['base', 'created'], name='leoparser_d_base_id_9b042b_idx'),
+        ),
+    ]
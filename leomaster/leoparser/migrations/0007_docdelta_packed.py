@@ -0,0 +1,26 @@
+# Generated by Django 2.0.6 on 2026-10-18 14:20
+
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.db import migrations
+import leoparser.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leoparser', '0006_docdelta_base_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='docdelta',
+            name='packed',
+            field=leoparser.fields.PackedJSONField(default=None, null=True),
+        ),
+        migrations.AlterField(
+            model_name='docdelta',
+            name='delta',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=list, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.0.6 on 2026-10-18 11:20
+
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leoparser', '0007_docdelta_packed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TestRelatedModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField()),
+                ('title', models.TextField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='genericdocument',
+            name='content',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder),
+        ),
+        migrations.CreateModel(
+            name='TestMappingDocument',
+            fields=[
+                ('genericdocument_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='leoparser.GenericDocument')),
+                ('date', models.DateTimeField(default=None, null=True)),
+                ('related', models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='leoparser.TestRelatedModel')),
+            ],
+            bases=('leoparser.persistenthistorydocument',),
+        ),
+    ]
@@ -1,31 +1,63 @@
 import re
 import json
+import time
 import uuid
+import hashlib
 import lxml
 import logging
 import lxml.html
-
-from django.db import models
+import threading
+
+from datetime import timedelta
+from contextlib import contextmanager
+from collections import namedtuple
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, When, Value, Q, F, OuterRef, Subquery
+from django.db.models.functions import Cast
 from django.db.models.fields import NOT_PROVIDED
+from django.db.models.signals import pre_save, post_save
 
 from django.utils import timezone
 from django.contrib.postgres.fields import JSONField
 from django.core.serializers.json import DjangoJSONEncoder
-from django.core.exceptions import ObjectDoesNotExist, FieldError, MultipleObjectsReturned
+from django.core.exceptions import ObjectDoesNotExist, FieldError, MultipleObjectsReturned, ValidationError
 
 from dateutil.relativedelta import *
-from dictdiffer import diff, patch, revert
+from dictdiffer import patch, revert
+
+from leoparser import converters
+from leoparser.diff import diff as fast_diff
+from leoparser.fields import PackedJSONField
+from leoparser.relations import related_cache
+from leoparser.plan import ExecutionPlan, compile_regex, apply_regex
+from leoparser.tracing import ParseTrace, ParseProfile
 
 LOG = logging.getLogger(__name__)
 
+SNAPSHOT_EVERY = 100
+SNAPSHOT_INTERVAL = timedelta(days=1)
+
 
 class Parser(models.Model):
     name = models.TextField(verbose_name='name', unique=True, blank=False)
     rule_set = models.ManyToManyField('Rule', verbose_name='rule', related_name='parsers')
+    version = models.PositiveIntegerField(verbose_name='version', default=0, editable=False)
 
     def __init__(self, *args, **kwargs):
         super(Parser, self).__init__(*args, **kwargs)
         self._rules = {}
+        self._plan = None
+        self._trace = None
+
+    def save(self, *args, **kwargs):
+        # version is changed only by bump_version, a stale instance must not write its version back
+        if not self._state.adding and not kwargs.get('force_insert'):
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+            kwargs['update_fields'] = [name for name in update_fields if name != 'version']
+        super().save(*args, **kwargs)
 
     @property
     def rules(self):
@@ -33,16 +65,42 @@ class Parser(models.Model):
             if not self._rules:
                 self._rules = {rule.id: rule for rule in self.rule_set.select_related('typeof', 'parent').all()}
                 self._init_children()
+                self._plan = None
         return self._rules
 
+    @property
+    def plan(self):
+        """
+        Compiled rules of parser.
+        Plan is shared between parsers with the same rule set and rebuilt only when rules change.
+        """
+        rules = self.rules
+        if self._plan is None:
+            self._plan = ExecutionPlan.compile(rules.values())
+        return self._plan
+
     def _init_children(self):
-        for _id, rule in self.rules.items():
-            rule.set_children([r for r in self.rules.values() if r.parent_id == _id])
+        children = {_id: [] for _id in self._rules}
+        for rule in self._rules.values():
+            if rule.parent_id in children:
+                children[rule.parent_id].append(rule)
+        for _id, rule in self._rules.items():
+            rule.set_children(children[_id])
+
+    @classmethod
+    def bump_version(cls, queryset):
+        """
+        Increase version of parsers, so cached rules of them are reloaded by ParserRegistry of every process
+        :param queryset: parsers which rules have been changed
+        """
+        ids = list(queryset.values_list('id', flat=True).distinct())
+        if ids:
+            cls.objects.filter(id__in=ids).update(version=models.F('version') + 1)
 
     def _get_roots(self):
         return [rule for rule in self.rules.values() if rule.parent is None]
 
-    def _go_through_rules(self, root, html, doc, level=1):
+    def _go_through_rules(self, root, html, doc):
         try:
             result = root.apply(html)
         except Exception:
@@ -58,8 +116,7 @@ class Parser(models.Model):
                     context_doc = doc[root.name]
                     context_html = html
                 for rule in root.children:
-                    print(' ' * (level * 3) + '|_', str(rule))
-                    self._go_through_rules(rule, context_html, context_doc, level=level + 1)
+                    self._go_through_rules(rule, context_html, context_doc)
         else:
             if isinstance(result, lxml.html.HtmlElement):
                 context_doc = dict()
@@ -70,20 +127,78 @@ class Parser(models.Model):
                 context_doc = doc
                 context_html = html
             for rule in root.children:
-                print(' ' * (level * 3) + '|_', str(rule))
-                self._go_through_rules(rule, context_html, context_doc, level=level + 1)
+                self._go_through_rules(rule, context_html, context_doc)
 
     def go_through(self, html, doc):
         root_rules = self._get_roots()
         for root in root_rules:
-            print('|_', str(root))
             self._go_through_rules(root, html, doc)
 
+    @contextmanager
+    def tracing(self, trace=None):
+        """
+        Trace every rule applied by parse calls made inside of the block.
+        Usage:
+            with parser.tracing() as trace:
+                parser.parse(content)
+            print(trace.format())
+        :param trace: ParseTrace to collect events to, new one is created by default
+        """
+        previous = self._trace
+        self._trace = ParseTrace() if trace is None else trace
+        try:
+            yield self._trace
+        finally:
+            self._trace = previous
+
     def parse(self, content):
-        doc = dict()
         html = lxml.html.document_fromstring(content)
-        self.go_through(html, doc)
-        return doc
+        return self.plan.execute(html, hook=self._trace)
+
+    def parse_stream(self, chunks, encoding=None):
+        """
+        Parse html incrementally, see ExecutionPlan.execute_stream
+        Usage:
+            response = requests.get(url, stream=True)
+            for key, value in parser.parse_stream(response.iter_content(chunk_size=65536)):
+                ...
+        :param chunks: iterable of bytes or str
+        :param encoding: encoding of bytes, detected by parser by default
+        :return: generator of (key, value) pairs
+        """
+        return self.plan.execute_stream(chunks, encoding=encoding, hook=self._trace)
+
+    def parse_many(self, contents, workers=None, ordered=True):
+        """
+        Parse many documents in pool of processes, see ExecutionPlan.execute_many
+        Usage:
+            for index, doc in parser.parse_many(snapshots, workers=4):
+                if isinstance(doc, Exception):
+                    ...
+        :param contents: iterable of html
+        :param workers: amount of processes, amount of CPUs by default
+        :param ordered: yield results in order of contents, otherwise as soon as document is parsed
+        :return: generator of (index, doc) pairs, in case of failure exception is returned instead of doc
+        """
+        return self.plan.execute_many(contents, workers=workers, ordered=ordered)
+
+    def profile(self, content, repeat=1, report=None):
+        """
+        Parse content in instrumentation mode
+        :param content: html
+        :param repeat: amount of parsing iterations, statistics are accumulated
+        :param report: ParseProfile to accumulate statistics in, new one is created by default
+        :return: ParseProfile, result of the last iteration is available as report.doc
+        """
+        report = ParseProfile() if report is None else report
+        plan = self.plan
+        for _ in range(repeat):
+            started = time.perf_counter()
+            html = lxml.html.document_fromstring(content)
+            report.document_time += time.perf_counter() - started
+            report.doc = plan.execute(html, hook=report)
+            report.documents += 1
+        return report
 
 
 class Rule(models.Model):
@@ -94,6 +209,18 @@ class Rule(models.Model):
     typeof = models.ForeignKey('TypeOf', on_delete=models.CASCADE)
     parent = models.ForeignKey('Rule', related_name='children_set', null=True, blank=True, on_delete=models.CASCADE)
 
+    def __init__(self, *args, **kwargs):
+        self._compiled_regex = None
+        self._converter = None
+        super().__init__(*args, **kwargs)
+
+    def __setattr__(self, name, value):
+        if name == 'regex':
+            super().__setattr__('_compiled_regex', None)
+        elif name in ('typeof', 'typeof_id'):
+            super().__setattr__('_converter', None)
+        return super().__setattr__(name, value)
+
     def set_children(self, children):
         self.children = children
 
@@ -101,15 +228,45 @@ class Rule(models.Model):
         ordering = ('name',)
         unique_together = ('name', 'parent',)
 
+    @property
+    def compiled_regex(self):
+        """
+        Compiled regex, built on first access and dropped when regex is changed
+        :exception: re.error
+        """
+        if self._compiled_regex is None and self.regex:
+            self._compiled_regex = compile_regex(self.regex)
+        return self._compiled_regex
+
+    @property
+    def converter(self):
+        """
+        Converter of the rule type, every rule has its own one, so a format detected for values of one rule
+        does not affect other rules of the type
+        """
+        if self._converter is None:
+            self._converter = converters.get_converter(self.typeof.name)
+        return self._converter
+
+    def clean(self):
+        super().clean()
+        self.validate_regex()
+
+    def validate_regex(self):
+        try:
+            self.compiled_regex
+        except re.error as err:
+            raise ValidationError({'regex': 'Invalid regular expression: %s' % (err,)})
+
+    def save(self, *args, **kwargs):
+        self.validate_regex()
+        super().save(*args, **kwargs)
+
     def apply(self, element):
         res = element.xpath(self.xpath)
         if self.regex:
-            regex = re.compile(self.regex, re.UNICODE | re.IGNORECASE)
-            extracted = regex.search(res)
-            res = extracted.group(0) if extracted else res
-            if self.sub:
-                res = regex.sub(self.sub, res)
-        return self.typeof.convert(res)
+            res = apply_regex(self.compiled_regex, self.sub, res)
+        return self.converter(res)
 
     def __str__(self):
         return '%s::%s(%s)' % (self.typeof, self.name, self.xpath)
@@ -126,17 +283,6 @@ class Rule(models.Model):
                 'children': [c.id for c in self.children.all()]}
 
 
-def apply_once_or_many(f):
-    def wrapper(value):
-        if isinstance(value, (list, tuple)):
-            if len(value) > 1:
-                return [f(v) for v in value]
-            elif len(value) == 1:
-                value = value[0]
-        return f(value)
-    return wrapper
-
-
 class TypeOf(models.Model):
     T_CONTAINER = 'container'
     T_CURRENCY = 'currency'
@@ -162,16 +308,8 @@ class TypeOf(models.Model):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.converters = {
-            self.T_CONTAINER: self.to_container,
-            self.T_CURRENCY: self.to_currency,
-            self.T_DATE: self.to_date,
-            self.T_DATETIME: self.to_datetime,
-            self.T_FLOAT: self.to_float,
-            self.T_INTEGER: self.to_integer,
-            self.T_STRING: self.to_string,
-            self.T_TIME: self.to_time,
-        }
+        # own instances, formats detected by converters of one type are not shared with other ones
+        self.converters = {name: converters.get_converter(name) for name, _ in self.options}
 
     class Meta:
         ordering = ('name',)
@@ -180,44 +318,36 @@ class TypeOf(models.Model):
         return self.converters.get(self.name, lambda v: v)(value)
 
     @staticmethod
-    @apply_once_or_many
     def to_container(value):
-        return value
+        return converters.to_container(value)
 
     @staticmethod
-    @apply_once_or_many
     def to_currency(value):
-        return value
+        return converters.to_currency(value)
 
     @staticmethod
-    @apply_once_or_many
     def to_date(value):
-        return value
+        return converters.to_date(value)
 
     @staticmethod
-    @apply_once_or_many
     def to_datetime(value):
-        return value
+        return converters.to_datetime(value)
 
     @staticmethod
-    @apply_once_or_many
     def to_float(value):
-        return float(value)
+        return converters.to_float(value)
 
     @staticmethod
-    @apply_once_or_many
     def to_integer(value):
-        return int(value)
+        return converters.to_integer(value)
 
     @staticmethod
-    @apply_once_or_many
     def to_string(value):
-        return str(value).strip()
+        return converters.to_string(value)
 
     @staticmethod
-    @apply_once_or_many
     def to_time(value):
-        return value
+        return converters.to_time(value)
 
     def __str__(self):
         return self.name
@@ -226,19 +356,266 @@ class TypeOf(models.Model):
         return '<%s: id="%s" name="%s">' % (self.__class__.__name__, self.id, self.__str__(),)
 
 
+class DocDeltaManager(models.Manager):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._local = threading.local()
+
+    def record(self, base, delta):
+        """
+        Create delta of document, inside of buffered block delta is inserted when the block is over.
+        Snapshot of the document is created after the delta if it is due, see GenericDocument.snapshot_is_due
+        :param base: GenericDocument
+        :param delta: list of dictdiffer actions
+        :return: DocDelta
+        """
+        buffer = getattr(self._local, 'buffer', None)
+        doc_delta = self.model(base=base, **self.model.payload(delta))
+        snapshot = DocSnapshot(base=base, content=base.content) if base.snapshot_is_due else None
+        base.snapshot_is_due = False
+        if buffer is None:
+            doc_delta.save(force_insert=True, using=self.db)
+            if snapshot is not None:
+                snapshot.save(force_insert=True, using=self.db)
+        else:
+            buffer.append(doc_delta)
+            if snapshot is not None:
+                buffer.append(snapshot)
+        return doc_delta
+
+    @contextmanager
+    def buffered(self, batch_size=None):
+        """
+        Collect deltas recorded in block and insert them by bulk_create, nested blocks share the outer buffer.
+        Deltas are dropped if block is failed
+        """
+        if getattr(self._local, 'buffer', None) is not None:
+            yield
+            return
+        self._local.buffer = []
+        try:
+            yield
+            # snapshots are inserted after deltas, so they are never older than the deltas they include
+            buffer = self._local.buffer
+            self.bulk_create([obj for obj in buffer if isinstance(obj, DocDelta)], batch_size=batch_size)
+            DocSnapshot.objects.using(self.db).bulk_create([obj for obj in buffer if isinstance(obj, DocSnapshot)],
+                                                           batch_size=batch_size)
+        finally:
+            self._local.buffer = None
+
+
 class DocDelta(models.Model):
     base = models.ForeignKey('GenericDocument', related_name='delta_set', null=False, on_delete=models.CASCADE)
     created = models.DateTimeField(auto_now_add=True)
-    delta = JSONField(default=list, encoder=DjangoJSONEncoder)
+    delta = JSONField(default=list, null=True, encoder=DjangoJSONEncoder)
+    packed = PackedJSONField(null=True, default=None)
+
+    objects = DocDeltaManager()
 
     class Meta:
         ordering = ('-created',)
+        indexes = [models.Index(fields=['base', 'created'])]
+
+    @staticmethod
+    def payload(delta):
+        """
+        Return values of delta columns, delta is packed into binary column if LEOPARSER_PACK_DELTAS is on
+        :param delta: list of dictdiffer actions
+        :return: dict of field name to value
+        """
+        if getattr(settings, 'LEOPARSER_PACK_DELTAS', False):
+            return {'delta': None, 'packed': delta}
+        return {'delta': delta, 'packed': None}
+
+    @property
+    def changes(self):
+        """
+        Delta regardless of the column it is stored in
+        """
+        return self.packed if self.packed is not None else self.delta
 
     def __str__(self):
-        return json.dumps(self.delta, indent=1)
+        return json.dumps(self.changes, indent=1)
 
     def __repr__(self):
-        return '<%s: id="%s" delta="%s">' % (self.__class__.__name__, self.id, self.delta,)
+        return '<%s: id="%s" delta="%s">' % (self.__class__.__name__, self.id, self.changes,)
+
+
+class DocSnapshot(models.Model):
+    """
+    Full copy of document content, it includes all deltas of the document created before the snapshot.
+    A version of the document is restored from the nearest snapshot by replaying deltas created after it
+    """
+    base = models.ForeignKey('GenericDocument', related_name='snapshot_set', null=False, on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+    content = JSONField(default=dict, encoder=DjangoJSONEncoder)
+
+    class Meta:
+        ordering = ('-created',)
+        indexes = [models.Index(fields=['base', 'created'])]
+
+    def replay(self, deltas):
+        """
+        Apply deltas created after the snapshot to its content
+        :param deltas: iterable of DocDelta in order of creation
+        :return: content
+        """
+        return replay(self.content, deltas)
+
+    def __str__(self):
+        return '%s%s' % (json.dumps(self.content)[:100], '...')
+
+    def __repr__(self):
+        return '<%s: id="%s" base="%s" created="%s">' % (self.__class__.__name__, self.id, self.base_id,
+                                                         self.created,)
+
+
+def replay(content, deltas):
+    """
+    Apply deltas to content one by one
+    :param content: dict
+    :param deltas: iterable of DocDelta in order of creation
+    :return: new content, content passed is not changed
+    """
+    for doc_delta in deltas:
+        content = patch(doc_delta.changes, content)
+    return content
+
+
+def contents_as_of(docs, timestamp, chunk_size=2000):
+    """
+    Restore contents of documents at timestamp by a fixed amount of queries.
+    Documents having a snapshot before timestamp are restored forward from the latest such snapshot,
+    the rest are restored backward from the earliest snapshot after timestamp or from the current content.
+    Deltas of all documents are streamed by one query per direction, both use (base, created) indexes
+    :param docs: iterable of GenericDocument created not later than timestamp
+    :param timestamp: aware datetime
+    :param chunk_size: amount of deltas fetched from database at once
+    :return: dict of document id to content
+    """
+    docs = {doc.id: doc for doc in docs}
+    contents = {}
+    if not docs:
+        return contents
+
+    before = DocSnapshot.objects.filter(base__in=list(docs), created__lte=timestamp).order_by('base', '-created')
+    for base_id, content in before.distinct('base').values_list('base_id', 'content'):
+        contents[base_id] = content
+    if contents:
+        latest = DocSnapshot.objects.filter(base=OuterRef('base'), created__lte=timestamp).order_by('-created')
+        forward = DocDelta.objects.filter(base__in=list(contents), created__lte=timestamp,
+                                          created__gt=Subquery(latest.values('created')[:1]))
+        forward = forward.order_by('base', 'created').values_list('base_id', 'delta', 'packed')
+        for base_id, delta, packed in forward.iterator(chunk_size):
+            contents[base_id] = patch(packed if packed is not None else delta, contents[base_id])
+
+    rest = [doc_id for doc_id in docs if doc_id not in contents]
+    if rest:
+        after = DocSnapshot.objects.filter(base__in=rest, created__gt=timestamp).order_by('base', 'created')
+        for base_id, content in after.distinct('base').values_list('base_id', 'content'):
+            contents[base_id] = content
+        for doc_id in rest:
+            if doc_id not in contents:
+                doc = docs[doc_id]
+                contents[doc_id] = doc._old_content if doc._old_content is not None else doc.content
+        earliest = DocSnapshot.objects.filter(base=OuterRef('base'), created__gt=timestamp).order_by('created')
+        backward = DocDelta.objects.filter(base__in=rest, created__gt=timestamp)\
+            .annotate(bound=Subquery(earliest.values('created')[:1]))\
+            .filter(Q(bound__isnull=True) | Q(created__lte=F('bound')))
+        backward = backward.order_by('base', '-created').values_list('base_id', 'delta', 'packed')
+        for base_id, delta, packed in backward.iterator(chunk_size):
+            contents[base_id] = revert(packed if packed is not None else delta, contents[base_id])
+    return contents
+
+
+def snapshot_policy():
+    """
+    Return amount of changes and interval after which a new snapshot of document is created,
+    see LEOPARSER_SNAPSHOT_EVERY and LEOPARSER_SNAPSHOT_INTERVAL settings
+    """
+    every = getattr(settings, 'LEOPARSER_SNAPSHOT_EVERY', SNAPSHOT_EVERY)
+    interval = getattr(settings, 'LEOPARSER_SNAPSHOT_INTERVAL', SNAPSHOT_INTERVAL)
+    if not isinstance(interval, timedelta):
+        interval = timedelta(seconds=interval)
+    return every, interval
+
+
+def stored_form(content):
+    """
+    Return content as it is loaded from database: typed values (dates, times, decimals) are replaced
+    by their JSON representation, keys are strings
+    """
+    return json.loads(json.dumps(content, cls=DjangoJSONEncoder))
+
+
+def content_fingerprint(content):
+    """
+    Return stable hash of document content.
+    Content is hashed in the same JSON representation it is stored in database,
+    so typed values (e.g. dates) and values loaded from database have the same fingerprint
+    """
+    try:
+        dump = json.dumps(content, cls=DjangoJSONEncoder, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    except TypeError:
+        # keys of different types can not be sorted, they are all strings after a round trip
+        dump = json.dumps(json.loads(json.dumps(content, cls=DjangoJSONEncoder)),
+                          sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha1(dump.encode('utf-8')).hexdigest()
+
+
+def _batches(objs, batch_size):
+    if not batch_size:
+        yield objs
+        return
+    for start in range(0, len(objs), batch_size):
+        yield objs[start:start + batch_size]
+
+
+def _bulk_insert(model, objs, using, batch_size=None):
+    """
+    Insert objects by one statement per table.
+    Unlike QuerySet.bulk_create multi-table inherited models are supported:
+    rows of the root model are inserted first and their ids are used as parent links of the rest tables.
+    Signals are not sent
+    """
+    parents = model._meta.get_parent_list()
+    if not parents:
+        model._base_manager.using(using).bulk_create(objs, batch_size=batch_size)
+        return
+    root = parents[-1]
+    root_fields = [field for field in root._meta.concrete_fields if not field.primary_key]
+    rows = [root(**{field.attname: getattr(obj, field.attname) for field in root_fields}) for obj in objs]
+    root._base_manager.using(using).bulk_create(rows, batch_size=batch_size)
+    for obj, row in zip(objs, rows):
+        for field in root._meta.concrete_fields:
+            setattr(obj, field.attname, getattr(row, field.attname))
+    for klass in list(reversed(parents[:-1])) + [model]:
+        for obj in objs:
+            for link in klass._meta.parents.values():
+                setattr(obj, link.attname, getattr(obj, root._meta.pk.attname))
+        for batch in _batches(objs, batch_size):
+            klass._base_manager.using(using)._insert(batch, fields=klass._meta.local_concrete_fields, using=using)
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = using
+
+
+def _bulk_update(model, objs, fields, using, batch_size=None):
+    """
+    Update fields of objects by one statement per table, value of every row is selected by CASE WHEN pk = ...
+    Signals are not sent
+    """
+    tables = {}
+    for field in fields:
+        tables.setdefault(field.model._meta.concrete_model, []).append(field)
+    for table, table_fields in tables.items():
+        for batch in _batches(objs, batch_size):
+            values = {}
+            for field in table_fields:
+                whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in batch]
+                values[field.attname] = Cast(Case(*whens, output_field=field), output_field=field)
+            table._base_manager.using(using).filter(pk__in=[obj.pk for obj in batch]).update(**values)
 
 
 class HistoryManager(models.Manager):
@@ -255,8 +632,12 @@ class HistoryManager(models.Manager):
 
         lookup = {self.unique_field: unique_value}
         try:
-
-            doc = self.get_queryset().get(**lookup)
+            doc = self.get_queryset().defer('content').get(**lookup)
+            if doc.fingerprint == content_fingerprint(content):
+                # nothing changed, stored content is not even loaded
+                doc.content = content
+                return doc, False, []
+            doc.refresh_from_db(fields=['content'])
             doc.content = content
             delta = doc.delta
             doc.save(*args, **kwargs)
@@ -268,14 +649,150 @@ class HistoryManager(models.Manager):
 
         return doc, is_new, delta
 
+    def save_many(self, contents, batch_size=None):
+        """
+        Save many documents as save does but by a fixed amount of queries.
+        Fingerprints of all documents are selected by one query, changed documents by another one,
+        deltas are computed in memory, new documents, updated documents and deltas are written by bulk
+        statements in a single transaction. pre_save and post_save signals are sent for every written document,
+        deltas recorded by receivers are collected and inserted together.
+        If a unique value occurs more than once, the last content is saved and returned for every occurrence
+        :param contents: iterable of contents as for save
+        :param batch_size: max amount of rows per statement
+        :return: list of (doc, is_new, delta) in order of contents
+        """
+        model, using = self.model, self.db
+        items = []
+        for content in contents:
+            try:
+                unique_value = str(content.pop(self.unique_field))
+            except KeyError:
+                unique_value = uuid.uuid4().hex
+            items.append((unique_value, content))
+        if not items:
+            return []
+
+        last = dict(items)
+        stored = self.fingerprints(last)
+        changed = {value for value in stored if stored[value] != content_fingerprint(last[value])}
+        lookup = {'%s__in' % (self.unique_field,): list(changed)}
+        docs = {getattr(doc, self.unique_field): doc for doc in self.get_queryset().filter(**lookup)} if changed else {}
+        if len(docs) < len(stored):
+            lookup = {'%s__in' % (self.unique_field,): [value for value in stored if value not in docs]}
+            docs.update((getattr(doc, self.unique_field), doc) for doc in self.get_queryset().defer('content')
+                        .filter(**lookup))
+
+        results, created, updated = {}, [], []
+        for unique_value, content in last.items():
+            doc = docs.get(unique_value)
+            if doc is None:
+                doc = model(content=content, **{self.unique_field: unique_value})
+                created.append(doc)
+                results[unique_value] = (doc, True, [])
+            elif unique_value not in changed:
+                doc.content = content
+                results[unique_value] = (doc, False, [])
+            else:
+                doc.content = content
+                updated.append(doc)
+                results[unique_value] = (doc, False, list(doc.delta))
+
+        now = timezone.now()
+        with transaction.atomic(using=using), DocDelta.objects.buffered(batch_size=batch_size):
+            for doc in created + updated:
+                doc._prepare_save(map_fields=False)
+            with related_cache.batch():
+                model._prefetch_related(created + updated)
+                for doc in created + updated:
+                    doc._map_to_field()
+            for doc in created + updated:
+                doc.modified = now
+                pre_save.send(sender=model, instance=doc, raw=False, using=using, update_fields=None)
+            if created:
+                for doc in created:
+                    doc.created = now
+                _bulk_insert(model, created, using, batch_size)
+            if updated:
+                fields = [field for field in model._meta.concrete_fields
+                          if not field.primary_key and field.name not in (self.unique_field, 'created')]
+                _bulk_update(model, updated, fields, using, batch_size)
+            for is_new, group in ((True, created), (False, updated)):
+                for doc in group:
+                    post_save.send(sender=model, instance=doc, created=is_new, update_fields=None, raw=False,
+                                   using=using)
+        for doc in updated:
+            doc._old_content = None
+            doc._delta = None
+            doc.snapshot_is_due = False
+        return [results[unique_value] for unique_value, _ in items]
+
+    def as_of(self, timestamp, uids=None, chunk_size=2000):
+        """
+        Restore contents of documents at timestamp, see contents_as_of
+        :param timestamp: aware datetime
+        :param uids: values of unique field, all documents by default
+        :param chunk_size: amount of deltas fetched from database at once
+        :return: dict of unique value to content, documents created after timestamp are omitted
+        """
+        docs = self.get_queryset().filter(created__lte=timestamp)
+        if uids is not None:
+            docs = docs.filter(**{'%s__in' % (self.unique_field,): [str(uid) for uid in uids]})
+        docs = list(docs)
+        contents = contents_as_of(docs, timestamp, chunk_size)
+        return {getattr(doc, self.unique_field): contents[doc.id] for doc in docs}
+
+    def fingerprints(self, unique_values):
+        """
+        Return fingerprints of stored documents by one query
+        :param unique_values: iterable of values of unique field
+        :return: dict of unique value to fingerprint, missing documents are omitted
+        """
+        lookup = {'%s__in' % (self.unique_field,): [str(value) for value in unique_values]}
+        return dict(self.get_queryset().filter(**lookup).values_list(self.unique_field, 'fingerprint'))
+
+    def changed(self, contents):
+        """
+        Filter out contents which are already stored as is
+        :param contents: iterable of contents as for save
+        :return: list of contents which are new or differ from stored documents
+        """
+        contents = list(contents)
+        stored = self.fingerprints(content[self.unique_field] for content in contents
+                                   if self.unique_field in content)
+        changed = []
+        for content in contents:
+            if self.unique_field in content:
+                fingerprint = stored.get(str(content[self.unique_field]))
+                rest = {key: value for key, value in content.items() if key != self.unique_field}
+                if fingerprint is not None and fingerprint == content_fingerprint(rest):
+                    continue
+            changed.append(content)
+        return changed
+
+
+MappingItem = namedtuple('MappingItem', ('path', 'keys', 'target', 'field', 'is_foreign_key'))
+
 
 class MetaDocument(models.base.ModelBase):
+    """
+    Checks mapping of document and compiles it into a plan: fields are resolved and paths are split once per class
+    """
 
     def __init__(cls, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        cls._fields_by_name = {field.name: field for field in cls._meta.fields}
         cls._check_mapping()
+        cls._mapping_plan = cls._compile_mapping()
         setattr(cls, 'get_field_by_name', cls._get_field_by_name)
 
+    def _compile_mapping(cls):
+        plan = []
+        for path, target in getattr(cls, 'mapping', {}).items():
+            field = cls._get_field_by_name(target) if isinstance(target, str) else target
+            plan.append(MappingItem(path, tuple(path.split('.')), target, field,
+                                    isinstance(field, models.ForeignKey)))
+        return tuple(plan)
+
     def _check_mapping(cls):
         if hasattr(cls, 'mapping'):
             for item in cls.mapping.values():
@@ -289,15 +806,15 @@ class MetaDocument(models.base.ModelBase):
                     raise AssertionError(msg % (item, cls.__name__,))
 
     def _get_field_by_name(cls, name):
-        for field in cls._meta.fields:
-            if field.name == name:
-                return field
-        return None
+        return cls._fields_by_name.get(name)
 
 
 class GenericDocument(models.Model, metaclass=MetaDocument):
     uid = models.TextField(unique=True)
     content = JSONField(default=dict, null=False, encoder=DjangoJSONEncoder)
+    fingerprint = models.CharField(max_length=40, blank=True, default='', editable=False)
+    changes_since_snapshot = models.PositiveIntegerField(default=0, editable=False)
+    snapshot_created = models.DateTimeField(null=True, default=None, editable=False)
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
     _track_change = False
@@ -310,6 +827,9 @@ class GenericDocument(models.Model, metaclass=MetaDocument):
 
     def __init__(self, *args, **kwargs):
         self._old_content = None
+        self._assigned_content = None
+        self._delta = None
+        self.snapshot_is_due = False
         super().__init__(*args, **kwargs)
 
     @property
@@ -328,6 +848,8 @@ class GenericDocument(models.Model, metaclass=MetaDocument):
             # instance has already created
             if self.__dict__.get('id') and self._old_content is None:
                 self._old_content = self.__dict__.get('content')
+            self._assigned_content = value
+            self._delta = None
         return super().__setattr__(name, value)
 
     @property
@@ -337,28 +859,50 @@ class GenericDocument(models.Model, metaclass=MetaDocument):
         return patch(self.delta, self._old_content)
 
     def save(self, *args, **kwargs):
-        if self._old_content is not None:
-            super().__setattr__('content', self.patched_content)
-        self._map_to_field()
+        self._prepare_save()
         super().save(*args, **kwargs)
         self._old_content = None
+        self._delta = None
+        self.snapshot_is_due = False
+
+    def _prepare_save(self, map_fields=True):
+        # fingerprint is taken of assigned content, stored content keeps keys which are not tracked as removed,
+        # so the same content assigned next time is recognized as unchanged (see HistoryManager.save)
+        self.fingerprint = content_fingerprint(self.content)
+        if self._old_content is not None:
+            delta = self.delta
+            super().__setattr__('content', patch(delta, self._old_content))
+            if delta:
+                self._count_change()
+        if map_fields:
+            self._map_to_field()
+
+    def _count_change(self):
+        """
+        Count change of content and decide whether a snapshot has to be created together with the delta
+        """
+        every, interval = snapshot_policy()
+        now = timezone.now()
+        self.changes_since_snapshot += 1
+        last = self.snapshot_created or self.created
+        if self.changes_since_snapshot >= every or (last is not None and now - last >= interval):
+            self.snapshot_is_due = True
+            self.changes_since_snapshot = 0
+            self.snapshot_created = now
 
     def _map_to_field(self):
-        for path, target in self.mapping.items():
-            field = self.get_field_by_name(target) if isinstance(target, str) else target
+        for path, keys, target, field, is_foreign_key in self._mapping_plan:
             if field is not None:
                 try:
-                    value = self._extract_value_from_content(path)
+                    value = self._extract_value_from_content(keys)
                 except KeyError:
                     LOG.warning('Path "%(path)s" does not exist in content (path="%(path)s" content="%(content)s")',
                                 {'path': path, 'content': self.content})
                     continue
 
-                if isinstance(field, models.ForeignKey) and isinstance(value, dict):
+                if is_foreign_key and isinstance(value, dict):
                     try:
-                        model = field.related_model
-                        related_instance, _ = model.objects.get_or_create(**value)
-                        value = related_instance
+                        value = related_cache.get_or_create(field.related_model, value)
                     except (FieldError, MultipleObjectsReturned) as err:
                         vars = path, field.name, path, self.content, value
                         if isinstance(err, FieldError):
@@ -375,29 +919,89 @@ class GenericDocument(models.Model, metaclass=MetaDocument):
                             'for model "%(model)s" (target="%(target)s" model="%(model)s")',
                             {'target': target, 'model': self.__class__.__name__})
 
+    @classmethod
+    def _prefetch_related(cls, docs):
+        """
+        Resolve related instances mapped from contents of many documents by a query per related model,
+        see RelatedCache.prefetch
+        :param docs: documents of the class
+        """
+        lookups = {}
+        for path, keys, target, field, is_foreign_key in cls._mapping_plan:
+            if field is None or not is_foreign_key:
+                continue
+            for doc in docs:
+                try:
+                    value = doc._extract_value_from_content(keys)
+                except KeyError:
+                    continue
+                if isinstance(value, dict):
+                    lookups.setdefault(field.related_model, []).append(value)
+        for model, values in lookups.items():
+            related_cache.prefetch(model, values)
+
     def _extract_value_from_content(self, path):
         """
-        Extract value from dict by dot separated keys
-        :param path: dot separated keys
+        Extract value from dict by dot separated keys.
+        Assigned content is looked up first, it keeps typed values which are strings in saved content
+        :param path: dot separated keys or tuple of keys
         :return:
         :exception: KeyError
         """
-        value = self.content
-        for key in path.split('.'):
-            value = value[key]
-        return value
+        keys = path.split('.') if isinstance(path, str) else path
+        for content in (self._assigned_content, self.content):
+            if content is None:
+                continue
+            value = content
+            try:
+                for key in keys:
+                    value = value[key]
+            except (KeyError, IndexError, TypeError):
+                continue
+            return value
+        raise KeyError(path)
 
     @property
     def delta(self):
-        if self._old_content is not None:
-            return self._gen_delta(self._old_content, self.content)
-        return list()
+        """
+        Tracked changes between stored and assigned content.
+        Delta is computed once and cached until content is assigned again or document is saved
+        """
+        if self._old_content is None:
+            return list()
+        if self._delta is None:
+            # stored content is loaded as JSON, typed values of assigned content are compared in the same form,
+            # so an equal date is not recorded as a change from its string
+            self._delta = list(self._gen_delta(self._old_content, stored_form(self.content)))
+        return self._delta
 
     def _gen_delta(self, original, modified):
-        for action in diff(original, modified):
-            if action[0] in self.actions:
+        actions = self.actions
+        for action in fast_diff(original, modified):
+            if action[0] in actions:
                 yield action
 
+    def nearest_snapshot(self, timestamp=None):
+        """
+        Return the latest snapshot created not later than timestamp
+        :param timestamp: aware datetime, now by default
+        :return: DocSnapshot or None
+        """
+        snapshots = DocSnapshot.objects.filter(base=self)
+        if timestamp is not None:
+            snapshots = snapshots.filter(created__lte=timestamp)
+        return snapshots.order_by('-created').first()
+
+    def as_of(self, timestamp):
+        """
+        Restore content of document at timestamp
+        :param timestamp: aware datetime
+        :return: content or None if document did not exist at timestamp
+        """
+        if self.created is not None and timestamp < self.created:
+            return None
+        return contents_as_of([self], timestamp)[self.id]
+
     def get_year_history(self):
         return self.get_history_period(years=1)
 
@@ -418,20 +1022,37 @@ class GenericDocument(models.Model, metaclass=MetaDocument):
         return self.get_history(created__gte=last_date)
 
     def get_history(self, n=-1, **kwargs):
+        return list(self.iter_history(n, **kwargs))
+
+    def iter_history(self, n=-1, chunk_size=2000, **kwargs):
+        """
+        Iterate over versions of document from the current one back in time.
+        Only deltas of the document are read, they are streamed from database in chunks
+        :param n: amount of versions including the current one, all versions if negative
+        :param chunk_size: amount of deltas fetched from database at once
+        :param kwargs: lookups of DocDelta, e.g. created__gte
+        :return: generator of contents
+        :exception: TypeError if n is not integer representable
+        """
         try:
             n = int(n)
         except (TypeError, ValueError):
             raise TypeError('Amount of history items must be integer representable: "%s" isn\'t' % (n,))
+        doc_delta_set = DocDelta.objects.filter(base=self, **kwargs).order_by('-created')
+        if n > 0:
+            doc_delta_set = doc_delta_set[:n - 1]
+        return self._iter_history(n, doc_delta_set.values_list('delta', 'packed'), chunk_size)
+
+    def _iter_history(self, n, deltas, chunk_size):
+        if n == 0:
+            return
         current_version = self.content
-        history = [current_version]
-        doc_delta_set = DocDelta.objects.all().filter(**kwargs).order_by('-created')
-        for doc_delta in doc_delta_set:
-            previous_version = revert(doc_delta.delta, current_version)
-            history.append(previous_version)
-            current_version = previous_version
-        if n >= 0:
-            return history[:n]
-        return history
+        yield current_version
+        if n == 1:
+            return
+        for delta, packed in deltas.iterator(chunk_size):
+            current_version = revert(packed if packed is not None else delta, current_version)
+            yield current_version
 
     def __str__(self):
         return '%s%s' % (json.dumps(self.content)[:100], '...')
@@ -0,0 +1,536 @@
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+import lxml.html
+
+from lxml import etree
+from functools import lru_cache
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from leoparser.converters import get_converter
+
+LOG = logging.getLogger(__name__)
+
+ERROR = '__error__'
+CONTAINER = 'container'
+PLAN_CACHE_SIZE = 16
+
+
+def _failing(err):
+    def fail(*args, **kwargs):
+        raise err
+    return fail
+
+
+@lru_cache(maxsize=1024)
+def compile_regex(pattern):
+    """
+    Compile regex of rule, compiled patterns are shared by all rules and plans of the process
+    :param pattern: str
+    :return: compiled pattern
+    :exception: re.error
+    """
+    return re.compile(pattern, re.UNICODE | re.IGNORECASE)
+
+
+def apply_regex(regex, sub, value):
+    """
+    Extract first match of regex from value and replace it by sub if sub is specified.
+    Value is returned as is if there is no match, lists are processed item by item
+    """
+    if isinstance(value, (list, tuple)):
+        return [apply_regex(regex, sub, item) for item in value]
+    extracted = regex.search(value)
+    value = extracted.group(0) if extracted else value
+    if sub:
+        value = regex.sub(sub, value)
+    return value
+
+
+_LITERAL = re.compile(r'"[^"]*"|\'[^\']*\'')
+_NUMERIC = re.compile(r'^[\d\s.+\-*()]+$')
+_NUMERIC_CALL = re.compile(r'^\s*(count|string-length|sum|number|floor|ceiling|round)\s*\([^=<>]*$')
+_CONTEXT_DEPENDENT = re.compile(r'position\s*\(|last\s*\(|\.\.|(?<![\w.)\]@*/])/|\$')
+_AXIS = re.compile(r'([\w-]+)\s*::')
+_STREAMING_AXES = ('child', 'descendant', 'descendant-or-self', 'self', 'attribute')
+
+
+def _predicates(step):
+    """
+    Split step into node test and top level predicates, literals are replaced by empty ones
+    :return: node test, list of predicates or None if brackets are not balanced
+    """
+    step = _LITERAL.sub('""', step)
+    test, predicates, depth, start = None, [], 0, 0
+    for position, char in enumerate(step):
+        if char == '[':
+            if depth == 0:
+                test = step[:position] if test is None else test
+                start = position + 1
+            depth += 1
+        elif char == ']':
+            depth -= 1
+            if depth < 0:
+                return None, None
+            if depth == 0:
+                predicates.append(step[start:position])
+        elif depth == 0 and test is not None:
+            return None, None
+    if depth != 0:
+        return None, None
+    return (step if test is None else test), predicates
+
+
+StreamingTest = namedtuple('StreamingTest', ('node', 'element', 'at_start'))
+
+_CALL = re.compile(r'([\w-]+)\s*\(\s*(\))?')
+_CONSTANT_CALLS = ('true', 'false')
+
+
+def _attributes_only(predicates):
+    """
+    Check whether predicates look at attributes of the element only, so they can be checked as soon as
+    the element is opened. Anything unknown is treated as a reference to content
+    """
+    for predicate in predicates:
+        predicate = _LITERAL.sub('', predicate)
+        for match in _CALL.finditer(predicate):
+            # calls without arguments (text(), string(), normalize-space()) use content of the element
+            if match.group(2) and match.group(1) not in _CONSTANT_CALLS:
+                return False
+        rest = re.sub(r'@[\w:-]+', '', predicate)
+        rest = _CALL.sub('', rest)
+        rest = re.sub(r'\b(and|or|div|mod)\b|\d+(\.\d+)?', '', rest)
+        if re.search(r'[\w.*/:]', rest):
+            return False
+    return True
+
+
+def _streaming_test(xpath):
+    """
+    Build tests which check whether single element is selected by xpath.
+    Only a descendant search of one location step (e.g. //div[@class="card"]) can be checked
+    by an element itself when it is closed. Predicates may look at attributes and content of the element only:
+    positional predicates ([1], [last()]), references to parent, siblings, following or preceding nodes,
+    absolute paths and variables depend on the whole document
+    :param xpath: source of xpath
+    :return: StreamingTest of node test, test of the whole step and whether the whole step can be checked
+             when the element is opened (predicates look at attributes only), or None
+    """
+    if not xpath.startswith('//'):
+        return None
+    step = xpath[2:]
+    test, predicates = _predicates(step)
+    if not test or not re.match(r'^[\w*-]+(:[\w*-]+)?$', test.strip()):
+        return None
+    for predicate in predicates:
+        if not predicate.strip() or _NUMERIC.match(predicate) or _NUMERIC_CALL.match(predicate) \
+                or _CONTEXT_DEPENDENT.search(predicate.strip()):
+            return None
+        if any(axis not in _STREAMING_AXES for axis in _AXIS.findall(predicate)):
+            return None
+    try:
+        return StreamingTest(etree.XPath('self::' + test.strip()), etree.XPath('self::' + step),
+                             _attributes_only(predicates))
+    except etree.XPathSyntaxError:
+        return None
+
+
+class Step(namedtuple('Step', ('id', 'name', 'xpath', 'regex', 'sub', 'convert', 'children', 'depth',
+                               'source'))):
+    """
+    Compiled form of a single rule.
+    xpath and regex are precompiled, convert is the converter of the rule type (own instance per step),
+    children are indexes of child steps in the plan, depth is the level of the rule in the tree,
+    source keeps (xpath, regex, type name) the step was compiled from
+    """
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, id, name, xpath, regex, sub, typeof, children, depth):
+        source = (xpath, regex, typeof)
+        try:
+            compiled_xpath = etree.XPath(xpath, smart_strings=False)
+        except etree.XPathSyntaxError as err:
+            LOG.warning('Could not compile xpath of rule "%s" (id=%s): %s', name, id, err)
+            compiled_xpath = _failing(err)
+        compiled_regex = None
+        if regex:
+            try:
+                compiled_regex = compile_regex(regex)
+            except re.error as err:
+                # broken rule fails on every element as Rule.apply does
+                LOG.warning('Could not compile regex of rule "%s" (id=%s): %s', name, id, err)
+                compiled_xpath = _failing(err)
+        return cls(id, name, compiled_xpath, compiled_regex, sub, get_converter(typeof), tuple(children), depth, source)
+
+    def __reduce__(self):
+        xpath, regex, typeof = self.source
+        return self.build, (self.id, self.name, xpath, regex, self.sub, typeof, self.children, self.depth)
+
+    def apply(self, element):
+        res = self.xpath(element)
+        if self.regex is not None:
+            res = apply_regex(self.regex, self.sub, res)
+        return self.convert(res)
+
+
+class ExecutionPlan:
+    """
+    Flat immutable representation of a rule tree.
+    Steps are stored in a tuple, a tree structure is kept by indexes of children,
+    so the plan is compiled once and can be executed for any amount of documents.
+    """
+    __slots__ = ('steps', 'roots', 'version')
+
+    def __init__(self, steps, roots, version):
+        super().__setattr__('steps', tuple(steps))
+        super().__setattr__('roots', tuple(roots))
+        super().__setattr__('version', version)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % (self.__class__.__name__,))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __repr__(self):
+        return '<%s: steps="%s" version="%s">' % (self.__class__.__name__, len(self.steps), self.version,)
+
+    @staticmethod
+    def signature(rules):
+        """
+        Return hashable description of rules which changes whenever any rule affecting result changes
+        :param rules: iterable of leoparser.models.Rule
+        :return: tuple
+        """
+        return tuple((rule.id, rule.name, rule.xpath, rule.regex, rule.sub, rule.typeof.name, rule.parent_id)
+                     for rule in rules)
+
+    @classmethod
+    def compile(cls, rules):
+        """
+        Build plan from rules.
+        Order of rules is kept, so roots and children are visited in the same order as Parser.go_through does.
+        :param rules: iterable of leoparser.models.Rule with loaded typeof
+        :return: ExecutionPlan
+        """
+        rules = list(rules)
+        signature = cls.signature(rules)
+        with _compiled_lock:
+            plan = _compiled.get(signature)
+            if plan is not None:
+                _compiled.move_to_end(signature)
+                return plan
+        plan = cls._compile(rules, cls.version_of(signature))
+        with _compiled_lock:
+            _compiled[signature] = plan
+            while len(_compiled) > PLAN_CACHE_SIZE:
+                _compiled.popitem(last=False)
+        return plan
+
+    @staticmethod
+    def version_of(signature):
+        """
+        Return digest of signature, it is the same in every process unlike hash of the signature
+        """
+        return hashlib.sha1(repr(signature).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _compile(cls, rules, version):
+        positions = {rule.id: index for index, rule in enumerate(rules)}
+        children = {rule.id: [] for rule in rules}
+        roots = []
+        for rule in rules:
+            if rule.parent_id is None:
+                roots.append(positions[rule.id])
+            elif rule.parent_id in children:
+                children[rule.parent_id].append(positions[rule.id])
+        depths = {}
+        level, pending = 0, [rules[index] for index in roots]
+        while pending:
+            depths.update((rule.id, level) for rule in pending)
+            level, pending = level + 1, [rules[index] for rule in pending for index in children[rule.id]]
+        steps = [Step.build(rule.id, rule.name, rule.xpath, rule.regex, rule.sub, rule.typeof.name,
+                            children[rule.id], depths.get(rule.id, 0)) for rule in rules]
+        return cls(steps, roots, version)
+
+    def __reduce__(self):
+        return self.__class__, (self.steps, self.roots, self.version)
+
+    def execute(self, html, hook=None):
+        """
+        Apply plan to parsed html
+        :param html: lxml.html.HtmlElement
+        :param hook: callable(step, elapsed, result, error) called after every application of a rule.
+                     Without hook rules are applied directly, so there is no overhead at all.
+        :return: dict
+        """
+        apply = Step.apply if hook is None else self._traced(hook)
+        doc = dict()
+        for index in self.roots:
+            self._execute_step(index, html, doc, apply)
+        return doc
+
+    @staticmethod
+    def _traced(hook):
+        timer = time.perf_counter
+
+        def apply(step, element):
+            started = timer()
+            try:
+                result = step.apply(element)
+            except Exception as err:
+                hook(step, timer() - started, None, err)
+                raise
+            hook(step, timer() - started, result, None)
+            return result
+        return apply
+
+    def _execute_step(self, index, html, doc, apply):
+        step = self.steps[index]
+        try:
+            result = apply(step, html)
+        except Exception:
+            result = ERROR
+        if isinstance(result, (list, tuple)):
+            for position, piece_of_result in enumerate(result):
+                if isinstance(piece_of_result, lxml.html.HtmlElement):
+                    context_doc = dict()
+                    doc[step.name + '_' + str(position)] = context_doc
+                    context_html = piece_of_result
+                else:
+                    doc.setdefault(step.name, dict()).update({position: piece_of_result})
+                    context_doc = doc[step.name]
+                    context_html = html
+                for child in step.children:
+                    self._execute_step(child, context_html, context_doc, apply)
+        else:
+            if isinstance(result, lxml.html.HtmlElement):
+                context_doc = dict()
+                doc[step.name] = context_doc
+                context_html = result
+            else:
+                doc[step.name] = result
+                context_doc = doc
+                context_html = html
+            for child in step.children:
+                self._execute_step(child, context_html, context_doc, apply)
+
+    def execute_stream(self, chunks, encoding=None, hook=None):
+        """
+        Parse html incrementally.
+        If every root rule is a container of form //step without regex (see _streaming_test), rules are checked
+        against every element as soon as it is closed, children of a matched rule are applied to the element
+        and the element is dropped from the tree unless it is inside another element which may still match,
+        so peak memory is about one element instead of the whole page.
+        Otherwise the whole document is parsed and executed as by execute.
+        Result is the same as of execute in both cases, results of a rule are yielded in document order.
+        Children of streamed rules must use relative xpath (.//span), the tree outside of the element
+        is incomplete while the element is processed.
+        :param chunks: iterable of bytes or str, e.g. response.iter_content(chunk_size)
+        :param encoding: encoding of bytes, detected by parser by default
+        :param hook: see ExecutionPlan.execute
+        :return: generator of (key, value) pairs
+        """
+        apply = Step.apply if hook is None else self._traced(hook)
+        streamed = []
+        for index in self.roots:
+            step = self.steps[index]
+            test = None
+            if step.regex is None and step.source[2] == CONTAINER:
+                test = _streaming_test(step.source[0])
+            if test is None:
+                break
+            streamed.append((step, test))
+        else:
+            for result in _Stream(self, streamed, apply).run(chunks, encoding):
+                yield result
+            return
+
+        parser = lxml.html.HTMLParser(encoding=encoding)
+        for chunk in chunks:
+            parser.feed(chunk)
+        root = parser.close()
+        if root is not None:
+            for result in self.execute(root, hook).items():
+                yield result
+
+    def execute_many(self, contents, workers=None, ordered=True):
+        """
+        Parse many documents in pool of processes.
+        Plan is sent to every worker once, documents are sent one by one and not more than
+        two documents per worker are in progress at the same time, so contents may be a lazy iterable.
+        :param contents: iterable of html
+        :param workers: amount of processes, amount of CPUs by default, in case of 1 documents are parsed in place
+        :param ordered: yield results in order of contents, otherwise as soon as document is parsed
+        :return: generator of (index, doc) pairs, in case of failure exception is returned instead of doc
+        """
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            for index, content in enumerate(contents):
+                try:
+                    yield index, self.execute(lxml.html.document_fromstring(content))
+                except Exception as err:
+                    yield index, err
+            return
+
+        backlog = workers * 2
+        contents = enumerate(contents)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,)) as executor:
+            if ordered:
+                pending = deque()
+                for index, content in contents:
+                    pending.append((index, executor.submit(_parse_in_worker, content)))
+                    if len(pending) >= backlog:
+                        yield _result(*pending.popleft())
+                while pending:
+                    yield _result(*pending.popleft())
+            else:
+                pending = {}
+                for index, content in contents:
+                    pending[executor.submit(_parse_in_worker, content)] = index
+                    if len(pending) >= backlog:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield _result(pending.pop(future), future)
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield _result(pending.pop(future), future)
+
+
+class _Candidate:
+    """
+    Open element which is selected or may be selected by a streamed rule.
+    matches keeps for every rule True, False or None if it is known only when the element is closed
+    """
+    __slots__ = ('element', 'matches', 'results')
+
+    def __init__(self, element, matches):
+        self.element = element
+        self.matches = matches
+        self.results = None
+
+
+class _Stream:
+    """
+    State of ExecutionPlan.execute_stream.
+    Candidates are kept in order of their start tags and results are released in this order,
+    so an element enclosing another one is reported first as by xpath. Matched elements are dropped
+    only when no candidate is open, enclosing elements are complete when their rules are applied
+    """
+
+    def __init__(self, plan, streamed, apply):
+        self.plan = plan
+        self.streamed = streamed
+        self.apply = apply
+        self.open = []
+        self.pending = deque()
+        self.kept = []
+        # the first result is held back, a single match is not indexed as in execute
+        self.counters = [0] * len(streamed)
+        self.first = [None] * len(streamed)
+
+    def run(self, chunks, encoding):
+        parser = etree.HTMLPullParser(events=('start', 'end'), encoding=encoding)
+        parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+        for chunk in chunks:
+            parser.feed(chunk)
+            for result in self._events(parser):
+                yield result
+        parser.close()
+        for result in self._events(parser):
+            yield result
+        for position, (step, _) in enumerate(self.streamed):
+            if self.counters[position] == 1:
+                yield step.name, self.first[position]
+
+    def _events(self, parser):
+        for event, element in parser.read_events():
+            if event == 'start':
+                self._start(element)
+            else:
+                for result in self._end(element):
+                    yield result
+
+    def _start(self, element):
+        matches = []
+        for step, test in self.streamed:
+            if not test.node(element):
+                matches.append(False)
+            elif test.at_start:
+                matches.append(bool(test.element(element)))
+            else:
+                matches.append(None)
+        if any(match is not False for match in matches):
+            candidate = _Candidate(element, matches)
+            self.open.append(candidate)
+            self.pending.append(candidate)
+
+    def _end(self, element):
+        if self.open and self.open[-1].element is element:
+            candidate = self.open.pop()
+            candidate.results = []
+            for position, (step, test) in enumerate(self.streamed):
+                match = candidate.matches[position]
+                if match or (match is None and test.element(element)):
+                    doc = dict()
+                    for child in step.children:
+                        self.plan._execute_step(child, element, doc, self.apply)
+                    candidate.results.append((position, doc))
+            if candidate.results:
+                self.kept.append(element)
+            candidate.element = None
+        while self.pending and self.pending[0].results is not None:
+            for position, doc in self.pending.popleft().results:
+                for result in self._emit(position, doc):
+                    yield result
+        if not self.open and self.kept:
+            for kept in self.kept:
+                parent = kept.getparent()
+                kept.clear()
+                if parent is not None:
+                    parent.remove(kept)
+            self.kept = []
+
+    def _emit(self, position, doc):
+        name = self.streamed[position][0].name
+        count = self.counters[position]
+        if count == 0:
+            self.first[position] = doc
+        else:
+            if count == 1:
+                yield name + '_0', self.first[position]
+                self.first[position] = None
+            yield name + '_' + str(count), doc
+        self.counters[position] = count + 1
+
+
+def _result(index, future):
+    try:
+        return index, future.result()
+    except Exception as err:
+        return index, err
+
+
+# plan of the current worker process, see ExecutionPlan.execute_many
+_worker_plan = None
+
+
+def _init_worker(plan):
+    global _worker_plan
+    _worker_plan = plan
+
+
+def _parse_in_worker(content):
+    return _worker_plan.execute(lxml.html.document_fromstring(content))
+
+
+# compiled plans by signature of rule set, the least recently used plan is evicted first
+_compiled = OrderedDict()
+_compiled_lock = threading.Lock()
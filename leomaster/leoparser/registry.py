@@ -0,0 +1,68 @@
+import logging
+import threading
+
+from leoparser.models import Parser
+
+LOG = logging.getLogger(__name__)
+
+
+class ParserRegistry:
+    """
+    Process wide cache of parsers by name.
+    Rules and compiled plan of a parser are loaded once and kept until version of the parser is changed.
+    Version is increased by signals on any change of Rule, Parser or TypeOf,
+    so it is enough to select a single integer to find out whether cached parser is stale.
+    """
+
+    def __init__(self):
+        self._parsers = {}
+        self._lock = threading.Lock()
+
+    def version(self, name):
+        """
+        Return current version of parser
+        :param name: name of parser
+        :return: int
+        :exception: Parser.DoesNotExist
+        """
+        version = Parser.objects.filter(name=name).values_list('version', flat=True).first()
+        if version is None:
+            raise Parser.DoesNotExist('Parser "%s" does not exist' % (name,))
+        return version
+
+    def get(self, name, check=True):
+        """
+        Return parser with loaded rules and compiled plan
+        :param name: name of parser
+        :param check: compare cached version with database, otherwise only local invalidation is taken into account
+        :return: Parser
+        :exception: Parser.DoesNotExist
+        """
+        parser = self._parsers.get(name)
+        if parser is not None and (not check or parser.version == self.version(name)):
+            return parser
+        with self._lock:
+            parser = Parser.objects.get(name=name)
+            LOG.info('Loading rules of parser "%s" (version=%s)', name, parser.version)
+            parser.plan
+            self._parsers[name] = parser
+        return parser
+
+    def invalidate(self, name=None):
+        """
+        Drop cached parser, all parsers are dropped if name is not specified
+        """
+        with self._lock:
+            if name is None:
+                self._parsers.clear()
+            else:
+                self._parsers.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self._parsers
+
+    def __len__(self):
+        return len(self._parsers)
+
+
+registry = ParserRegistry()
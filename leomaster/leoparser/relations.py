@@ -0,0 +1,226 @@
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+
+LOG = logging.getLogger(__name__)
+
+CACHE_SIZE = 1024
+CACHE_TTL = 300
+
+
+class RelatedCache:
+    """
+    Process wide LRU cache of related instances resolved by mapping of documents (see GenericDocument._map_to_field).
+    Key is (related model, frozen lookup), entries expire after LEOPARSER_RELATED_CACHE_TTL seconds.
+    Entries of a model are dropped when any instance of the model is changed or deleted.
+    Instances are published to the cache only when the transaction they are resolved in is committed,
+    so rolled back rows are never cached, and instances still waiting for commit when their model is invalidated
+    are not published at all.
+    Invalidation is done by signals of the current process only, other processes keep changed or deleted
+    instances up to LEOPARSER_RELATED_CACHE_TTL seconds, so a document mapped there to a deleted instance
+    fails to save with an integrity error until the entry expires
+    """
+
+    def __init__(self, size=None, ttl=None):
+        self._size = size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._models = set()
+        # generation of a model is changed by invalidation, pending instances of older generations are not published
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size(self):
+        return self._size if self._size is not None else getattr(settings, 'LEOPARSER_RELATED_CACHE_SIZE', CACHE_SIZE)
+
+    @property
+    def ttl(self):
+        return self._ttl if self._ttl is not None else getattr(settings, 'LEOPARSER_RELATED_CACHE_TTL', CACHE_TTL)
+
+    @staticmethod
+    def key(model, lookup):
+        """
+        Return key of lookup or None if lookup is not hashable
+        """
+        try:
+            return model, frozenset(lookup.items())
+        except TypeError:
+            return None
+
+    def get(self, key):
+        overlay = getattr(self._local, 'overlay', None)
+        if overlay is not None and key in overlay:
+            return overlay[key]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            instance, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return instance
+
+    def set(self, key, instance):
+        overlay = getattr(self._local, 'overlay', None)
+        if overlay is not None:
+            overlay[key] = instance
+        with self._lock:
+            generation = self._generations.setdefault(key[0], 0)
+        transaction.on_commit(lambda: self._publish(key, instance, generation))
+
+    def _publish(self, key, instance, generation):
+        with self._lock:
+            if self._generations.get(key[0]) != generation:
+                return
+            self._entries[key] = instance, time.monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            self._models.add(key[0])
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def get_or_create(self, model, lookup):
+        """
+        Resolve related instance as model.objects.get_or_create(**lookup) does
+        :return: instance
+        :exception: FieldError, MultipleObjectsReturned
+        """
+        key = self.key(model, lookup)
+        if key is not None:
+            instance = self.get(key)
+            if instance is not None:
+                return instance
+        instance, _ = model.objects.get_or_create(**lookup)
+        if key is not None:
+            self.set(key, instance)
+        return instance
+
+    @contextmanager
+    def batch(self):
+        """
+        Keep instances resolved in block available for the block even before they are published,
+        see prefetch
+        """
+        if getattr(self._local, 'overlay', None) is not None:
+            yield
+            return
+        self._local.overlay = {}
+        try:
+            yield
+        finally:
+            self._local.overlay = None
+
+    def prefetch(self, model, lookups):
+        """
+        Resolve many lookups of a model by one select and one bulk insert of missing instances.
+        Lookups which are not plain field values or which match several instances are left
+        for get_or_create, so errors are reported in the same way
+        :param model: related model
+        :param lookups: iterable of dicts
+        """
+        groups = {}
+        for lookup in lookups:
+            key = self.key(model, lookup)
+            if key is None or self.get(key) is not None:
+                continue
+            normalized = self._normalize(model, lookup)
+            if normalized is not None:
+                groups.setdefault(tuple(sorted(normalized)), {})[frozenset(normalized.items())] = key, lookup
+        if not groups:
+            return
+
+        query = Q()
+        for pending in groups.values():
+            for frozen in pending:
+                query |= Q(**dict(frozen))
+        found = {}
+        for instance in model.objects.filter(query):
+            for names, pending in groups.items():
+                frozen = frozenset((name, getattr(instance, name)) for name in names)
+                if frozen in pending:
+                    found.setdefault(pending[frozen][0], []).append(instance)
+
+        missing = []
+        for pending in groups.values():
+            for key, lookup in pending.values():
+                instances = found.get(key)
+                if instances is None:
+                    missing.append((key, model(**lookup)))
+                elif len(instances) == 1:
+                    self.set(key, instances[0])
+        if missing:
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create([instance for _, instance in missing])
+            except (IntegrityError, ValueError) as err:
+                LOG.warning('Could not create instances of "%s" in bulk, they will be created one by one: %s',
+                            model.__name__, err)
+                return
+            for key, instance in missing:
+                self.set(key, instance)
+
+    @staticmethod
+    def _normalize(model, lookup):
+        normalized = {}
+        for name, value in lookup.items():
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            if field.is_relation or not field.concrete:
+                return None
+            try:
+                normalized[field.attname] = field.to_python(value)
+            except ValidationError:
+                return None
+        return normalized
+
+    def invalidate(self, model=None):
+        """
+        Drop entries of model and its instances waiting for commit, all entries if model is not specified
+        """
+        overlay = getattr(self._local, 'overlay', None)
+        if overlay:
+            for key in [key for key in overlay if model is None or key[0] is model]:
+                del overlay[key]
+        with self._lock:
+            if model is None:
+                self._entries.clear()
+                self._models.clear()
+                for each in self._generations:
+                    self._generations[each] += 1
+                return
+            if model in self._generations:
+                self._generations[model] += 1
+            if model in self._models:
+                for key in [key for key in self._entries if key[0] is model]:
+                    del self._entries[key]
+                self._models.discard(model)
+
+    def __contains__(self, model):
+        return model in self._generations
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '<%s: entries="%s" hits="%s" misses="%s">' % (self.__class__.__name__, len(self._entries),
+                                                             self.hits, self.misses,)
+
+
+related_cache = RelatedCache()
@@ -1,17 +1,82 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
-from leoparser.models import Document, DocDelta, RemovableHistoryDocument
+from leoparser.models import Document, DocDelta, RemovableHistoryDocument, Parser, Rule, TypeOf
+from leoparser.registry import registry
+from leoparser.relations import related_cache
 
 
 @receiver(post_save, sender=Document)
 def save_document_delta(sender, instance, **kwargs):
     delta = list(instance.delta)
     if delta:
-        DocDelta.objects.create(base=instance, delta=delta)
+        DocDelta.objects.record(base=instance, delta=delta)
 
 
 @receiver(post_save, sender=RemovableHistoryDocument)
 def save_removable_history_document_delta(sender, instance, **kwargs):
     delta = list(instance.delta)
     if delta:
-        DocDelta.objects.create(base=instance, delta=delta)
+        DocDelta.objects.record(base=instance, delta=delta)
+
+
+@receiver(post_save, sender=Parser)
+def invalidate_saved_parser(sender, instance, raw=False, **kwargs):
+    if not raw:
+        Parser.bump_version(Parser.objects.filter(pk=instance.pk))
+    registry.invalidate(instance.name)
+
+
+@receiver(post_delete, sender=Parser)
+def invalidate_deleted_parser(sender, instance, **kwargs):
+    registry.invalidate(instance.name)
+
+
+@receiver(post_save, sender=Rule)
+def invalidate_parsers_of_saved_rule(sender, instance, raw=False, **kwargs):
+    if not raw:
+        Parser.bump_version(Parser.objects.filter(rule_set=instance))
+    registry.invalidate()
+
+
+@receiver(pre_delete, sender=Rule)
+def invalidate_parsers_of_deleted_rule(sender, instance, **kwargs):
+    # relations to parsers do not exist anymore after deletion
+    Parser.bump_version(Parser.objects.filter(rule_set=instance))
+    registry.invalidate()
+
+
+@receiver(post_save, sender=TypeOf)
+@receiver(post_delete, sender=TypeOf)
+def invalidate_parsers_of_type(sender, instance, raw=False, **kwargs):
+    if not raw:
+        Parser.bump_version(Parser.objects.filter(rule_set__typeof=instance))
+    registry.invalidate()
+
+
+@receiver(m2m_changed, sender=Parser.rule_set.through)
+def invalidate_parsers_of_changed_rule_set(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        instance._cleared_parsers = list(Parser.objects.filter(rule_set=instance).values_list('id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        parsers = Parser.objects.filter(pk=instance.pk)
+    elif action == 'post_clear':
+        parsers = Parser.objects.filter(pk__in=getattr(instance, '_cleared_parsers', []))
+    else:
+        parsers = Parser.objects.filter(pk__in=pk_set or [])
+    Parser.bump_version(parsers)
+    registry.invalidate()
+
+
+@receiver(post_save)
+def invalidate_related_cache_of_saved(sender, instance, created=False, **kwargs):
+    # new instances can not make cached ones stale
+    if not created and sender in related_cache:
+        related_cache.invalidate(sender)
+
+
+@receiver(post_delete)
+def invalidate_related_cache_of_deleted(sender, instance, **kwargs):
+    if sender in related_cache:
+        related_cache.invalidate(sender)
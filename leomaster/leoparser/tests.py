@@ -1,9 +1,61 @@
+import io
+import json
 import mock
-from django.test import TestCase
+import hashlib
+import pickle
+import datetime
+import tempfile
+from django.test import TestCase, override_settings
+from django.core.exceptions import ValidationError
+from django.core.management import call_command, CommandError
 from django.utils import timezone
+from django.db.models.signals import post_save
 from dictdiffer import diff, patch
 from dateutil.relativedelta import *
-from leoparser.models import Document, RemovableHistoryDocument, DocDelta, TestMappingDocument, TestRelatedModel
+from leoparser.models import Document, RemovableHistoryDocument, DocDelta, DocSnapshot
+from leoparser.models import TestMappingDocument, TestRelatedModel
+from leoparser.models import Parser, Rule, TypeOf, content_fingerprint
+from leoparser.compaction import compact_history, expire_history
+from leoparser.diff import diff as fast_diff
+from leoparser.relations import RelatedCache, related_cache
+
+PAGE = '''
+<html>
+  <body>
+    <h1>Masterclasses</h1>
+    <div class="card">
+      <h2>Painting</h2>
+      <span class="seats">3</span>
+      <span class="price">1500 rub.</span>
+    </div>
+    <div class="card">
+      <h2>Knitting</h2>
+      <span class="seats">0</span>
+      <span class="price">700 rub.</span>
+    </div>
+  </body>
+</html>
+'''
+
+
+class ParserTestMixin:
+
+    def create_parser(self, name='parser'):
+        types = {name: TypeOf.objects.create(name=name) for name, _ in TypeOf.options}
+        card = Rule.objects.create(name='card', xpath='//div[@class="card"]', typeof=types[TypeOf.T_CONTAINER])
+        rules = [
+            Rule.objects.create(name='header', xpath='//h1/text()', typeof=types[TypeOf.T_STRING]),
+            card,
+            Rule.objects.create(name='title', xpath='.//h2/text()', typeof=types[TypeOf.T_STRING], parent=card),
+            Rule.objects.create(name='seats', xpath='.//span[@class="seats"]/text()',
+                                typeof=types[TypeOf.T_INTEGER], parent=card),
+            Rule.objects.create(name='price', xpath='string(.//span[@class="price"])', regex=r'\d+',
+                                typeof=types[TypeOf.T_INTEGER], parent=card),
+            Rule.objects.create(name='broken', xpath='.//span[', typeof=types[TypeOf.T_STRING], parent=card),
+        ]
+        parser = Parser.objects.create(name=name)
+        parser.rule_set.set(rules)
+        return Parser.objects.get(name=name)
 
 
 class TestDictdiffer(TestCase):
@@ -599,3 +651,1000 @@ class TestFieldMapping(TestCase):
         related = TestRelatedModel.objects.all()
         self.assertEqual(2, len(related))
         self.assertIsNone(doc.related)
+
+    def test_mapping_plan(self):
+        plan = {item.path: item for item in TestMappingDocument._mapping_plan}
+        self.assertEqual(('date', 'field'), plan['date.field'].keys)
+        self.assertIs(TestMappingDocument._meta.get_field('date'), plan['date.field'].field)
+        self.assertTrue(plan['nested'].is_foreign_key)
+        self.assertFalse(plan['date.field'].is_foreign_key)
+        self.assertIs(TestMappingDocument._meta.get_field('related'), TestMappingDocument.get_field_by_name('related'))
+        self.assertIsNone(TestMappingDocument.get_field_by_name('missing'))
+
+    def test_mapping_does_not_resolve_fields(self):
+        with mock.patch.object(TestMappingDocument, 'get_field_by_name', side_effect=AssertionError):
+            doc, _, _ = TestMappingDocument.history.save({'date': {'field': timezone.now()}})
+        self.assertIsNotNone(doc.date)
+
+
+class TestRelatedCache(TestCase):
+
+    def setUp(self):
+        # test case is never committed, publish cached instances immediately
+        patcher = mock.patch('leoparser.relations.transaction.on_commit', side_effect=lambda func, using=None: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        related_cache.invalidate()
+        self.addCleanup(related_cache.invalidate)
+
+    def test_resolved_once(self):
+        content = {'nested': {'name': 'name', 'title': 'title'}}
+        first, _, _ = TestMappingDocument.history.save(dict(content, uid='1'))
+        with mock.patch.object(TestRelatedModel.objects, 'get_or_create', side_effect=AssertionError):
+            second, _, _ = TestMappingDocument.history.save(dict(content, uid='2'))
+        self.assertEqual(first.related_id, second.related_id)
+        self.assertEqual(1, TestRelatedModel.objects.count())
+
+    def test_invalidated_on_save_and_delete(self):
+        instance = TestRelatedModel.objects.create(name='name', title='title')
+        related_cache.get_or_create(TestRelatedModel, {'name': 'name'})
+        self.assertEqual(1, len(related_cache))
+        TestRelatedModel.objects.create(name='other', title='title')
+        self.assertEqual(1, len(related_cache))
+        instance.save()
+        self.assertEqual(0, len(related_cache))
+
+        related_cache.get_or_create(TestRelatedModel, {'name': 'name'})
+        instance.delete()
+        self.assertEqual(0, len(related_cache))
+        self.assertNotEqual(instance.pk, related_cache.get_or_create(TestRelatedModel, {'name': 'name'}).pk)
+
+    def test_pending_instance_is_not_published_after_invalidation(self):
+        instance = TestRelatedModel.objects.create(name='name', title='title')
+        callbacks = []
+        with mock.patch('leoparser.relations.transaction.on_commit', side_effect=callbacks.append):
+            related_cache.get_or_create(TestRelatedModel, {'name': 'name'})
+        instance.delete()
+        for callback in callbacks:
+            callback()
+        self.assertEqual(0, len(related_cache))
+
+        related_cache.get_or_create(TestRelatedModel, {'name': 'name'})
+        self.assertEqual(1, len(related_cache))
+
+    def test_expiration_and_size(self):
+        cache = RelatedCache(size=2, ttl=10)
+        with mock.patch('leoparser.relations.time.monotonic', return_value=100):
+            for name in ('a', 'b', 'c'):
+                cache.get_or_create(TestRelatedModel, {'name': name})
+            self.assertEqual(2, len(cache))
+            self.assertIsNone(cache.get(cache.key(TestRelatedModel, {'name': 'a'})))
+            self.assertIsNotNone(cache.get(cache.key(TestRelatedModel, {'name': 'c'})))
+        with mock.patch('leoparser.relations.time.monotonic', return_value=111):
+            self.assertIsNone(cache.get(cache.key(TestRelatedModel, {'name': 'c'})))
+
+    def test_unhashable_lookup_is_not_cached(self):
+        self.assertIsNone(RelatedCache.key(TestRelatedModel, {'name': ['a']}))
+
+    def test_save_many_resolves_in_bulk(self):
+        TestRelatedModel.objects.create(name='existing', title='title')
+        contents = [{'uid': str(i), 'nested': {'name': name, 'title': 'title'}}
+                    for i, name in enumerate(['existing', 'new', 'new', 'other'] * 5)]
+        with mock.patch.object(TestRelatedModel.objects, 'get_or_create', side_effect=AssertionError):
+            results = TestMappingDocument.history.save_many(contents)
+        self.assertEqual(3, TestRelatedModel.objects.count())
+        for content, (doc, _, _) in zip(contents, results):
+            self.assertEqual(content['nested']['name'], doc.related.name)
+            self.assertEqual(content['nested']['name'], TestMappingDocument.objects.get(id=doc.id).related.name)
+        self.assertEqual(3, len(related_cache))
+
+    def test_save_many_queries_do_not_depend_on_related_values(self):
+        contents = [{'uid': str(i), 'nested': {'name': str(i), 'title': 'title'}} for i in range(10)]
+        with self.assertNumQueries(9):
+            TestMappingDocument.history.save_many(contents)
+
+    def test_save_many_keeps_errors(self):
+        TestRelatedModel.objects.create(name='name', title='title_1')
+        TestRelatedModel.objects.create(name='name', title='title_2')
+        contents = [{'uid': '1', 'nested': {'name': 'name'}}, {'uid': '2', 'nested': {'name': 'x', 'broken': 1}}]
+        results = TestMappingDocument.history.save_many(contents)
+        self.assertIsNone(results[0][0].related)
+        self.assertIsNone(results[1][0].related)
+        self.assertEqual(2, TestRelatedModel.objects.count())
+
+    def test_rolled_back_instances_are_not_cached(self):
+        patcher = mock.patch('leoparser.relations.transaction.on_commit')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        TestMappingDocument.history.save_many([{'uid': '1', 'nested': {'name': 'name', 'title': 'title'}}])
+        self.assertEqual(0, len(related_cache))
+
+
+class TestCompiledParser(ParserTestMixin, TestCase):
+
+    def setUp(self):
+        self.parser = self.create_parser()
+
+    def test_parse(self):
+        doc = self.parser.parse(PAGE)
+        self.assertEqual({
+            'header': 'Masterclasses',
+            'card_0': {'title': 'Painting', 'seats': 3, 'price': 1500, 'broken': '__error__'},
+            'card_1': {'title': 'Knitting', 'seats': 0, 'price': 700, 'broken': '__error__'},
+        }, doc)
+
+    def test_parse_equals_go_through(self):
+        import lxml.html
+        expected = dict()
+        self.parser.go_through(lxml.html.document_fromstring(PAGE), expected)
+        self.assertEqual(expected, self.parser.parse(PAGE))
+
+    def test_plan_is_reused(self):
+        plan = self.parser.plan
+        self.assertIs(plan, self.parser.plan)
+        self.assertIs(plan, Parser.objects.get(pk=self.parser.pk).plan)
+        self.assertEqual(6, len(plan))
+
+    def test_plan_cache_evicts_least_recently_used(self):
+        from leoparser import plan as plans
+        rules = list(self.parser.rule_set.select_related('typeof').order_by('id'))
+        with mock.patch.object(plans, '_compiled', plans.OrderedDict()), \
+                mock.patch.object(plans, 'PLAN_CACHE_SIZE', 2):
+            first = plans.ExecutionPlan.compile(rules[:1])
+            plans.ExecutionPlan.compile(rules[:2])
+            self.assertIs(first, plans.ExecutionPlan.compile(rules[:1]))
+            plans.ExecutionPlan.compile(rules[:3])
+            self.assertIs(first, plans.ExecutionPlan.compile(rules[:1]))
+            self.assertEqual([plans.ExecutionPlan.signature(rules[:n]) for n in (3, 1)], list(plans._compiled))
+
+    def test_plan_version_is_stable(self):
+        from leoparser.plan import ExecutionPlan
+        signature = ExecutionPlan.signature(self.parser.rules.values())
+        # the same in every process, hash of str is randomized per process
+        self.assertEqual(hashlib.sha1(repr(signature).encode('utf-8')).hexdigest(), self.parser.plan.version)
+
+    def test_plan_is_rebuilt_after_rule_change(self):
+        plan = self.parser.plan
+        Rule.objects.filter(name='seats').update(xpath='.//span[@class="price"]/text()')
+        parser = Parser.objects.get(pk=self.parser.pk)
+        self.assertIsNot(plan, parser.plan)
+        self.assertEqual('__error__', parser.parse(PAGE)['card_0']['seats'])
+
+    def test_tracing(self):
+        with self.parser.tracing() as trace:
+            doc = self.parser.parse(PAGE)
+        self.assertEqual(self.parser.parse(PAGE), doc)
+        self.assertEqual(10, len(trace))
+        self.assertEqual(['card', 'header'], [event.name for event in trace if event.depth == 0])
+        card = [event for event in trace if event.name == 'card'][0]
+        self.assertEqual(2, card.matches)
+        self.assertEqual(2, len(trace.errors))
+        self.assertTrue(all(event.name == 'broken' for event in trace.errors))
+        self.assertIn('|_ card', trace.format())
+
+    def test_tracing_is_off_outside_block(self):
+        with self.parser.tracing() as trace:
+            pass
+        self.parser.parse(PAGE)
+        self.assertEqual(0, len(trace))
+
+    def test_profile(self):
+        report = self.parser.profile(PAGE, repeat=3)
+        self.assertEqual(3, report.documents)
+        self.assertEqual(self.parser.parse(PAGE), report.doc)
+        self.assertEqual(6, len(report))
+        card = report[Rule.objects.get(name='card').id]
+        self.assertEqual(3, card.calls)
+        self.assertEqual(6, card.matches)
+        self.assertEqual(2, card.max_matches)
+        self.assertEqual(0, card.errors)
+        broken = report[Rule.objects.get(name='broken').id]
+        self.assertEqual(6, broken.calls)
+        self.assertEqual(6, broken.errors)
+        self.assertEqual(0, broken.matches)
+
+    def test_profile_parser_command(self):
+        with tempfile.NamedTemporaryFile(suffix='.html') as html_file:
+            html_file.write(PAGE.encode('utf-8'))
+            html_file.flush()
+            out = io.StringIO()
+            call_command('profile_parser', self.parser.name, html_file.name, repeat=2, stdout=out)
+        output = out.getvalue()
+        self.assertIn('documents: 2', output)
+        self.assertIn('//div[@class="card"]', output)
+        self.assertIn(r'string(.//span[@class="price"]) ~ /\d+/', output)
+
+    def test_profile_parser_command_unknown_parser(self):
+        with self.assertRaises(CommandError):
+            call_command('profile_parser', 'unknown', 'page.html')
+
+    def test_plan_is_picklable(self):
+        plan = pickle.loads(pickle.dumps(self.parser.plan))
+        import lxml.html
+        self.assertEqual(self.parser.parse(PAGE), plan.execute(lxml.html.document_fromstring(PAGE)))
+
+    def test_parse_many(self):
+        contents = [PAGE, '', PAGE.replace('Painting', 'Drawing')]
+        expected = self.parser.parse(PAGE)
+        for workers in (1, 2):
+            results = list(self.parser.parse_many(iter(contents), workers=workers))
+            self.assertEqual([0, 1, 2], [index for index, _ in results])
+            self.assertEqual(expected, results[0][1])
+            self.assertIsInstance(results[1][1], Exception)
+            self.assertEqual('Drawing', results[2][1]['card_0']['title'])
+
+    def test_parse_many_unordered(self):
+        results = dict(self.parser.parse_many([PAGE] * 5, workers=2, ordered=False))
+        self.assertEqual([0, 1, 2, 3, 4], sorted(results))
+        self.assertTrue(all(doc == results[0] for doc in results.values()))
+
+    def test_parse_stream(self):
+        chunks = [PAGE[i:i + 16].encode('utf-8') for i in range(0, len(PAGE), 16)]
+        self.assertEqual(self.parser.parse(PAGE), dict(self.parser.parse_stream(iter(chunks))))
+
+    def test_parse_stream_frees_matched_elements(self):
+        import lxml.html
+        from leoparser.plan import ExecutionPlan
+        seen = []
+        original = ExecutionPlan._execute_step
+
+        def execute_step(plan, index, html, doc, apply):
+            if isinstance(html, lxml.html.HtmlElement):
+                seen.append(len(html.getroottree().getroot().xpath('//div[@class="card"]')))
+            return original(plan, index, html, doc, apply)
+
+        self.parser.rule_set.remove(Rule.objects.get(name='header'))
+        parser = Parser.objects.get(name='parser')
+        chunks = [PAGE[i:i + 16] for i in range(0, len(PAGE), 16)]
+        with mock.patch.object(ExecutionPlan, '_execute_step', execute_step):
+            results = list(parser.parse_stream(chunks))
+        self.assertEqual(['card_0', 'card_1'], [key for key, _ in results])
+        # every card is executed while it is the only one in the tree
+        self.assertEqual([1] * 8, seen)
+
+    def test_parse_stream_falls_back_to_parse(self):
+        chunks = [PAGE[i:i + 16] for i in range(0, len(PAGE), 16)]
+        with mock.patch('leoparser.plan._Stream') as stream:
+            results = dict(self.parser.parse_stream(chunks))
+        # header is not a container, so the whole document is parsed
+        stream.assert_not_called()
+        self.assertEqual(self.parser.parse(PAGE), results)
+
+    def test_parse_stream_equals_parse(self):
+        page = '''
+        <html><body>
+          <ul><li>first</li><li>second</li><li>third</li></ul>
+          <ul><li>fourth</li></ul>
+          <div class="card"><h2>Painting</h2></div>
+        </body></html>
+        '''
+        chunks = [page[i:i + 8] for i in range(0, len(page), 8)]
+        xpaths = ['//li', '//li[1]', '//li[last()]', '//li[position() < 3]', '//li[following-sibling::li]',
+                  '//li[preceding::li]', '//ul[li][2]', '//li[.="fourth"]', '//div[@class="card"]',
+                  '//li[count(../li) > 1]']
+        container = TypeOf.objects.get(name=TypeOf.T_CONTAINER)
+        string = TypeOf.objects.get(name=TypeOf.T_STRING)
+        for number, xpath in enumerate(xpaths):
+            with self.subTest(xpath=xpath):
+                root = Rule.objects.create(name='item', xpath=xpath, typeof=container)
+                child = Rule.objects.create(name='text', xpath='string(.)', typeof=string, parent=root)
+                parser = Parser.objects.create(name='stream%s' % (number,))
+                parser.rule_set.set([root, child])
+                self.assertEqual(parser.parse(page), dict(parser.parse_stream(iter(chunks))))
+
+    def create_stream_parser(self, name, *xpaths):
+        container = TypeOf.objects.get(name=TypeOf.T_CONTAINER)
+        string = TypeOf.objects.get(name=TypeOf.T_STRING)
+        rules = []
+        for number, xpath in enumerate(xpaths):
+            root = Rule.objects.create(name='item%s' % (number,), xpath=xpath, typeof=container)
+            rules.extend([root, Rule.objects.create(name='text', xpath='normalize-space(.)', typeof=string,
+                                                    parent=root)])
+        parser = Parser.objects.create(name=name)
+        parser.rule_set.set(rules)
+        return Parser.objects.get(name=name)
+
+    def test_parse_stream_of_nested_elements(self):
+        page = '''
+        <html><body><div class="list">
+          <div class="card">A<div class="card">B<div class="card">C</div></div></div>
+          <div class="card">D</div>
+        </div></body></html>
+        '''
+        chunks = [page[i:i + 8] for i in range(0, len(page), 8)]
+        for number, xpath in enumerate(['//div[@class="card"]', '//div[./div]', '//div[span or div]']):
+            with self.subTest(xpath=xpath):
+                parser = self.create_stream_parser('nested%s' % (number,), xpath)
+                # results are in document order, enclosing elements are complete
+                self.assertEqual(list(parser.parse(page).items()), list(parser.parse_stream(iter(chunks))))
+
+    def test_parse_stream_of_overlapping_roots(self):
+        page = '''
+        <html><body>
+          <div class="card">A</div><div class="card">B<span>x</span></div><span>C</span>
+        </body></html>
+        '''
+        chunks = [page[i:i + 8] for i in range(0, len(page), 8)]
+        parser = self.create_stream_parser('overlapping', '//div[@class="card"]', '//div', '//*[span]')
+        expected = parser.parse(page)
+        self.assertEqual(['item0_0', 'item0_1', 'item1_0', 'item1_1', 'item2_0', 'item2_1'], sorted(expected))
+        self.assertEqual(expected, dict(parser.parse_stream(iter(chunks))))
+
+    def test_streaming_test(self):
+        from leoparser.plan import _streaming_test
+        self.assertIsNotNone(_streaming_test('//div[@class="card"]'))
+        self.assertIsNotNone(_streaming_test('//div[contains(@class, "card")][./h2]'))
+        self.assertIsNotNone(_streaming_test('//div[@title="a/b"]'))
+        self.assertIsNone(_streaming_test('//div[@class="list"]/div'))
+        self.assertIsNone(_streaming_test('//h1/text()'))
+        self.assertIsNone(_streaming_test('.//div'))
+        self.assertIsNone(_streaming_test('//div | //span'))
+        self.assertIsNone(_streaming_test('//li[1]'))
+        self.assertIsNone(_streaming_test('//li[last()]'))
+        self.assertIsNone(_streaming_test('//li[position() < 3]'))
+        self.assertIsNone(_streaming_test('//div[following-sibling::div]'))
+        self.assertIsNone(_streaming_test('//div[../h1]'))
+        self.assertIsNone(_streaming_test('//div[count(span)]'))
+        self.assertTrue(_streaming_test('//div[@class="card" and not(@id)]').at_start)
+        self.assertTrue(_streaming_test('//div[contains(@title, "a/b.c")]').at_start)
+        self.assertFalse(_streaming_test('//div[./h2]').at_start)
+        self.assertFalse(_streaming_test('//div[normalize-space()]').at_start)
+        self.assertFalse(_streaming_test('//div[contains(., "card")]').at_start)
+        self.assertFalse(_streaming_test('//div[span]').at_start)
+
+
+class TestRuleRegex(TestCase):
+
+    def setUp(self):
+        self.typeof = TypeOf.objects.create(name=TypeOf.T_STRING)
+
+    def test_compiled_regex_is_cached(self):
+        rule = Rule(name='rule', xpath='//text()', regex=r'\d+', typeof=self.typeof)
+        compiled = rule.compiled_regex
+        self.assertIs(compiled, rule.compiled_regex)
+        self.assertEqual(r'\d+', compiled.pattern)
+
+    def test_compiled_regex_is_dropped_on_change(self):
+        rule = Rule.objects.create(name='rule', xpath='//text()', regex=r'\d+', typeof=self.typeof)
+        self.assertEqual(r'\d+', rule.compiled_regex.pattern)
+        rule.regex = r'\w+'
+        self.assertEqual(r'\w+', rule.compiled_regex.pattern)
+        rule.regex = ''
+        self.assertIsNone(rule.compiled_regex)
+
+    def test_invalid_regex_is_rejected(self):
+        rule = Rule(name='rule', xpath='//text()', regex=r'(\d+', typeof=self.typeof)
+        with self.assertRaises(ValidationError) as cm:
+            rule.full_clean()
+        self.assertIn('regex', cm.exception.message_dict)
+        with self.assertRaises(ValidationError):
+            rule.save()
+        self.assertFalse(Rule.objects.exists())
+
+    def test_apply_regex_to_list(self):
+        import lxml.html
+        rule = Rule(name='rule', xpath='//span/text()', regex=r'\d+', sub='#', typeof=self.typeof)
+        html = lxml.html.document_fromstring('<div><span>a 1</span><span>b 22</span></div>')
+        self.assertEqual(['#', '#'], rule.apply(html))
+        rule.sub = ''
+        self.assertEqual(['1', '22'], rule.apply(html))
+
+
+class TestParserRegistry(ParserTestMixin, TestCase):
+
+    def setUp(self):
+        from leoparser.registry import ParserRegistry
+        self.registry = ParserRegistry()
+        self.parser = self.create_parser()
+
+    def test_parser_is_cached(self):
+        parser = self.registry.get('parser')
+        self.assertIs(parser, self.registry.get('parser'))
+        with self.assertNumQueries(1):
+            self.assertIs(parser, self.registry.get('parser'))
+        with self.assertNumQueries(0):
+            self.assertIs(parser, self.registry.get('parser', check=False))
+        self.assertEqual(self.parser.parse(PAGE), parser.parse(PAGE))
+
+    def test_unknown_parser(self):
+        with self.assertRaises(Parser.DoesNotExist):
+            self.registry.get('unknown')
+
+    def test_children_are_built(self):
+        parser = self.registry.get('parser')
+        card = [rule for rule in parser.rules.values() if rule.name == 'card'][0]
+        self.assertEqual(['broken', 'price', 'seats', 'title'], [rule.name for rule in card.children])
+
+    def assertReloaded(self, change):
+        parser = self.registry.get('parser')
+        version = self.registry.version('parser')
+        change()
+        self.assertGreater(self.registry.version('parser'), version)
+        self.assertIsNot(parser, self.registry.get('parser'))
+
+    def test_rule_change_bumps_version(self):
+        def change():
+            rule = Rule.objects.get(name='seats')
+            rule.xpath = './/span[@class="price"]/text()'
+            rule.save()
+        self.assertReloaded(change)
+        self.assertEqual('__error__', self.registry.get('parser').parse(PAGE)['card_0']['seats'])
+
+    def test_rule_deletion_bumps_version(self):
+        self.assertReloaded(lambda: Rule.objects.get(name='seats').delete())
+        self.assertNotIn('seats', self.registry.get('parser').parse(PAGE)['card_0'])
+
+    def test_rule_set_change_bumps_version(self):
+        self.assertReloaded(lambda: self.parser.rule_set.remove(Rule.objects.get(name='header')))
+        self.assertReloaded(lambda: Rule.objects.get(name='header').parsers.add(self.parser))
+        self.assertReloaded(lambda: Rule.objects.get(name='header').parsers.clear())
+        self.assertNotIn('header', self.registry.get('parser').parse(PAGE))
+
+    def test_stale_parser_does_not_move_version_back(self):
+        stale = Parser.objects.get(name='parser')
+        Parser.bump_version(Parser.objects.filter(name='parser'))
+        Parser.bump_version(Parser.objects.filter(name='parser'))
+        version = self.registry.version('parser')
+        stale.name = 'renamed'
+        stale.save()
+        self.assertEqual(version + 1, self.registry.version('renamed'))
+
+    def test_typeof_change_bumps_version(self):
+        self.assertReloaded(lambda: TypeOf.objects.get(name=TypeOf.T_INTEGER).save())
+
+    def test_other_parser_is_not_affected(self):
+        other = Parser.objects.create(name='other')
+        version = self.registry.version('other')
+        Rule.objects.get(name='seats').save()
+        self.assertEqual(version, self.registry.version('other'))
+
+
+class TestConverters(TestCase):
+
+    def setUp(self):
+        from leoparser.converters import get_converter
+        self.get_converter = get_converter
+
+    def test_date(self):
+        to_date = self.get_converter(TypeOf.T_DATE)
+        self.assertEqual(datetime.date(2026, 5, 15), to_date('15 мая 2026'))
+        self.assertEqual(datetime.date(2026, 5, 15), to_date('15.05.2026'))
+        self.assertEqual(datetime.date(2026, 5, 15), to_date('15.05.26'))
+        self.assertEqual(datetime.date(2026, 5, 15), to_date('2026-05-15'))
+        self.assertEqual(datetime.date(2026, 12, 1), to_date('Дата: 1\xa0декабря 2026 г.'))
+        self.assertEqual(datetime.date.today().year, to_date('1 июня').year)
+        self.assertEqual('unknown', to_date('unknown'))
+        self.assertEqual([], to_date([]))
+
+    def test_datetime(self):
+        to_datetime = self.get_converter(TypeOf.T_DATETIME)
+        value = to_datetime('15 мая 2026, пятница, 18:30')
+        self.assertEqual(datetime.datetime(2026, 5, 15, 18, 30), value.replace(tzinfo=None))
+        self.assertEqual(datetime.timedelta(hours=3), value.utcoffset())
+        self.assertEqual(datetime.datetime(2026, 5, 16), to_datetime('16.05.2026').replace(tzinfo=None))
+
+    def test_currency(self):
+        to_currency = self.get_converter(TypeOf.T_CURRENCY)
+        self.assertEqual(1500, to_currency('1 500 ₽'))
+        self.assertEqual(1500, to_currency('1\xa0500 руб.'))
+        self.assertEqual(1500.5, to_currency('1 500,50 р.'))
+        self.assertEqual(1200, to_currency('1 200.00 р.'))
+        self.assertEqual(0, to_currency('Бесплатно'))
+        self.assertIsInstance(to_currency('700 ₽'), int)
+
+    def test_time(self):
+        to_time = self.get_converter(TypeOf.T_TIME)
+        self.assertEqual(datetime.timedelta(hours=2), to_time('2 часа'))
+        self.assertEqual(datetime.timedelta(hours=1, minutes=30), to_time('1 ч. 30 мин.'))
+        self.assertEqual(datetime.timedelta(minutes=90), to_time('90 минут'))
+        self.assertEqual(datetime.timedelta(hours=1, minutes=30), to_time('1,5 часа'))
+        self.assertEqual(datetime.time(18, 30), to_time('18:30'))
+        self.assertEqual('18 человек', to_time('18 человек'))
+
+    def test_batch(self):
+        to_date = self.get_converter(TypeOf.T_DATE)
+        values = ['15.05.2026', '16.05.2026', '1 июня 2026', 'unknown']
+        self.assertEqual([datetime.date(2026, 5, 15), datetime.date(2026, 5, 16), datetime.date(2026, 6, 1),
+                          'unknown'], to_date(values))
+        self.assertEqual(datetime.date(2026, 5, 15), to_date(['15.05.2026']))
+        self.assertEqual([1, 2], self.get_converter(TypeOf.T_INTEGER)(['1', '2']))
+
+    def test_format_is_cached_per_converter(self):
+        first, second = self.get_converter(TypeOf.T_DATE), self.get_converter(TypeOf.T_DATE)
+        first('15.05.2026')
+        second('15 мая 2026')
+        self.assertEqual('dd.mm.yyyy', first.format.name)
+        self.assertEqual('dd month yyyy', second.format.name)
+        first('15 мая 2026')
+        self.assertEqual('dd month yyyy', first.format.name)
+
+    def test_typeof_converters(self):
+        self.assertEqual(1500, TypeOf(name=TypeOf.T_CURRENCY).convert(['1 500 ₽']))
+        self.assertEqual(datetime.date(2026, 5, 15), TypeOf(name=TypeOf.T_DATE).convert('15 мая 2026'))
+
+    def test_format_is_cached_per_rule(self):
+        import lxml.html
+        typeof = TypeOf(name=TypeOf.T_DATE)
+        first = Rule(name='first', xpath='//i/text()', typeof=typeof)
+        second = Rule(name='second', xpath='//b/text()', typeof=typeof)
+        html = lxml.html.document_fromstring('<p><i>15.05.2026</i><b>15 мая 2026</b></p>')
+        self.assertEqual(datetime.date(2026, 5, 15), first.apply(html))
+        self.assertEqual(datetime.date(2026, 5, 15), second.apply(html))
+        self.assertEqual('dd.mm.yyyy', first.converter.format.name)
+        self.assertEqual('dd month yyyy', second.converter.format.name)
+        self.assertIsNot(first.converter, typeof.converters[TypeOf.T_DATE])
+        first.typeof = TypeOf(name=TypeOf.T_TIME)
+        self.assertIsNone(first.converter.format)
+
+
+class TestContentFingerprint(TestCase):
+
+    def test_fingerprint_is_stable(self):
+        self.assertEqual(content_fingerprint({'a': 1, 'b': [1, 2]}), content_fingerprint({'b': [1, 2], 'a': 1}))
+        self.assertNotEqual(content_fingerprint({'a': 1}), content_fingerprint({'a': 2}))
+        self.assertEqual(content_fingerprint({'a': {0: 'x'}}), content_fingerprint({'a': {'0': 'x'}}))
+        self.assertEqual(content_fingerprint({'a': {0: 'x', 'b': 'y'}}),
+                         content_fingerprint({'a': {'0': 'x', 'b': 'y'}}))
+        self.assertEqual(content_fingerprint({'a': datetime.date(2026, 5, 15)}),
+                         content_fingerprint({'a': '2026-05-15'}))
+
+    def test_fingerprint_is_saved(self):
+        doc, _, _ = Document.history.save(content={'uid': 1, 'a': 1})
+        doc = Document.objects.get(id=doc.id)
+        self.assertEqual(content_fingerprint({'a': 1}), doc.fingerprint)
+        self.assertEqual(content_fingerprint(doc.content), doc.fingerprint)
+
+    def test_equal_content_is_not_saved(self):
+        doc, _, _ = Document.history.save(content={'uid': 1, 'a': 1})
+        modified = Document.objects.get(id=doc.id).modified
+
+        with self.assertNumQueries(1):
+            same_doc, is_new, delta = Document.history.save(content={'uid': 1, 'a': 1})
+
+        self.assertFalse(is_new)
+        self.assertEqual([], delta)
+        self.assertEqual(doc.id, same_doc.id)
+        self.assertEqual({'a': 1}, same_doc.content)
+        self.assertEqual(modified, Document.objects.get(id=doc.id).modified)
+        self.assertEqual(0, DocDelta.objects.count())
+
+    def test_content_without_untracked_key_is_not_saved_again(self):
+        Document.history.save(content={'uid': 1, 'a': 1, 'b': 2})
+        doc, _, delta = Document.history.save(content={'uid': 1, 'a': 1})
+        self.assertEqual([], delta)
+        self.assertEqual({'a': 1, 'b': 2}, Document.objects.get(id=doc.id).content)
+        self.assertEqual(content_fingerprint({'a': 1}), Document.objects.get(id=doc.id).fingerprint)
+
+        with self.assertNumQueries(1):
+            _, is_new, delta = Document.history.save(content={'uid': 1, 'a': 1})
+        self.assertFalse(is_new)
+        self.assertEqual([], delta)
+
+        modified = Document.objects.get(id=doc.id).modified
+        results = Document.history.save_many([{'uid': 1, 'a': 1}])
+        self.assertEqual([(doc.id, False, [])], [(doc.id, is_new, delta) for doc, is_new, delta in results])
+        self.assertEqual(modified, Document.objects.get(id=doc.id).modified)
+        self.assertEqual([], Document.history.changed([{'uid': 1, 'a': 1}]))
+
+    def test_typed_content_is_compared_as_stored(self):
+        content = {'d': datetime.date(2026, 5, 15), 'dt': timezone.now(), 't': datetime.time(18, 30),
+                   'td': datetime.timedelta(hours=1, minutes=30), 'n': 1}
+        Document.history.save(dict(content, uid=1))
+        doc, _, delta = Document.history.save(dict(content, uid=1, n=2))
+
+        self.assertEqual([('change', 'n', (1, 2))], list(delta))
+        self.assertEqual([[['change', 'n', [1, 2]]]], [d.delta for d in DocDelta.objects.all()])
+        results = Document.history.save_many([dict(content, uid=1, n=3)])
+        self.assertEqual([('change', 'n', (2, 3))], list(results[0][2]))
+        self.assertEqual(str(content['d']), Document.objects.get(id=doc.id).content['d'])
+
+    def test_changed_content_is_saved(self):
+        Document.history.save(content={'uid': 1, 'a': 1})
+        doc, is_new, delta = Document.history.save(content={'uid': 1, 'a': 2})
+
+        self.assertFalse(is_new)
+        self.assertEqual([('change', 'a', (1, 2))], list(delta))
+        self.assertEqual({'a': 2}, Document.objects.get(id=doc.id).content)
+        self.assertEqual(1, DocDelta.objects.count())
+
+    def test_changed_contents(self):
+        Document.history.save(content={'uid': 1, 'a': 1})
+        Document.history.save(content={'uid': 2, 'a': 1})
+        contents = [{'uid': 1, 'a': 1}, {'uid': 2, 'a': 2}, {'uid': 3, 'a': 1}, {'a': 1}]
+
+        with self.assertNumQueries(1):
+            changed = Document.history.changed(contents)
+
+        self.assertEqual(contents[1:], changed)
+        self.assertEqual({'1': content_fingerprint({'a': 1})}, Document.history.fingerprints([1, 3]))
+
+
+class TestHistoryManagerSaveMany(TestCase):
+
+    def test_save_new_documents(self):
+        results = Document.history.save_many([{'uid': 1, 'a': 1}, {'uid': 2, 'a': 2}, {'a': 3}])
+
+        self.assertEqual(3, len(results))
+        self.assertTrue(all(is_new for _, is_new, _ in results))
+        self.assertEqual(['1', '2'], [doc.uid for doc, _, _ in results[:2]])
+        self.assertRegex(results[2][0].uid, r'[0-9a-f]{32}')
+        for (doc, _, delta), content in zip(results, [{'a': 1}, {'a': 2}, {'a': 3}]):
+            self.assertEqual([], delta)
+            stored = Document.objects.get(id=doc.id)
+            self.assertEqual(content, stored.content)
+            self.assertEqual(doc.id, stored.pk)
+            self.assertEqual(content_fingerprint(content), stored.fingerprint)
+
+    def test_save_existing_documents(self):
+        Document.history.save(content={'uid': 1, 'a': 1})
+        Document.history.save(content={'uid': 2, 'a': 1})
+
+        results = Document.history.save_many([{'uid': 1, 'a': 2}, {'uid': 2, 'a': 1}, {'uid': 3, 'a': 1}])
+
+        self.assertEqual([False, False, True], [is_new for _, is_new, _ in results])
+        self.assertEqual([[('change', 'a', (1, 2))], [], []], [list(delta) for _, _, delta in results])
+        self.assertEqual({'a': 2}, Document.objects.get(uid='1').content)
+        self.assertEqual(content_fingerprint({'a': 2}), Document.objects.get(uid='1').fingerprint)
+        self.assertEqual(3, Document.objects.count())
+        self.assertEqual([[['change', 'a', [1, 2]]]], [d.delta for d in DocDelta.objects.all()])
+
+    def test_save_many_equals_save(self):
+        contents = [{'a': 1, 'b': {'c': 1}}, {'a': [1, 2]}]
+        modified = [{'a': 2, 'b': {'d': 1}}, {'a': [1, 3], 'e': 1}]
+        for uid, content in enumerate(contents):
+            Document.history.save(dict(content, uid=uid))
+        Document.history.save_many([dict(content, uid=uid + 10) for uid, content in enumerate(contents)])
+
+        single = [Document.history.save(dict(content, uid=uid)) for uid, content in enumerate(modified)]
+        many = Document.history.save_many([dict(content, uid=uid + 10) for uid, content in enumerate(modified)])
+
+        self.assertEqual([list(delta) for _, _, delta in single], [list(delta) for _, _, delta in many])
+        self.assertEqual([doc.content for doc, _, _ in single], [doc.content for doc, _, _ in many])
+        for (doc, _, _), (other, _, _) in zip(single, many):
+            self.assertEqual(Document.objects.get(id=doc.id).content, Document.objects.get(id=other.id).content)
+
+    def test_queries_do_not_depend_on_amount_of_documents(self):
+        Document.history.save_many([{'uid': i, 'a': 1} for i in range(3)])
+
+        with self.assertNumQueries(8):
+            Document.history.save_many([{'uid': i, 'a': 2} for i in range(30)])
+
+    def test_duplicated_uid(self):
+        results = Document.history.save_many([{'uid': 1, 'a': 1}, {'uid': 1, 'a': 2}])
+
+        self.assertIs(results[0][0], results[1][0])
+        self.assertEqual({'a': 2}, Document.objects.get(uid='1').content)
+
+    def test_mapping(self):
+        date = timezone.now()
+        results = TestMappingDocument.history.save_many([{'uid': 1, 'date': {'field': date},
+                                                          'nested': {'name': 'name', 'title': 'title'}}])
+        doc = TestMappingDocument.objects.get(id=results[0][0].id)
+        self.assertEqual(date, doc.date)
+        self.assertEqual('name', doc.related.name)
+
+        later = date + datetime.timedelta(days=1)
+        TestMappingDocument.history.save_many([{'uid': 1, 'date': {'field': later},
+                                                'nested': {'name': 'name', 'title': 'title'}}])
+        self.assertEqual(later, TestMappingDocument.objects.get(id=doc.id).date)
+
+    def test_signals_are_sent(self):
+        handler = mock.Mock()
+        post_save.connect(handler, sender=Document)
+        try:
+            Document.history.save_many([{'uid': 1, 'a': 1}])
+        finally:
+            post_save.disconnect(handler, sender=Document)
+        self.assertEqual(1, handler.call_count)
+        self.assertTrue(handler.call_args[1]['created'])
+
+    def test_deltas_are_buffered(self):
+        doc, _, _ = Document.history.save(content={'uid': 1, 'a': 1})
+        with DocDelta.objects.buffered():
+            DocDelta.objects.record(doc, [['change', 'a', [1, 2]]])
+            self.assertEqual(0, DocDelta.objects.count())
+        self.assertEqual(1, DocDelta.objects.count())
+
+
+@override_settings(LEOPARSER_SNAPSHOT_EVERY=3, LEOPARSER_SNAPSHOT_INTERVAL=datetime.timedelta(days=1))
+class TestDocSnapshot(TestCase):
+
+    def test_snapshot_every_n_changes(self):
+        for a in range(8):
+            doc, _, _ = Document.history.save(content={'uid': 1, 'a': a})
+
+        snapshots = list(doc.snapshot_set.order_by('created'))
+        self.assertEqual([{'a': 3}, {'a': 6}], [snapshot.content for snapshot in snapshots])
+        self.assertEqual(1, Document.objects.get(id=doc.id).changes_since_snapshot)
+        for snapshot in snapshots:
+            # every change increases "a" by one, so snapshot includes exactly "a" deltas
+            self.assertEqual(snapshot.content['a'], doc.delta_set.filter(created__lte=snapshot.created).count())
+
+    def test_equal_content_is_not_counted(self):
+        for _ in range(5):
+            doc, _, _ = Document.history.save(content={'uid': 1, 'a': 1})
+        self.assertEqual(0, DocSnapshot.objects.count())
+        self.assertEqual(0, Document.objects.get(id=doc.id).changes_since_snapshot)
+
+    def test_snapshot_after_interval(self):
+        doc, _, _ = Document.history.save(content={'uid': 1, 'a': 0})
+        later = timezone.now() + datetime.timedelta(days=2)
+        with mock.patch('django.utils.timezone.now', mock.Mock(return_value=later)):
+            Document.history.save(content={'uid': 1, 'a': 1})
+        self.assertEqual([{'a': 1}], [snapshot.content for snapshot in doc.snapshot_set.all()])
+
+    def test_replay_from_nearest_snapshot(self):
+        for a in range(5):
+            doc, _, _ = Document.history.save(content={'uid': 1, 'a': a, 'b': [a]})
+
+        snapshot = doc.nearest_snapshot()
+        deltas = doc.delta_set.filter(created__gt=snapshot.created).order_by('created')
+        self.assertEqual(1, len(deltas))
+        self.assertEqual(Document.objects.get(id=doc.id).content, snapshot.replay(deltas))
+        self.assertIsNone(doc.nearest_snapshot(doc.created))
+
+    def test_snapshots_of_save_many(self):
+        for a in range(4):
+            Document.history.save_many([{'uid': 1, 'a': a}, {'uid': 2, 'a': -a}])
+
+        for uid, content in (('1', {'a': 3}), ('2', {'a': -3})):
+            snapshot = DocSnapshot.objects.get(base__uid=uid)
+            self.assertEqual(content, snapshot.content)
+            self.assertFalse(DocDelta.objects.filter(base__uid=uid, created__gt=snapshot.created).exists())
+
+
+@override_settings(LEOPARSER_SNAPSHOT_EVERY=3, LEOPARSER_SNAPSHOT_INTERVAL=datetime.timedelta(days=1))
+class TestDocumentAsOf(TestCase):
+
+    def setUp(self):
+        self.start = timezone.now() - datetime.timedelta(hours=10)
+        self.moments = []
+        for hour in range(8):
+            moment = self.start + datetime.timedelta(hours=hour)
+            self.moments.append(moment)
+            with mock.patch('django.utils.timezone.now', mock.Mock(return_value=moment)):
+                Document.history.save_many([{'uid': 1, 'seats': 10 - hour, 'title': 'first'},
+                                            {'uid': 2, 'seats': 20 - hour % 2, 'title': 'second'}])
+        self.doc = Document.objects.get(uid='1')
+
+    def test_as_of(self):
+        for hour, moment in enumerate(self.moments):
+            self.assertEqual({'seats': 10 - hour, 'title': 'first'}, self.doc.as_of(moment))
+            self.assertEqual({'seats': 10 - hour, 'title': 'first'},
+                             self.doc.as_of(moment + datetime.timedelta(minutes=30)))
+
+    def test_as_of_before_creation(self):
+        self.assertIsNone(self.doc.as_of(self.start - datetime.timedelta(minutes=1)))
+
+    def test_as_of_without_snapshots(self):
+        DocSnapshot.objects.all().delete()
+        self.assertEqual({'seats': 8, 'title': 'first'}, self.doc.as_of(self.moments[2]))
+
+    def test_manager_as_of(self):
+        Document.history.save({'uid': 3, 'seats': 1})
+
+        # forward from snapshots
+        with self.assertNumQueries(3):
+            contents = Document.history.as_of(self.moments[4])
+        self.assertEqual({'1': {'seats': 6, 'title': 'first'}, '2': {'seats': 20, 'title': 'second'}}, contents)
+
+        # backward from the next snapshot
+        with self.assertNumQueries(4):
+            contents = Document.history.as_of(self.moments[1])
+        self.assertEqual({'1': {'seats': 9, 'title': 'first'}, '2': {'seats': 19, 'title': 'second'}}, contents)
+
+        self.assertEqual({'2': {'seats': 19, 'title': 'second'}}, Document.history.as_of(self.moments[5], uids=[2]))
+
+
+class TestDocumentHistoryScope(TestCase):
+
+    def test_history_of_document_only(self):
+        for b in range(3):
+            doc, _, _ = Document.history.save(content={'uid': 1, 'b': b})
+            Document.history.save(content={'uid': 2, 'b': b * 10})
+
+        self.assertEqual([{'b': 2}, {'b': 1}, {'b': 0}], doc.get_history())
+
+    def test_iter_history_limits_query(self):
+        for b in range(5):
+            doc, _, _ = Document.history.save(content={'uid': 1, 'b': b})
+
+        with self.assertNumQueries(1) as context:
+            history = list(doc.iter_history(3, chunk_size=1))
+        self.assertEqual([{'b': 4}, {'b': 3}, {'b': 2}], history)
+        self.assertIn('LIMIT 2', context.captured_queries[0]['sql'])
+
+        with self.assertNumQueries(0):
+            self.assertEqual([{'b': 4}], list(doc.iter_history(1)))
+
+
+@override_settings(LEOPARSER_SNAPSHOT_EVERY=1000, LEOPARSER_SNAPSHOT_INTERVAL=datetime.timedelta(days=1000))
+class TestHistoryCompaction(TestCase):
+
+    def save_at(self, moment, content):
+        with mock.patch('django.utils.timezone.now', mock.Mock(return_value=moment)):
+            doc, _, _ = Document.history.save(content=dict(content))
+        return doc
+
+    def create_history(self, start, amount, step=datetime.timedelta(minutes=5), uid=1):
+        doc = None
+        for seats in range(amount):
+            doc = self.save_at(start + seats * step, {'uid': uid, 'seats': amount - seats, 'tags': ['a'] * seats})
+        return doc
+
+    def test_merge_hourly(self):
+        start = (timezone.now() - datetime.timedelta(days=3)).replace(minute=0, second=0, microsecond=0)
+        doc = self.create_history(start, 6)
+        expected = doc.get_history()
+        self.assertEqual(6, len(expected))
+
+        report = compact_history(hourly_after=datetime.timedelta(days=1))
+
+        self.assertEqual(1, report.merged)
+        self.assertEqual(4, report.deleted)
+        self.assertGreater(report.bytes_reclaimed, 0)
+        doc = Document.objects.get(id=doc.id)
+        self.assertEqual([expected[0], expected[-1]], doc.get_history())
+        self.assertEqual(expected[0], doc.as_of(start + datetime.timedelta(hours=1)))
+
+    def test_merge_daily(self):
+        start = (timezone.now() - datetime.timedelta(days=40)).replace(hour=10, minute=0, second=0, microsecond=0)
+        doc = self.create_history(start, 5, step=datetime.timedelta(hours=2))
+        expected = doc.get_history()
+
+        compact_history(hourly_after=datetime.timedelta(days=1), daily_after=datetime.timedelta(days=30))
+
+        history = Document.objects.get(id=doc.id).get_history()
+        self.assertEqual([expected[0], expected[-1]], history)
+
+    def test_recent_deltas_are_kept(self):
+        doc = self.create_history(timezone.now() - datetime.timedelta(hours=2), 6, step=datetime.timedelta(minutes=1))
+        report = compact_history(hourly_after=datetime.timedelta(days=1))
+        self.assertEqual(0, report.merged)
+        self.assertEqual(5, DocDelta.objects.filter(base=doc).count())
+
+    def test_deltas_are_not_merged_across_snapshot(self):
+        start = (timezone.now() - datetime.timedelta(days=3)).replace(minute=0, second=0, microsecond=0)
+        with self.settings(LEOPARSER_SNAPSHOT_EVERY=3):
+            doc = self.create_history(start, 7)
+        snapshot = doc.snapshot_set.order_by('created').first()
+
+        compact_history(hourly_after=datetime.timedelta(days=1))
+
+        doc = Document.objects.get(id=doc.id)
+        self.assertEqual(2, DocDelta.objects.filter(base=doc).count())
+        self.assertEqual(snapshot.content, doc.as_of(snapshot.created))
+        self.assertEqual(doc.content, doc.as_of(timezone.now()))
+        self.assertEqual({'seats': 7, 'tags': []}, doc.get_history()[-1])
+
+    def test_expire_history(self):
+        start = timezone.now() - datetime.timedelta(days=400)
+        with self.settings(LEOPARSER_SNAPSHOT_EVERY=2):
+            old = self.create_history(start, 6, step=datetime.timedelta(days=1))
+        recent = self.create_history(timezone.now() - datetime.timedelta(days=2), 3, uid=2)
+        moment = start + datetime.timedelta(days=20)
+        content = old.as_of(moment)
+
+        report = expire_history(retention=datetime.timedelta(days=365))
+
+        self.assertEqual(4, report.deleted)
+        self.assertGreater(report.bytes_reclaimed, 0)
+        self.assertEqual(1, DocSnapshot.objects.filter(base=old).count())
+        self.assertEqual(1, DocDelta.objects.filter(base=old).count())
+        self.assertEqual(2, DocDelta.objects.filter(base=recent).count())
+        self.assertEqual(content, Document.objects.get(id=old.id).as_of(moment))
+
+    def test_compact_history_command(self):
+        start = (timezone.now() - datetime.timedelta(days=3)).replace(minute=0, second=0, microsecond=0)
+        self.create_history(start, 6)
+        out = io.StringIO()
+        call_command('compact_history', '--hourly-after', '24', stdout=out)
+        self.assertIn('merged deltas: 1, deleted deltas: 4', out.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command('compact_history', '--retention', '0')
+
+
+class TestFastDiff(TestCase):
+
+    cases = [
+        ({}, {}),
+        ({'a': 1}, {'a': 2}),
+        ({'a': 1}, {'a': 1, 'b': [1, 2]}),
+        ({'a': 1, 'b': 2}, {'b': 2}),
+        ({'a': {'b': {'c': 1}}}, {'a': {'b': {'c': 2, 'd': 3}}}),
+        ({'a': [1, 2, 3]}, {'a': [1, 4]}),
+        ({'a': [1]}, {'a': [1, {'b': 2}, 3]}),
+        ({'a': [{'b': 1}, {'c': 2}]}, {'a': [{'b': 2}, {'c': 2}]}),
+        ({'a': {'b': 1}}, {'a': [1]}),
+        ({'a': None}, {'a': {'b': 1}}),
+        ({'a.b': {'c': 1}}, {'a.b': {'c': 2}}),
+        ({0: {'x': 1}}, {0: {'x': 2}, 1: 'y'}),
+        ({'a': 1.0}, {'a': 1.0 + 1e-12}),
+        ({'a': float('nan')}, {'a': float('nan')}),
+        ({'a': {1, 2}}, {'a': {2, 3}}),
+        ({'a': 'text'}, {'a': 'test'}),
+        ([1, 2], [2, 1, 0]),
+    ]
+
+    def test_compatible_with_dictdiffer(self):
+        for first, second in self.cases:
+            self.assertEqual(list(diff(first, second)), fast_diff(first, second), (first, second))
+
+    def test_equal_subtrees_are_skipped(self):
+        big = {str(i): {'items': list(range(100))} for i in range(100)}
+        modified = dict(big, seats=1)
+        with mock.patch('leoparser.diff.are_different', side_effect=AssertionError) as are_different:
+            self.assertEqual([('add', '', [('seats', 1)])], fast_diff(big, modified))
+        self.assertFalse(are_different.called)
+
+    def test_values_are_copied(self):
+        second = {'a': {'b': [1]}}
+        result = fast_diff({}, second)
+        second['a']['b'].append(2)
+        self.assertEqual([('add', '', [('a', {'b': [1]})])], result)
+
+    def test_delta_is_cached(self):
+        doc, _, _ = Document.history.save(content={'uid': 1, 'a': 1})
+        doc.content = {'a': 2}
+
+        with mock.patch('leoparser.models.fast_diff', wraps=fast_diff) as diff_mock:
+            self.assertIs(doc.delta, doc.delta)
+            self.assertEqual({'a': 2}, doc.patched_content)
+            self.assertEqual(1, diff_mock.call_count)
+            doc.content = {'a': 3}
+            self.assertEqual([('change', 'a', (1, 3))], doc.delta)
+            self.assertEqual(2, diff_mock.call_count)
+            doc.save()
+            self.assertEqual(2, diff_mock.call_count)
+        self.assertEqual([], doc.delta)
+        self.assertEqual([[['change', 'a', [1, 3]]]], [d.delta for d in DocDelta.objects.all()])
+
+
+class TestPackedDeltas(TestCase):
+
+    def save_versions(self, uid=1):
+        doc = None
+        for seats in range(4):
+            doc, _, _ = Document.history.save(content={'uid': uid, 'seats': seats, 'title': 'title'})
+        return doc
+
+    def test_packed_field(self):
+        field = DocDelta._meta.get_field('packed')
+        delta = [['change', 'seats', [1, 2]]] * 50
+        packed = field.pack(delta)
+        self.assertLess(len(packed), len(json.dumps(delta)))
+        self.assertEqual(delta, field.unpack(packed))
+
+    @override_settings(LEOPARSER_PACK_DELTAS=True)
+    def test_deltas_are_packed(self):
+        doc = self.save_versions()
+
+        delta = DocDelta.objects.filter(base=doc).order_by('created').first()
+        self.assertIsNone(delta.delta)
+        self.assertEqual([['change', 'seats', [0, 1]]], delta.packed)
+        self.assertEqual(delta.packed, delta.changes)
+        self.assertIn('seats', str(delta))
+        self.assertEqual([{'seats': seats, 'title': 'title'} for seats in (3, 2, 1, 0)], doc.get_history())
+        self.assertEqual({'seats': 0, 'title': 'title'}, doc.as_of(doc.created))
+
+    def test_pack_deltas_command(self):
+        doc = self.save_versions()
+        history = doc.get_history()
+
+        call_command('pack_deltas', '--batch-size', '2', stdout=io.StringIO())
+        self.assertFalse(DocDelta.objects.filter(delta__isnull=False).exists())
+        self.assertEqual(history, doc.get_history())
+
+        call_command('pack_deltas', '--unpack', stdout=io.StringIO())
+        self.assertFalse(DocDelta.objects.filter(packed__isnull=False).exists())
+        self.assertEqual(history, doc.get_history())
+
+    @override_settings(LEOPARSER_PACK_DELTAS=True)
+    def test_mixed_deltas(self):
+        with self.settings(LEOPARSER_PACK_DELTAS=False):
+            self.save_versions()
+        doc, _, _ = Document.history.save(content={'uid': 1, 'seats': 5, 'title': 'title'})
+
+        self.assertEqual(1, DocDelta.objects.filter(packed__isnull=False).count())
+        self.assertEqual([5, 3, 2, 1, 0], [version['seats'] for version in doc.get_history()])
@@ -0,0 +1,148 @@
+from collections import namedtuple
+
+TraceEvent = namedtuple('TraceEvent', ('rule_id', 'name', 'depth', 'elapsed', 'matches', 'error'))
+
+
+def count_matches(result):
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    return 0 if result is None else 1
+
+
+class ParseTrace:
+    """
+    In-memory trace of parsing.
+    Every application of a rule is stored as TraceEvent in order of execution.
+    Instance is a hook for ExecutionPlan.execute, see Parser.tracing
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, step, elapsed, result, error):
+        matches = 0 if error is not None else count_matches(result)
+        self.events.append(TraceEvent(step.id, step.name, step.depth, elapsed, matches, error))
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __len__(self):
+        return len(self.events)
+
+    @property
+    def errors(self):
+        return [event for event in self.events if event.error is not None]
+
+    @property
+    def elapsed(self):
+        return sum(event.elapsed for event in self.events)
+
+    def clear(self):
+        self.events = []
+
+    def format(self):
+        """
+        Render trace as tree of applied rules
+        :return: str
+        """
+        lines = []
+        for event in self.events:
+            line = '%s|_ %s (id=%s) matches=%s time=%.6fs' % (' ' * (event.depth * 3), event.name, event.rule_id,
+                                                               event.matches, event.elapsed)
+            if event.error is not None:
+                line += ' error=%r' % (event.error,)
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return '<%s: events="%s" errors="%s">' % (self.__class__.__name__, len(self.events), len(self.errors),)
+
+
+class RuleProfile:
+    """
+    Aggregated statistics of a single rule
+    """
+    __slots__ = ('rule_id', 'name', 'depth', 'calls', 'elapsed', 'matches', 'max_matches', 'errors')
+
+    def __init__(self, rule_id, name, depth):
+        self.rule_id = rule_id
+        self.name = name
+        self.depth = depth
+        self.calls = 0
+        self.elapsed = 0.0
+        self.matches = 0
+        self.max_matches = 0
+        self.errors = 0
+
+    @property
+    def mean(self):
+        return self.elapsed / self.calls if self.calls else 0.0
+
+    def __repr__(self):
+        return '<%s: id="%s" name="%s" calls="%s" elapsed="%.6f">' % (self.__class__.__name__, self.rule_id, self.name,
+                                                                      self.calls, self.elapsed,)
+
+
+class ParseProfile:
+    """
+    Per rule report of parsing: wall time, amount of calls, cardinality of results and amount of exceptions.
+    Instance is a hook for ExecutionPlan.execute, see Parser.profile
+    """
+
+    def __init__(self):
+        self.rules = {}
+        self.documents = 0
+        self.document_time = 0.0
+        self.doc = None
+
+    def __call__(self, step, elapsed, result, error):
+        try:
+            profile = self.rules[step.id]
+        except KeyError:
+            profile = self.rules[step.id] = RuleProfile(step.id, step.name, step.depth)
+        profile.calls += 1
+        profile.elapsed += elapsed
+        if error is not None:
+            profile.errors += 1
+        else:
+            matches = count_matches(result)
+            profile.matches += matches
+            profile.max_matches = max(profile.max_matches, matches)
+
+    def __getitem__(self, rule_id):
+        return self.rules[rule_id]
+
+    def __iter__(self):
+        return iter(self.rules.values())
+
+    def __len__(self):
+        return len(self.rules)
+
+    @property
+    def elapsed(self):
+        return sum(profile.elapsed for profile in self.rules.values())
+
+    def slowest(self, n=None):
+        profiles = sorted(self.rules.values(), key=lambda p: p.elapsed, reverse=True)
+        return profiles[:n] if n else profiles
+
+    def format(self, n=None, sources=None):
+        """
+        Render report as table ordered by time spent in rule
+        :param n: amount of rows, all rules by default
+        :param sources: dict of rule id to text which describes rule, e.g. xpath
+        :return: str
+        """
+        sources = sources or {}
+        lines = ['documents: %s, html parsing: %.6fs, rules: %.6fs' % (self.documents, self.document_time,
+                                                                      self.elapsed),
+                 '%8s %-24s %8s %12s %12s %9s %7s %7s  %s' % ('id', 'name', 'calls', 'total, s', 'mean, s',
+                                                             'matches', 'max', 'errors', 'source')]
+        for p in self.slowest(n):
+            lines.append('%8s %-24s %8s %12.6f %12.6f %9s %7s %7s  %s' % (p.rule_id, p.name[:24], p.calls, p.elapsed,
+                                                                        p.mean, p.matches, p.max_matches, p.errors,
+                                                                        sources.get(p.rule_id, '')))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return '<%s: rules="%s" documents="%s">' % (self.__class__.__name__, len(self.rules), self.documents,)